@@ -0,0 +1,4 @@
+"""Benchmarks for pib.
+
+Run from the top-level directory, e.g. ``python -m benchmarks.bench_yaml``.
+"""
@@ -0,0 +1,43 @@
+"""Compare building a System with pyrsistent transforms to the builder."""
+
+from pyrsistent import freeze, ny as match_any, discard
+
+from pib.envfile import System, load_envfile, _build_system
+
+from .common import make_envfile, best_of, report
+
+
+def transform_system(instance):
+    """The original, transform-based way of building a System."""
+    instance = freeze(instance)
+    instance = instance.remove("Envfile-version")
+    instance = instance.transform(["local", "templates", match_any, "type"],
+                                  discard)
+
+    def add_name(mapping):
+        for key, value in mapping.items():
+            mapping = mapping.set(key, value.set("name", key))
+        return mapping
+
+    instance = instance.transform(["local", "templates"], add_name)
+    instance = instance.transform(["application", "requires"], add_name)
+    instance = instance.transform(["application", "services"], add_name)
+    instance = instance.transform(
+        ["application", "services", match_any, "requires"], add_name)
+    return System.create(instance)
+
+
+def main():
+    for services, requires in [(400, 2), (2000, 5)]:
+        instance = make_envfile(
+            services=services, private_requires=requires,
+            shared_requires=requires * 10)
+        assert transform_system(instance) == load_envfile(instance)
+        report("build System: {} services, {} requires each".format(
+            services, requires),
+            best_of(lambda: transform_system(instance), repeat=3),
+            best_of(lambda: _build_system(instance), repeat=3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""Compare manifest sizes with per-key env entries and with envFrom."""
+
+import json
+
+from pib import _yaml
+from pib.envfile import load_envfile
+from pib.kubernetes import envfile_to_k8s, RenderingOptions
+
+from .common import make_envfile
+
+
+def sizes(objects, options):
+    """
+    :return: tuple of (bytes of Deployment YAML, bytes of all YAML, bytes of
+        all JSON).
+    """
+    manifests = [o.render(options) for o in objects]
+    deployments = [m for m in manifests if m["kind"] == "Deployment"]
+    return (len(_yaml.safe_dump_all(deployments)),
+            len(_yaml.safe_dump_all(manifests)),
+            sum(len(json.dumps(m)) for m in manifests))
+
+
+def main():
+    for shared_requires in [0, 10, 50]:
+        objects = envfile_to_k8s(load_envfile(make_envfile(
+            shared_requires=shared_requires)))
+        env = sizes(objects, RenderingOptions())
+        env_from = sizes(objects, RenderingOptions(env_from=True))
+        print("{} shared requires:".format(shared_requires))
+        for name, baseline, optimized in zip(
+                ["Deployment YAML", "all YAML", "all JSON"], env, env_from):
+            print("  {}: {} bytes -> {} bytes ({:.1f}x)".format(
+                name, baseline, optimized, baseline / optimized))
+
+
+if __name__ == "__main__":
+    main()
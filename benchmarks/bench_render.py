@@ -0,0 +1,26 @@
+"""Show how rendering Kubernetes objects scales with the number of services."""
+
+from pib.envfile import load_envfile
+from pib.kubernetes import envfile_to_k8s, RenderingOptions, RENDER_CACHE
+
+from .common import make_envfile, best_of
+
+
+def render_all(objects, options):
+    """Render from scratch, as the first deploy in a process does."""
+    RENDER_CACHE.clear()
+    return [o.render(options) for o in objects]
+
+
+def main():
+    options = RenderingOptions()
+    for services in [100, 200, 400, 800, 1600]:
+        objects = list(envfile_to_k8s(load_envfile(make_envfile(
+            services=services, shared_requires=20))))
+        elapsed = best_of(lambda: render_all(objects, options))
+        print("{} services ({} objects): {:.4f}s ({:.1f}us per service)".format(
+            services, len(objects), elapsed, elapsed / services * 1e6))
+
+
+if __name__ == "__main__":
+    main()
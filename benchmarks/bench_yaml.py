@@ -0,0 +1,29 @@
+"""Compare pure-Python YAML to the loader and dumper used by pib."""
+
+import yaml
+
+from pib import _yaml
+from pib.envfile import load_envfile
+from pib.kubernetes import envfile_to_k8s, RenderingOptions
+
+from .common import make_envfile, best_of, report
+
+
+def main():
+    instance = make_envfile()
+    envfile_text = yaml.safe_dump(instance)
+    options = RenderingOptions()
+    manifests = [
+        o.render(options) for o in envfile_to_k8s(load_envfile(instance))
+    ]
+    print("libyaml available: {}".format(yaml.__with_libyaml__))
+    report("load Envfile ({} bytes)".format(len(envfile_text)),
+           best_of(lambda: yaml.safe_load(envfile_text)),
+           best_of(lambda: _yaml.safe_load(envfile_text)))
+    report("dump {} manifests".format(len(manifests)),
+           best_of(lambda: [yaml.safe_dump(m) for m in manifests]),
+           best_of(lambda: [_yaml.safe_dump(m) for m in manifests]))
+
+
+if __name__ == "__main__":
+    main()
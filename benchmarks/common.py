@@ -0,0 +1,73 @@
+"""Utilities shared by the benchmarks."""
+
+from timeit import default_timer
+
+
+def make_envfile(services=400, private_requires=2, shared_requires=10,
+                 templates=5):
+    """
+    Create a decoded (POPO) Envfile.yaml with the given number of objects.
+
+    :param services int: Number of services.
+    :param private_requires int: Number of private requires per service.
+    :param shared_requires int: Number of shared requires.
+    :param templates int: Number of templates.
+    """
+    template_names = ["template{}".format(i) for i in range(templates)]
+    return {
+        "Envfile-version": 1,
+        "local": {
+            "templates": {
+                name: {
+                    "type": "docker",
+                    "image": "postgres:9.6",
+                    "config": {"port": 5432, "user": "pib", "db": name},
+                }
+                for name in template_names
+            },
+        },
+        "application": {
+            "requires": {
+                "shared{}".format(i): {
+                    "template": template_names[i % templates],
+                }
+                for i in range(shared_requires)
+            },
+            "services": {
+                "service{}".format(i): {
+                    "image": {
+                        "repository": "example/service{}".format(i),
+                        "tag": "1.0",
+                    },
+                    "port": 8080,
+                    "expose": {"path": "/service{}".format(i)},
+                    "requires": {
+                        "private{}".format(j): {
+                            "template": template_names[j % templates],
+                        }
+                        for j in range(private_requires)
+                    },
+                }
+                for i in range(services)
+            },
+        },
+    }
+
+
+def best_of(function, repeat=5):
+    """
+    :return float: the fastest of ``repeat`` calls of ``function``, in
+        seconds.
+    """
+    timings = []
+    for i in range(repeat):
+        start = default_timer()
+        function()
+        timings.append(default_timer() - start)
+    return min(timings)
+
+
+def report(name, baseline, optimized):
+    """Print a comparison of two timings."""
+    print("{}: {:.4f}s -> {:.4f}s ({:.1f}x)".format(
+        name, baseline, optimized, baseline / optimized))
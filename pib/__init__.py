@@ -1,5 +1,22 @@
 """Production in a box."""
 
-from ._version import get_versions
-__version__ = get_versions()['version']
-del get_versions
+
+def _get_versions():
+    try:
+        # Written when installing, so source checkouts don't run git on every
+        # import:
+        from ._static_version import get_versions, GIT_STATE
+    except ImportError:
+        pass
+    else:
+        from ._gitstate import is_current
+        if is_current(GIT_STATE):
+            return get_versions()
+    # In builds versioneer makes _version.py static; in a source checkout
+    # without an up to date install it will ask git:
+    from ._version import get_versions
+    return get_versions()
+
+
+__version__ = _get_versions()['version']
+del _get_versions
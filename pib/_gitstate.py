@@ -0,0 +1,67 @@
+"""Cheaply detect when a git checkout's commit or tags change.
+
+Used to tell whether pib/_static_version.py is stale without running git.
+"""
+
+from hashlib import sha256
+import os
+
+# The root of the source checkout, if pib is being run from one:
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def git_state(root=ROOT):
+    """
+    Fingerprint the current commit and the set of tags, which is what the
+    version is computed from, by reading files under ``.git``.
+
+    :return: a string, ``""`` if ``root`` isn't a git checkout, or ``None``
+        if it is one but the state can't be determined.
+    """
+    git_dir = os.path.join(root, ".git")
+    if not os.path.exists(git_dir):
+        return ""
+    hasher = sha256()
+    try:
+        head = _read(os.path.join(git_dir, "HEAD")).strip()
+        hasher.update(head)
+        if head.startswith(b"ref: "):
+            ref = head[len(b"ref: "):].decode("utf-8")
+            ref_path = os.path.join(git_dir, *ref.split("/"))
+            if os.path.exists(ref_path):
+                hasher.update(_read(ref_path))
+        # Packed refs include packed tags and possibly the HEAD branch:
+        packed_refs = os.path.join(git_dir, "packed-refs")
+        if os.path.exists(packed_refs):
+            hasher.update(_read(packed_refs))
+        tags_dir = os.path.join(git_dir, "refs", "tags")
+        for directory, _, files in sorted(os.walk(tags_dir)):
+            for name in sorted(files):
+                path = os.path.join(directory, name)
+                hasher.update(path.encode("utf-8"))
+                hasher.update(_read(path))
+    except (OSError, UnicodeDecodeError):
+        # E.g. .git is a file, as in worktrees and submodules:
+        return None
+    return hasher.hexdigest()
+
+
+def is_current(baked_state, root=ROOT):
+    """
+    :param baked_state: what ``git_state()`` returned when the static version
+        was written.
+
+    :return bool: whether a version computed when ``git_state()`` returned
+        ``baked_state`` is still correct. Outside a checkout it can't go
+        stale; if the state can't be determined, now or when it was baked,
+        it's assumed to be stale.
+    """
+    state = git_state(root)
+    if state == "":
+        return True
+    return state is not None and state == baked_state
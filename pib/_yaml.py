@@ -0,0 +1,32 @@
+"""YAML loading and dumping.
+
+Uses libyaml's C implementation when PyYAML was built with it, since it's an
+order of magnitude faster than the pure-Python implementation, and falls back
+to the latter otherwise.
+"""
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+
+def safe_load(stream):
+    """Like ``yaml.safe_load``, but using the fastest available loader."""
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def safe_dump(data, stream=None, **kwargs):
+    """Like ``yaml.safe_dump``, but using the fastest available dumper."""
+    return yaml.dump(data, stream, Dumper=SafeDumper, **kwargs)
+
+
+def safe_dump_all(documents, stream=None, **kwargs):
+    """Like ``yaml.safe_dump_all``, but using the fastest available dumper."""
+    return yaml.dump_all(documents, stream, Dumper=SafeDumper, **kwargs)
+
+
+__all__ = ["safe_load", "safe_dump", "safe_dump_all", "SafeLoader",
+           "SafeDumper"]
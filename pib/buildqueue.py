@@ -0,0 +1,130 @@
+"""Queue of Docker image builds for watch mode.
+
+Each service has at most one pending build, and the most recently changed
+service is built first. A change to a service whose build is in progress
+cancels that build, since its result would be out of date anyway.
+"""
+
+from queue import Queue, Empty
+from threading import Condition, Thread
+
+from .local import Cancellation, Cancelled
+
+
+class BuildResult(object):
+    """The outcome of a build.
+
+    :attr name: The service's name.
+    :attr tag: The Docker tag built, or ``None`` if the build failed.
+    :attr error: The exception raised by a failed build, otherwise ``None``.
+    """
+
+    def __init__(self, name, tag=None, error=None):
+        self.name = name
+        self.tag = tag
+        self.error = error
+
+
+class BuildQueue(object):
+    """Build services' Docker images in background threads."""
+
+    def __init__(self, build, jobs, on_result=None):
+        """
+        :param build: callable taking a service name and a ``Cancellation``
+            and returning the Docker tag built. Should raise ``Cancelled`` if
+            cancelled.
+        :param jobs: how many builds to run concurrently.
+        :param on_result: optional callable, called from a worker thread with
+            no arguments whenever a result becomes available from
+            ``results()``; lets callers block instead of polling.
+        """
+        self._build = build
+        self._on_result = on_result
+        self._condition = Condition()
+        self._pending = []  # service names, most recently submitted last
+        self._running = {}  # map service name to Cancellation
+        self._stopped = False
+        self._results = Queue()
+        self._threads = [Thread(target=self._work) for i in range(jobs)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, names):
+        """Queue builds of the given services, ahead of older ones.
+
+        Builds of these services that are in progress are cancelled.
+        """
+        with self._condition:
+            for name in sorted(names):
+                if name in self._pending:
+                    self._pending.remove(name)
+                self._pending.append(name)
+                if name in self._running:
+                    self._running[name].cancel()
+            self._condition.notify_all()
+
+    def results(self):
+        """:return list: ``BuildResult`` for builds finished since last call."""
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except Empty:
+                return results
+
+    def _next(self):
+        """
+        Wait for a service that can be built, and mark it as running.
+
+        :return: (name, Cancellation), or ``None`` if stopped.
+        """
+        with self._condition:
+            while not self._stopped:
+                # A cancelled build may still be exiting; don't start another
+                # build of the same service until it has:
+                for name in reversed(self._pending):
+                    if name not in self._running:
+                        self._pending.remove(name)
+                        cancellation = Cancellation()
+                        self._running[name] = cancellation
+                        return name, cancellation
+                self._condition.wait()
+        return None
+
+    def _work(self):
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            name, cancellation = job
+            try:
+                result = BuildResult(name, tag=self._build(name, cancellation))
+            except Cancelled:
+                result = None
+            except Exception as e:
+                result = BuildResult(name, error=e)
+            with self._condition:
+                del self._running[name]
+                # If cancelled the result is out of date, even if the build
+                # managed to finish:
+                published = result is not None and not cancellation.cancelled
+                if published:
+                    self._results.put(result)
+                self._condition.notify_all()
+            if published and self._on_result is not None:
+                self._on_result()
+
+    def close(self):
+        """Cancel all builds and stop the worker threads."""
+        with self._condition:
+            self._stopped = True
+            self._pending = []
+            for cancellation in self._running.values():
+                cancellation.cancel()
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+
+__all__ = ["BuildQueue", "BuildResult"]
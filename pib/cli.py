@@ -3,7 +3,7 @@
 from io import StringIO
 from functools import wraps
 from pathlib import Path
-from time import sleep
+from time import monotonic
 from traceback import print_exc
 from sys import stdout, exit, version as python_version
 from urllib.parse import quote_plus
@@ -11,11 +11,11 @@ import webbrowser
 import os
 
 import click
-from yaml import safe_load
 
-from .local import RunLocal, run_result
-from .schema import ValidationError
-from .envfile import load_envfile as _load_envfile
+# Only lightweight modules are imported here so that e.g. `pib --help` starts
+# quickly; Envfile parsing and Kubernetes rendering pull in yaml, jsonschema
+# and pyrsistent, so they're imported by the code paths that need them.
+from .local import RunLocal, run_result, PIB_DIR
 from . import __version__
 
 # Pacify Click:
@@ -23,8 +23,11 @@ if os.environ.get("LANG", None) is None:
     os.environ["LANG"] = os.environ["LC_ALL"] = "C.UTF-8"
 
 
-def create_run_local(logfile_path):
+def create_run_local(logfile_path, build_jobs=None, backend="kubectl"):
     """
+    :param build_jobs: how many Docker images to build concurrently.
+    :param backend: how to talk to Kubernetes, "kubectl" or "api".
+
     :return: RunLocal instance for the given logfile path.
     """
     if logfile_path == "-":
@@ -33,15 +36,15 @@ def create_run_local(logfile_path):
         # Wipe existing logfile, and use line buffering so data gets written
         # out immediately.
         logfile = open(logfile_path, "w", buffering=1)
-    return RunLocal(logfile, click.echo)
+    return RunLocal(logfile, click.echo, build_jobs, backend=backend)
 
 
-def start(logfile_path):
+def start(logfile_path, build_jobs=None, backend="kubectl"):
     """Download and start necessary tools.
 
     :return: RunLocal instance.
     """
-    run_local = create_run_local(logfile_path)
+    run_local = create_run_local(logfile_path, build_jobs, backend)
     run_local.ensure_requirements()
     run_local.start_minikube()
     run_local.set_minikube_docker_env()
@@ -50,9 +53,12 @@ def start(logfile_path):
 
 def load_envfile(config_path):
     """Load an Envfile.yaml into a envfile.System given a Path."""
+    from .schema import ValidationError
+    from .envfile import load_cached_envfile
+
     try:
-        with config_path.open() as f:
-            return _load_envfile(safe_load(f.read()))
+        with config_path.open("rb") as f:
+            return load_cached_envfile(f.read(), PIB_DIR / "cache")
     except ValidationError as e:
         click.echo("Error loading Envfile.yaml:")
         for error in e.errors:
@@ -61,30 +67,201 @@ def load_envfile(config_path):
 
 
 def redeploy(run_local, envfile, services_directory):
-    """Redeploy currently checked out version of the code."""
+    """Redeploy currently checked out version of the code.
+
+    :return: tuple of dict mapping service name to the Docker image tag
+        deployed, and list of names of the Deployments applied.
+    """
     tag_overrides = run_local.rebuild_docker_images(
         envfile, services_directory)
-    run_local.deploy(envfile, tag_overrides)
+    deployments = run_local.deploy(envfile, tag_overrides)
+    return tag_overrides, deployments
 
 
 def print_service_url(run_local, envfile):
     """Print the service URL."""
     services, application_url = run_local.get_application_urls(envfile)
     for name, url in services.items():
-        click.echo("{}: {}".format(name, url))
-    click.echo("Main application: {}".format(application_url))
+        run_local.echo("{}: {}".format(name, url))
+    run_local.echo("Main application: {}".format(application_url))
+
+
+def deploy(run_local, envfile, services_directory, wait=False):
+    """Redeploy and print the service URLs.
+
+    :param wait: whether to wait for the Deployments to be ready.
+
+    :return int: exit code.
+    """
+    from .local import RolloutFailed, KubernetesError
+
+    _, deployments = redeploy(run_local, envfile, services_directory)
+    if wait:
+        try:
+            run_local.wait_for_rollouts(deployments)
+        except (RolloutFailed, KubernetesError) as e:
+            run_local.echo(str(e))
+            return 1
+    print_service_url(run_local, envfile)
+    return 0
+
+
+def status(run_local, envfile, services_directory):
+    """Print the service URLs."""
+    print_service_url(run_local, envfile)
+
+
+# Commands that can be run by `pib daemon`:
+DAEMON_COMMANDS = {
+    "deploy": deploy,
+    "status": status,
+}
 
 
-def watch(run_local, envfile, services_directory):
+def run_in_daemon(command, envfile_path, services_directory, settings,
+                  **options):
+    """Run a command in `pib daemon`, if one is running.
+
+    :param settings dict: the "logfile", "build_jobs" and "backend" this
+        command was run with; the daemon warns if they differ from its own.
+    :param options: keyword arguments for the command.
+
+    :return: exit code, or ``None`` if no daemon is running.
+    """
+    from .daemon import request
+
+    settings = dict(settings)
+    if settings.get("logfile", "-") != "-":
+        settings["logfile"] = str(Path(settings["logfile"]).absolute())
+    return request({
+        "command": command,
+        "envfile": str(Path(envfile_path).absolute()),
+        "directory": str(Path(services_directory).absolute()),
+        "settings": settings,
+        "options": options,
+    }, click.echo)
+
+
+def watch(run_local, envfile, services_directory, tag_overrides,
+          debounce=1.0):
     """
     As code changes, rebuild Docker images for given repos in minikube Docker,
     then redeploy.
+
+    Only the services whose code changed are rebuilt and redeployed. Builds
+    happen in the background, most recently changed service first; a change
+    to a service that is being built cancels that build and starts over.
+
+    :param tag_overrides dict: map service name to the Docker image tag
+        currently deployed.
+    :param debounce: seconds without changes to wait for before building, so
+        bursts of changes are handled together.
+
+    :return: exit code, if watching for changes failed.
     """
-    while True:
-        # Kubernetes apply -f takes 20 seconds or so. If we were to redeploy
-        # more often than that we'd get an infinite queue.
-        sleep(20)
-        redeploy(run_local, envfile, services_directory)
+    from queue import Queue, Empty
+    from threading import Event, Thread
+
+    from .buildqueue import BuildQueue
+    from .watcher import create_watcher, PollingWatcher, WatchLimitReached
+
+    services = {
+        name: services_directory / name
+        for name in envfile.application.services
+        if (services_directory / name).exists()
+    }
+    if not services:
+        run_local.echo("No services found in {}, nothing to watch.".format(
+            services_directory.absolute()))
+        return
+
+    def build(name, cancellation):
+        service = envfile.application.services[name]
+        directory = services_directory / name
+        if not directory.exists():
+            # The checkout was removed, fall back to the Envfile.yaml tag:
+            return service.image.tag
+        return run_local.rebuild_service_image(
+            name, service.image, directory, cancellation)
+
+    # Sets of changed services from the watcher, or empty sets when builds
+    # finish, so the loop below can block until there's something to do. If
+    # the watcher fails the exception is put here too, so the loop doesn't
+    # wait forever:
+    events = Queue()
+    stopped = Event()
+
+    def watch_files(watcher):
+        try:
+            while not stopped.is_set():
+                try:
+                    more = watcher.changes(timeout=1.0)
+                except OSError as e:
+                    if isinstance(watcher, PollingWatcher):
+                        raise
+                    if isinstance(e, WatchLimitReached):
+                        problem = e.strerror
+                    else:
+                        problem = "Watching for changes failed ({})".format(e)
+                    run_local.echo("{}. Falling back to polling for changes."
+                                   .format(problem))
+                    watcher.close()
+                    watcher = PollingWatcher(services)
+                    # Changes may have been missed:
+                    more = set(services)
+                if more:
+                    events.put(more)
+        except Exception as e:
+            events.put(e)
+        finally:
+            watcher.close()
+
+    tag_overrides = dict(tag_overrides)
+    watcher_thread = Thread(
+        target=watch_files, args=(create_watcher(services, run_local.echo),))
+    watcher_thread.daemon = True
+    watcher_thread.start()
+    queue = BuildQueue(build, run_local.build_jobs,
+                       on_result=lambda: events.put(set()))
+    changed = set()
+    quiet_until = None
+    try:
+        while True:
+            # Sleep until something changes or a build finishes, or until
+            # changes have been quiet long enough to build:
+            timeout = None
+            if changed:
+                timeout = max(0, quiet_until - monotonic())
+            try:
+                more = events.get(timeout=timeout)
+            except Empty:
+                more = set()
+            if isinstance(more, OSError):
+                run_local.echo("Watching for changes failed ({}), "
+                               "stopping.".format(more))
+                return 1
+            if isinstance(more, Exception):
+                raise more
+            if more:
+                changed |= more
+                quiet_until = monotonic() + debounce
+            if changed and monotonic() >= quiet_until:
+                run_local.echo("Changes in {}, rebuilding...".format(
+                    ", ".join(sorted(changed))))
+                queue.submit(changed)
+                changed = set()
+            for result in queue.results():
+                if result.error is not None:
+                    run_local.echo("Rebuilding {} failed: {}".format(
+                        result.name, result.error))
+                    continue
+                tag_overrides[result.name] = result.tag
+                run_local.echo("Redeploying {}...".format(result.name))
+                run_local.deploy(envfile, tag_overrides, {result.name})
+    finally:
+        stopped.set()
+        queue.close()
+        watcher_thread.join()
 
 
 opt_logfile = click.option(
@@ -102,6 +279,26 @@ opt_directory = click.option(
         readable=True, file_okay=False, exists=True),
     default=".",
     help=("Directory where services can be found. Default: ."))
+opt_build_jobs = click.option(
+    "--build-jobs",
+    nargs=1,
+    type=click.IntRange(min=1),
+    default=None,
+    help=("Number of Docker images to build concurrently. "
+          "Default: number of CPUs."))
+opt_backend = click.option(
+    "--kubernetes-backend",
+    "backend",
+    type=click.Choice(["kubectl", "api"]),
+    default="kubectl",
+    help=("How to talk to Kubernetes: 'kubectl' runs kubectl, 'api' "
+          "talks to the API server directly. Default: kubectl"))
+opt_wait = click.option(
+    "--wait",
+    is_flag=True,
+    default=False,
+    help=("Wait for all Deployments to be ready, failing if their pods "
+          "can't start."))
 param_envfile = click.argument(
     "ENVFILE_PATH",
     type=click.Path(
@@ -176,14 +373,34 @@ def cli():
 @cli.command("deploy", help="Deploy current Pibstack.yaml.")
 @opt_logfile
 @opt_directory
+@opt_build_jobs
+@opt_backend
+@opt_wait
 @param_envfile
 @handle_unexpected_errors
-def cli_deploy(logfile, directory, envfile_path):
+def cli_deploy(logfile, directory, build_jobs, backend, wait, envfile_path):
+    code = run_in_daemon("deploy", envfile_path, directory, {
+        "logfile": logfile, "build_jobs": build_jobs, "backend": backend,
+    }, wait=wait)
+    if code is not None:
+        exit(code)
     envfile = load_envfile(Path(envfile_path))
     directory = Path(directory)
+    run_local = start(logfile, build_jobs, backend)
+    exit(deploy(run_local, envfile, directory, wait))
+
+
+@cli.command("status", help="Print URLs of deployed services.")
+@opt_logfile
+@param_envfile
+@handle_unexpected_errors
+def cli_status(logfile, envfile_path):
+    code = run_in_daemon("status", envfile_path, ".", {"logfile": logfile})
+    if code is not None:
+        exit(code)
+    envfile = load_envfile(Path(envfile_path))
     run_local = start(logfile)
-    redeploy(run_local, envfile, directory)
-    print_service_url(run_local, envfile)
+    status(run_local, envfile, Path("."))
 
 
 @cli.command(
@@ -191,15 +408,17 @@ def cli_deploy(logfile, directory, envfile_path):
     help="Continuously deploy application specified " + "by Envfile.yaml.")
 @opt_logfile
 @opt_directory
+@opt_build_jobs
+@opt_backend
 @param_envfile
 @handle_unexpected_errors
-def cli_watch(logfile, directory, envfile_path):
+def cli_watch(logfile, directory, build_jobs, backend, envfile_path):
     envfile = load_envfile(Path(envfile_path))
     directory = Path(directory)
-    run_local = start(logfile)
-    redeploy(run_local, envfile, directory)
+    run_local = start(logfile, build_jobs, backend)
+    tag_overrides, _ = redeploy(run_local, envfile, directory)
     print_service_url(run_local, envfile)
-    watch(run_local, envfile, directory)
+    exit(watch(run_local, envfile, directory, tag_overrides))
 
 
 @cli.command("wipe", help="Wipe all locally deployed services.")
@@ -208,12 +427,32 @@ def cli_watch(logfile, directory, envfile_path):
                            ' deployed to your local Kubernetes server '
                            '(minikube)?\nThis will also delete services not '
                            'started by pib.')
+@opt_backend
 @handle_unexpected_errors
-def cli_wipe(logfile):
-    run_local = start(logfile)
+def cli_wipe(logfile, backend):
+    run_local = start(logfile, backend=backend)
     run_local.wipe()
     click.echo("Wiped!")
 
 
+@cli.command(
+    "daemon",
+    help="Keep minikube configuration and Envfiles loaded in the "
+    "background, making deploy and status faster.")
+@opt_logfile
+@opt_build_jobs
+@opt_backend
+@handle_unexpected_errors
+def cli_daemon(logfile, build_jobs, backend):
+    from .daemon import Daemon, serve, SOCKET_PATH
+
+    run_local = start(logfile, build_jobs, backend)
+    click.echo("Listening on {}, press Ctrl-C to exit.".format(SOCKET_PATH))
+    try:
+        serve(Daemon(run_local, DAEMON_COMMANDS))
+    except KeyboardInterrupt:
+        pass
+
+
 def main():
     cli()  # pylint: disable=E1120,E1123
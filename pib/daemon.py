@@ -0,0 +1,201 @@
+"""Optional long-running process that keeps pib's state warm.
+
+`pib daemon` downloads tools once, starts minikube and configures its Docker
+environment again only when the minikube cache goes stale, and keeps loaded
+Envfiles in memory. Other pib commands
+then send it requests over a Unix socket instead of redoing that work.
+
+The protocol is line-based JSON: the client sends a single request, the
+daemon responds with any number of ``{"echo": text}`` lines followed by
+``{"exit": code}``.
+"""
+
+from hashlib import sha256
+import json
+import os
+from pathlib import Path
+import socket
+from socketserver import UnixStreamServer, StreamRequestHandler
+from traceback import format_exc
+
+from .local import PIB_DIR
+
+SOCKET_PATH = PIB_DIR / "daemon.sock"
+
+
+def _connect(socket_path):
+    """:return: a socket connected to the daemon, or ``None``."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(socket_path))
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def request(message, echo, socket_path=SOCKET_PATH):
+    """Send a request to a running daemon.
+
+    :param message dict: The request; "command" names the command to run.
+    :param echo: callable to write user output to. Presumed to add
+        linebreaks.
+    :param socket_path Path: The daemon's socket.
+
+    :return: the command's exit code, or ``None`` if no daemon is running.
+    """
+    sock = _connect(socket_path)
+    if sock is None:
+        return None
+    with sock, sock.makefile("rwb") as f:
+        f.write(json.dumps(message).encode("utf-8") + b"\n")
+        f.flush()
+        for line in f:
+            response = json.loads(line.decode("utf-8"))
+            if "echo" in response:
+                echo(response["echo"])
+            elif "exit" in response:
+                return response["exit"]
+    echo("The pib daemon exited unexpectedly.")
+    return 1
+
+
+class Daemon(object):
+    """State kept in memory across requests."""
+
+    def __init__(self, run_local, commands):
+        """
+        :param run_local: Started ``RunLocal`` instance.
+        :param commands: map command names to callables that take a
+            ``RunLocal``, an ``envfile.System``, the services directory and
+            any options as keyword arguments, and optionally return an exit
+            code.
+        """
+        self.run_local = run_local
+        self.commands = commands
+        self._envfiles = {}  # map path to (contents hash, System)
+
+    def load_envfile(self, path):
+        """Load an Envfile.yaml, reusing the result if it hasn't changed.
+
+        :raises ValidationError: if the Envfile.yaml is invalid in some way.
+        """
+        from .envfile import load_cached_envfile
+
+        with open(path, "rb") as f:
+            contents = f.read()
+        key = sha256(contents).hexdigest()
+        cached = self._envfiles.get(path)
+        if cached is None or cached[0] != key:
+            cached = (key, load_cached_envfile(contents, PIB_DIR / "cache"))
+            self._envfiles[path] = cached
+        return cached[1]
+
+    def _logfile_path(self):
+        """:return: the daemon's logfile path, or "-" for standard out."""
+        name = getattr(self.run_local.logfile, "name", "<stdout>")
+        if name.startswith("<"):
+            return "-"
+        return os.path.abspath(name)
+
+    def warn_about_settings(self, settings, echo):
+        """
+        Warn if the client asked for settings that differ from the daemon's,
+        since the daemon's are used regardless.
+
+        :param settings dict: the client's "logfile" (absolute path or "-"),
+            "build_jobs" (``None`` for the default) and "backend".
+        """
+        ours = {"logfile": self._logfile_path(),
+                "build_jobs": self.run_local.build_jobs,
+                "backend": self.run_local.backend}
+        for key, option in [("logfile", "--logfile"),
+                            ("build_jobs", "--build-jobs"),
+                            ("backend", "--kubernetes-backend")]:
+            value = settings.get(key)
+            if value is not None and value != ours[key]:
+                echo("Warning: ignoring {0}={1}, the pib daemon uses {0}={2}."
+                     " Restart `pib daemon` to change it.".format(
+                         option, value, ours[key]))
+
+    def handle(self, message, echo):
+        """Run a request.
+
+        :param message dict: The decoded request, with "command", "envfile",
+            "directory" and optionally "options" and "settings" keys; see
+            ``warn_about_settings()`` for the latter.
+        :param echo: callable to write user output to.
+
+        :return int: exit code.
+        """
+        from .schema import ValidationError
+
+        command = self.commands.get(message.get("command"))
+        if command is None:
+            echo("Unknown command: {}".format(message.get("command")))
+            return 1
+        self.warn_about_settings(message.get("settings", {}), echo)
+        original_echo = self.run_local.echo
+        self.run_local.echo = echo
+        try:
+            # The Docker environment set up at startup is stale if minikube
+            # has restarted since:
+            self.run_local.refresh_minikube()
+            envfile = self.load_envfile(message["envfile"])
+            return command(self.run_local, envfile,
+                           Path(message["directory"]),
+                           **message.get("options", {})) or 0
+        except ValidationError as e:
+            echo("Error loading Envfile.yaml:")
+            for error in e.errors:
+                echo("---\n" + error)
+            return 1
+        except Exception:
+            echo("The pib daemon failed to run the command:\n" + format_exc())
+            return 1
+        finally:
+            self.run_local.echo = original_echo
+
+
+class _RequestHandler(StreamRequestHandler):
+    """Handle a single client connection."""
+
+    def _send(self, response):
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+    def handle(self):
+        message = json.loads(self.rfile.readline().decode("utf-8"))
+        code = self.server.pib_daemon.handle(
+            message, lambda text: self._send({"echo": text}))
+        self._send({"exit": code})
+
+
+def create_server(daemon, socket_path=SOCKET_PATH):
+    """Create a server listening on the socket.
+
+    Requests are handled one at a time.
+
+    :raises RuntimeError: if another daemon is already listening.
+    """
+    existing = _connect(socket_path)
+    if existing is not None:
+        existing.close()
+        raise RuntimeError(
+            "A pib daemon is already listening on {}".format(socket_path))
+    if socket_path.exists():
+        # Left behind by a daemon that didn't exit cleanly:
+        socket_path.unlink()
+    server = UnixStreamServer(str(socket_path), _RequestHandler)
+    server.pib_daemon = daemon
+    return server
+
+
+def serve(daemon, socket_path=SOCKET_PATH):
+    """Serve requests until interrupted."""
+    server = create_server(daemon, socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        socket_path.unlink()
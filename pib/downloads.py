@@ -0,0 +1,126 @@
+"""Concurrent, resumable, checksum-verified downloads of the tools pib runs."""
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+
+import requests
+
+# Bytes read from the network at a time:
+CHUNK_SIZE = 64 * 1024
+
+
+class ChecksumMismatch(Exception):
+    """A downloaded file didn't match its expected checksum."""
+
+
+def _partial_path(path):
+    """:return: where an unfinished download of ``path`` is stored."""
+    return path.with_name(path.name + ".part")
+
+
+def _checksum_path(path, algorithm):
+    """:return: where the published checksum for ``path`` is stored."""
+    return path.with_name("{}.{}".format(path.name, algorithm))
+
+
+def published_checksum(session, path, checksum_url, algorithm):
+    """
+    Return the checksum published with the release, for files that have no
+    pinned checksum.
+
+    It's fetched the first time and then kept next to the download, so
+    resumed and repeated downloads are verified against the same value.
+    """
+    stored = _checksum_path(path, algorithm)
+    try:
+        with stored.open() as f:
+            return f.read().strip()
+    except OSError:
+        pass
+    response = session.get(checksum_url)
+    response.raise_for_status()
+    # Checksum files are either just the digest or "<digest>  <filename>":
+    checksum = response.text.split()[0].lower()
+    os.makedirs(str(path.parent), exist_ok=True)
+    tmp = stored.with_name(stored.name + ".tmp")
+    with tmp.open("w") as f:
+        f.write(checksum)
+    os.replace(str(tmp), str(stored))
+    return checksum
+
+
+def download(session, url, path, checksum, algorithm):
+    """
+    Download ``url`` to ``path`` and make it executable.
+
+    Data is written to a ``.part`` file first; if one is left over from an
+    interrupted download only the remainder is requested. ``path`` only
+    appears once the complete file has matched ``checksum``.
+
+    :raises ChecksumMismatch: if the downloaded file doesn't match. The
+        partial download is discarded so the next attempt starts over.
+    """
+    partial = _partial_path(path)
+    os.makedirs(str(path.parent), exist_ok=True)
+    digest = hashlib.new(algorithm)
+    offset = 0
+    if partial.exists():
+        with partial.open("rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+                offset += len(chunk)
+    headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+    response = session.get(url, headers=headers, stream=True)
+    if response.status_code == 416:
+        # Partial download is no use, e.g. it's already as long as the file:
+        response.close()
+        os.remove(str(partial))
+        return download(session, url, path, checksum, algorithm)
+    response.raise_for_status()
+    if response.status_code != 206:
+        # Server ignored the range, so we're getting the whole file:
+        digest = hashlib.new(algorithm)
+        offset = 0
+    with response, partial.open("ab" if offset else "wb") as f:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            digest.update(chunk)
+            f.write(chunk)
+    if digest.hexdigest() != checksum:
+        os.remove(str(partial))
+        raise ChecksumMismatch(
+            "{} has {} {}, expected {}".format(
+                url, algorithm, digest.hexdigest(), checksum))
+    partial.chmod(0o755)
+    os.replace(str(partial), str(path))
+
+
+def ensure_downloads(downloads, echo):
+    """
+    Download any missing files concurrently.
+
+    :param downloads: list of ``(path, url, checksum_url, algorithm,
+        sha256)``. ``sha256`` is the pinned hex digest, or ``None`` if there
+        isn't one, in which case the file is verified against the
+        ``algorithm`` checksum published at ``checksum_url``. Files already
+        at ``path`` were verified when downloaded and are left alone.
+    :param echo: callable to report progress.
+    """
+    missing = [d for d in downloads if not d[0].exists()]
+    if not missing:
+        return
+
+    def fetch(path, url, checksum_url, algorithm, sha256):
+        echo("Downloading {}...".format(path.name))
+        with requests.Session() as session:
+            if sha256 is not None:
+                download(session, url, path, sha256, "sha256")
+            else:
+                checksum = published_checksum(session, path, checksum_url,
+                                              algorithm)
+                download(session, url, path, checksum, algorithm)
+
+    with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+        futures = [executor.submit(fetch, *d) for d in missing]
+        for future in futures:
+            future.result()
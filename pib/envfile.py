@@ -1,9 +1,18 @@
 """Code for parsing the Envfile."""
 
-from pyrsistent import (PClass, field, pmap_field, freeze, ny as match_any,
-                        discard)
+from hashlib import sha256
+import json
+import os
+import pickle
 
+from pyrsistent import PClass, field, pmap_field
+
+from ._yaml import safe_load
 from .schema import validate, ENVFILE_SCHEMA, ValidationError
+from . import __version__
+
+# How many parsed Envfiles to keep in the on-disk cache:
+CACHE_SIZE = 20
 
 
 class DockerResource(PClass):
@@ -68,45 +77,58 @@ class System(PClass):
     application = field(mandatory=True, type=Application)
 
 
+def semantic_errors(instance):
+    """Find semantic errors in a decoded Envfile.yaml.
+
+    * Names must be unique: shared requirements and services can't have the
+      same name, nor can private and shared requirements.
+    * Each referenced template in a requirement must have a matching entry in
+      /local/templates/
+
+    All errors are found in a single pass.
+
+    :return list: error messages, empty if there were none.
+    """
+    templates = instance["local"]["templates"]
+    shared_requires = instance["application"]["requires"]
+    services = instance["application"]["services"]
+    errors = []
+
+    def check_template(path, requires):
+        if requires["template"] not in templates:
+            errors.append(
+                "{}/template: the template {} does not exist "
+                "in /local/templates".format(path, repr(requires["template"])))
+
+    for name, requires in shared_requires.items():
+        path = "/application/requires/{}".format(name)
+        if name in services:
+            errors.append(
+                "{}: the name {} conflicts with service"
+                " /application/services/{}".format(path, repr(name), name))
+        check_template(path, requires)
+    for service_name, service in services.items():
+        for name, requires in service["requires"].items():
+            path = "/application/services/{}/requires/{}".format(
+                service_name, name)
+            if name in shared_requires:
+                errors.append(
+                    "{}: the name {} conflicts with "
+                    "/application/requires/{}".format(path, repr(name), name))
+            check_template(path, requires)
+    return errors
+
+
 def semantic_validate(instance):
     """Additional validation for a decoded Envfile.yaml.
 
-    * Validate uniqueness of names: shared requirements and services can't have
-      the same name.
-    * Validate that each referenced template in a requirement has a matching
-      entry in /local/templates/
+    See ``semantic_errors`` for the checks done.
 
+    :raises ValidationError: with all errors found, if there were any.
     """
-    unknown_templates = {}
-    for name, requires in instance["application"]["requires"].items():
-        if name in instance["application"]["services"]:
-            raise ValidationError(errors=[
-                "/application/requires/{}: the name {} conflicts with service"
-                " /application/services/{}".format(name,
-                                                   repr(name),
-                                                   name),
-            ])
-        if requires["template"] not in instance["local"]["templates"]:
-            unknown_templates["/application/requires/{}/template".format(
-                name)] = requires["template"]
-    for service_name, service in instance["application"]["services"].items():
-        for name, requires in service["requires"].items():
-            if name in instance["application"]["requires"]:
-                raise ValidationError(errors=[
-                    "/application/services/{}/requires/{}: the name {}"
-                    " conflicts with /application/requires/{}".format(
-                        service_name, name, repr(name), name)
-                ])
-            if requires["template"] not in instance["local"]["templates"]:
-                unknown_templates[
-                    "/application/services/{}/requires/{}/template".
-                    format(service_name, name)] = requires["template"]
-    if unknown_templates:
-        raise ValidationError(errors=[
-            "{}: the template {} does not exist "
-            "in /local/templates".format(path, repr(name))
-            for (path, name) in unknown_templates.items()
-        ])
+    errors = semantic_errors(instance)
+    if errors:
+        raise ValidationError(errors=errors)
 
 
 def load_envfile(instance):
@@ -123,26 +145,102 @@ def load_envfile(instance):
     # to be an abstraction rather than exactly the same as config format, so
     # e.g. same object model might support two different versions of the config
     # format.
+    #
+    # We do however make some minor changes: unneeded fields like
+    # "Envfile-version" and the templates' "type" are dropped, and some
+    # objects want to know their own name. The objects are built in a single
+    # walk over the validated instance.
+    return _build_system(instance)
+
+
+def _build_requires(requires):
+    """:return dict: map names to ``RequiredResource``."""
+    return {
+        name: RequiredResource(name=name, template=value["template"])
+        for name, value in requires.items()
+    }
+
+
+def _build_system(instance):
+    """Create System object from a validated, decoded Envfile.yaml."""
+    templates = {
+        name: DockerResource(
+            name=name, image=value["image"], config=value["config"])
+        for name, value in instance["local"]["templates"].items()
+    }
+    services = {
+        name: Service(
+            name=name,
+            image=DockerImage(
+                repository=value["image"]["repository"],
+                tag=value["image"]["tag"]),
+            port=value.get("port"),
+            expose=Expose(path=value["expose"]["path"]),
+            requires=_build_requires(value["requires"]))
+        for name, value in instance["application"]["services"].items()
+    }
+    return System(
+        local=LocalDeployment(templates=templates),
+        remote=instance.get("remote", {}),
+        application=Application(
+            services=services,
+            requires=_build_requires(instance["application"]["requires"])))
+
+
+def _cache_key(contents):
+    """
+    :param contents bytes: The raw contents of an Envfile.yaml.
+    :return str: key identifying the parsed result of these contents with this
+        version of pib and the schema.
+    """
+    hasher = sha256()
+    hasher.update(__version__.encode("utf-8"))
+    hasher.update(
+        json.dumps(ENVFILE_SCHEMA, sort_keys=True).encode("utf-8"))
+    hasher.update(contents)
+    return hasher.hexdigest()
 
-    # We do however make some minor changes.
-    instance = freeze(instance)
 
-    # 1. Drop unneeded fields:
-    instance = instance.remove("Envfile-version")
-    instance = instance.transform(["local", "templates", match_any, "type"],
-                                  discard)
+def load_cached_envfile(contents, cache_directory):
+    """Create System object from the raw contents of an Envfile.yaml.
 
-    # 2. Some objects want to know their own name:
-    def add_name(mapping):
-        # Convert {a: {x: 1}} to {a: {name: a, x: 1}}:
-        for key, value in mapping.items():
-            mapping = mapping.set(key, value.set("name", key))
-        return mapping
+    Successfully parsed results are stored in the cache directory, keyed by
+    a hash of the contents, so unchanged Envfiles skip parsing and validation.
 
-    instance = instance.transform(["local", "templates"], add_name)
-    instance = instance.transform(["application", "requires"], add_name)
-    instance = instance.transform(["application", "services"], add_name)
-    instance = instance.transform(
-        ["application", "services", match_any, "requires"], add_name)
+    :param contents bytes: The raw contents of an Envfile.yaml.
+    :param cache_directory Path: Directory where parsed results are cached.
 
-    return System.create(instance)
+    :return System: parsed envfile.
+    :raises ValidationError: if the Envfile.yaml is invalid in some way.
+    """
+    path = cache_directory / "envfile-{}.pickle".format(_cache_key(contents))
+    try:
+        with path.open("rb") as f:
+            system = pickle.load(f)
+        if isinstance(system, System):
+            try:
+                # Mark as recently used, so eviction keeps it:
+                os.utime(str(path))
+            except OSError:
+                pass
+            return system
+    except Exception:
+        # Missing or corrupt cache entry, fall back to parsing:
+        pass
+
+    system = load_envfile(safe_load(contents))
+    try:
+        os.makedirs(str(cache_directory), exist_ok=True)
+        temporary = path.with_suffix(".tmp{}".format(os.getpid()))
+        with temporary.open("wb") as f:
+            pickle.dump(system, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(str(temporary), str(path))
+        # Drop the least recently used entries:
+        entries = sorted(cache_directory.glob("envfile-*.pickle"),
+                         key=lambda p: p.stat().st_mtime)
+        for entry in entries[:-CACHE_SIZE]:
+            entry.unlink()
+    except OSError:
+        # Caching is an optimization, failing to write is fine.
+        pass
+    return system
@@ -0,0 +1,175 @@
+"""Content-addressed Docker images.
+
+A service's Docker image is identified by a hash of its build context, so
+unchanged services don't need to be rebuilt or redeployed.
+"""
+
+from hashlib import sha256
+import json
+import os
+import re
+from threading import Lock
+
+
+def _pattern_to_regex(pattern):
+    """Convert a .dockerignore pattern to a compiled regex.
+
+    Follows Go's filepath.Match syntax as used by Docker, plus ``**`` which
+    matches any number of directories.
+    """
+    result = ""
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**", i):
+            result += ".*"
+            i += 2
+            # "**/" also matches zero directories:
+            if pattern.startswith("/", i):
+                result += "/?"
+                i += 1
+            continue
+        elif char == "*":
+            result += "[^/]*"
+        elif char == "?":
+            result += "[^/]"
+        elif char == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                result += re.escape(char)
+            else:
+                # Go and Python character classes have the same syntax:
+                result += pattern[i:end + 1]
+                i = end
+        elif char == "\\" and i + 1 < len(pattern):
+            i += 1
+            result += re.escape(pattern[i])
+        else:
+            result += re.escape(char)
+        i += 1
+    return re.compile(result + "$")
+
+
+def read_dockerignore(directory):
+    """
+    :param directory Path: Docker build context.
+    :return list: of (compiled regex, is exclusion) tuples, in order.
+    """
+    path = directory / ".dockerignore"
+    if not path.exists():
+        return []
+    patterns = []
+    with path.open() as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            exclusion = line.startswith("!")
+            if exclusion:
+                line = line[1:].strip()
+            line = os.path.normpath(line).lstrip("/")
+            if line == ".":
+                continue
+            patterns.append((_pattern_to_regex(line), exclusion))
+    return patterns
+
+
+def is_ignored(relative_path, patterns):
+    """
+    :param relative_path str: '/'-separated path relative to the context.
+    :param patterns: result of ``read_dockerignore``.
+    :return bool: whether Docker will leave the path out of the context.
+    """
+    # As with Docker, the last matching pattern wins, and a pattern matching
+    # a parent directory matches everything inside it:
+    parts = relative_path.split("/")
+    candidates = ["/".join(parts[:i + 1]) for i in range(len(parts))]
+    ignored = False
+    for regex, exclusion in patterns:
+        if any(regex.match(candidate) for candidate in candidates):
+            ignored = not exclusion
+    return ignored
+
+
+def context_hash(directory):
+    """Hash the parts of a Docker build context that Docker would send.
+
+    :param directory Path: Docker build context.
+    :return str: hex digest.
+    """
+    patterns = read_dockerignore(directory)
+    # If there are exclusions, an ignored directory may still contain files
+    # that are sent, so we can't skip walking it:
+    can_prune = not any(exclusion for (_, exclusion) in patterns)
+    hasher = sha256()
+    root = str(directory)
+    for dirpath, dirnames, filenames in os.walk(root):
+        relative_dir = os.path.relpath(dirpath, root)
+        relative_dir = "" if relative_dir == "." else relative_dir + "/"
+        relative_dir = relative_dir.replace(os.sep, "/")
+        dirnames.sort()
+        if can_prune:
+            dirnames[:] = [
+                d for d in dirnames
+                if not os.path.islink(os.path.join(dirpath, d)) and
+                not is_ignored(relative_dir + d, patterns)
+            ]
+        entries = sorted(filenames + [
+            d for d in dirnames if os.path.islink(os.path.join(dirpath, d))
+        ])
+        for name in entries:
+            relative_path = relative_dir + name
+            # Docker always sends these two files:
+            if relative_path not in ("Dockerfile", ".dockerignore") and (
+                    is_ignored(relative_path, patterns)):
+                continue
+            path = os.path.join(dirpath, name)
+            hasher.update(relative_path.encode("utf-8") + b"\0")
+            if os.path.islink(path):
+                hasher.update(b"link:" + os.readlink(path).encode("utf-8"))
+            else:
+                executable = os.access(path, os.X_OK)
+                hasher.update(b"x:" if executable else b"f:")
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(65536), b""):
+                        hasher.update(chunk)
+            hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+class ImageIndex(object):
+    """Persistent map of (repository, context hash) to Docker image tag."""
+
+    def __init__(self, path):
+        """
+        :param path Path: JSON file where the index is stored.
+        """
+        self.path = path
+        self._lock = Lock()
+        try:
+            with path.open() as f:
+                self._index = json.load(f)
+        except (OSError, ValueError):
+            self._index = {}
+
+    @staticmethod
+    def _key(repository, content_hash):
+        return "{}@{}".format(repository, content_hash)
+
+    def get(self, repository, content_hash):
+        """:return: the tag for the image, or ``None`` if unknown."""
+        with self._lock:
+            return self._index.get(self._key(repository, content_hash))
+
+    def set(self, repository, content_hash, tag):
+        """Record the tag for the image, and save the index."""
+        with self._lock:
+            self._index[self._key(repository, content_hash)] = tag
+            os.makedirs(str(self.path.parent), exist_ok=True)
+            temporary = self.path.with_suffix(".tmp{}".format(os.getpid()))
+            with temporary.open("w") as f:
+                json.dump(self._index, f, indent=1, sort_keys=True)
+            os.replace(str(temporary), str(self.path))
+
+
+__all__ = ["context_hash", "ImageIndex"]
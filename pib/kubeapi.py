@@ -0,0 +1,284 @@
+"""Talk to the Kubernetes API server directly over HTTP.
+
+This avoids spawning a kubectl process per operation: a single pooled
+keep-alive session is reused for all requests, and requests can be made
+concurrently.
+"""
+
+from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+import json
+import os
+from os.path import expanduser
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ._yaml import safe_load
+
+KUBECONFIG = Path(expanduser("~")) / ".kube" / "config"
+
+# Map Kubernetes kinds to the plural used in URLs:
+PLURALS = {
+    "ConfigMap": "configmaps",
+    "Deployment": "deployments",
+    "Ingress": "ingresses",
+    "Pod": "pods",
+    "Service": "services",
+}
+
+# Name used to identify pib's changes to the API server:
+FIELD_MANAGER = "pib"
+# Garbage-collect dependents when deleting; the default for
+# extensions/v1beta1 objects is to orphan them. orphanDependents is
+# deprecated in favour of propagationPolicy, but unlike it is understood by
+# the Kubernetes 1.5 that minikube runs:
+DELETE_OPTIONS = {"kind": "DeleteOptions", "apiVersion": "v1",
+                  "orphanDependents": False}
+
+
+class ApiError(Exception):
+    """The API server returned an error."""
+
+    def __init__(self, status, message):
+        self.status = status
+        self.message = message
+        Exception.__init__(self, status, message)
+
+    def __str__(self):
+        return "Kubernetes API error {}: {}".format(self.status, self.message)
+
+
+class KubeConfig(object):
+    """How to connect to an API server.
+
+    :attr server: URL of the API server.
+    :attr verify: CA bundle path, or ``True`` for the system CAs.
+    :attr cert: (certificate path, key path), or ``None``.
+    :attr token: bearer token, or ``None``.
+    """
+
+    def __init__(self, server, verify=True, cert=None, token=None):
+        self.server = server.rstrip("/")
+        self.verify = verify
+        self.cert = cert
+        self.token = token
+
+
+def _data_file(directory, data):
+    """Write base64-encoded data to a file, returning its path."""
+    decoded = b64decode(data)
+    path = directory / (sha256(decoded).hexdigest() + ".pem")
+    if not path.exists():
+        os.makedirs(str(directory), exist_ok=True)
+        with path.open("wb") as f:
+            f.write(decoded)
+        path.chmod(0o600)
+    return str(path)
+
+
+def load_kubeconfig(path=KUBECONFIG, context="minikube", data_directory=None):
+    """Load connection information for a context from a kubeconfig file.
+
+    :param path Path: The kubeconfig file.
+    :param context str: The name of the context to use.
+    :param data_directory Path: Where to write certificates that are
+        embedded in the kubeconfig, since requests needs files.
+
+    :return KubeConfig: how to connect.
+    :raises KeyError: if the context or its cluster or user don't exist.
+    """
+    with path.open() as f:
+        config = safe_load(f.read())
+    base = path.parent
+    if data_directory is None:
+        data_directory = base / "pib-data"
+
+    def by_name(section, name):
+        for entry in config.get(section) or []:
+            if entry["name"] == name:
+                return entry[section[:-1]]
+        raise KeyError("No {} named {!r} in {}".format(
+            section[:-1], name, path))
+
+    def file_path(section, key):
+        # Paths are relative to the kubeconfig file:
+        if key in section:
+            return str(base / expanduser(section[key]))
+        if key + "-data" in section:
+            return _data_file(data_directory, section[key + "-data"])
+        return None
+
+    context = by_name("contexts", context)
+    cluster = by_name("clusters", context["cluster"])
+    user = by_name("users", context["user"])
+    verify = file_path(cluster, "certificate-authority") or True
+    if cluster.get("insecure-skip-tls-verify"):
+        verify = False
+    certificate = file_path(user, "client-certificate")
+    key = file_path(user, "client-key")
+    return KubeConfig(
+        server=cluster["server"],
+        verify=verify,
+        cert=(certificate, key) if certificate and key else None,
+        token=user.get("token"))
+
+
+def object_path(obj):
+    """
+    :param obj dict: decoded (POPO) Kubernetes object.
+    :return str: URL path of the object's collection.
+    """
+    api_version = obj["apiVersion"]
+    prefix = "/api/" if "/" not in api_version else "/apis/"
+    namespace = obj.get("metadata", {}).get("namespace", "default")
+    return "{}{}/namespaces/{}/{}".format(prefix, api_version, namespace,
+                                          PLURALS[obj["kind"]])
+
+
+class ApiClient(object):
+    """Client for a Kubernetes API server."""
+
+    def __init__(self, config, jobs=8):
+        """
+        :param config KubeConfig: How to connect.
+        :param jobs: maximum number of concurrent requests.
+        """
+        self.config = config
+        self.jobs = jobs
+        self.session = requests.Session()
+        # Keep enough connections alive for all concurrent requests:
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=jobs)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.verify = config.verify
+        self.session.cert = config.cert
+        if config.token:
+            self.session.headers["Authorization"] = "Bearer " + config.token
+
+    def _request(self, method, path, allowed=(), **kwargs):
+        """
+        :param allowed: error statuses that shouldn't raise an exception.
+
+        :return: the ``requests.Response``.
+        :raises ApiError: if the request failed.
+        """
+        response = self.session.request(
+            method, self.config.server + path, **kwargs)
+        if response.status_code >= 400 and (
+                response.status_code not in allowed):
+            try:
+                message = response.json()["message"]
+            except (ValueError, KeyError, TypeError):
+                message = response.text
+            raise ApiError(response.status_code, message)
+        return response
+
+    def healthy(self):
+        """:return bool: whether the API server reports itself healthy."""
+        try:
+            response = self.session.get(self.config.server + "/healthz",
+                                        timeout=5)
+        except requests.RequestException:
+            return False
+        return response.status_code == 200 and response.text == "ok"
+
+    def _replace(self, obj, path):
+        """Replace an existing object with ``obj``.
+
+        The API server requires the live object's resourceVersion, and won't
+        let a Service's allocated clusterIP change, so those (and any
+        allocated node ports) are carried over from the live object.
+        """
+        live = self._request("GET", path).json()
+        obj = dict(obj, metadata=dict(
+            obj["metadata"],
+            resourceVersion=live["metadata"]["resourceVersion"]))
+        if obj["kind"] == "Service":
+            live_spec = live.get("spec", {})
+            node_ports = {port.get("port"): port["nodePort"]
+                          for port in live_spec.get("ports", [])
+                          if "nodePort" in port}
+            spec = dict(obj.get("spec", {}))
+            if "clusterIP" in live_spec:
+                spec.setdefault("clusterIP", live_spec["clusterIP"])
+            if "ports" in spec:
+                spec["ports"] = [
+                    dict(port, nodePort=node_ports[port["port"]])
+                    if ("nodePort" not in port and
+                        port.get("port") in node_ports) else port
+                    for port in spec["ports"]]
+            obj["spec"] = spec
+        self._request("PUT", path, data=json.dumps(obj),
+                      headers={"Content-Type": "application/json"})
+
+    def apply(self, obj):
+        """Create or update an object, using server-side apply.
+
+        API servers that are too old to support server-side apply, like the
+        Kubernetes 1.5 minikube runs, get the object created, or replaced if
+        it already exists.
+        """
+        path = "{}/{}".format(object_path(obj), obj["metadata"]["name"])
+        body = json.dumps(obj)
+        response = self._request(
+            "PATCH", path, allowed=(415,), data=body,
+            params={"fieldManager": FIELD_MANAGER, "force": "true"},
+            headers={"Content-Type": "application/apply-patch+yaml"})
+        if response.status_code != 415:
+            return
+        response = self._request(
+            "POST", object_path(obj), allowed=(409,), data=body,
+            headers={"Content-Type": "application/json"})
+        if response.status_code == 409:
+            self._replace(obj, path)
+
+    def delete(self, obj):
+        """Delete an object, if it exists, along with objects it owns.
+
+        E.g. a Deployment's ReplicaSets are deleted too, like `kubectl
+        delete` does, rather than left behind to recreate its Pods.
+        """
+        self._request(
+            "DELETE", "{}/{}".format(object_path(obj),
+                                     obj["metadata"]["name"]),
+            allowed=(404,), data=json.dumps(DELETE_OPTIONS),
+            headers={"Content-Type": "application/json"})
+
+    def list(self, api_version, kind, namespace="default"):
+        """:return list: decoded objects of the given kind."""
+        response = self._request("GET", object_path({
+            "apiVersion": api_version, "kind": kind,
+            "metadata": {"namespace": namespace}}))
+        return response.json()["items"]
+
+    def _concurrently(self, function, items):
+        """Call the function on each item concurrently, raising any error."""
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for _ in executor.map(function, items):
+                pass
+
+    def apply_all(self, objs):
+        """Apply objects concurrently.
+
+        Deployments refer to ConfigMaps, so all ConfigMaps are applied before
+        anything else.
+        """
+        objs = list(objs)
+        self._concurrently(
+            self.apply, [obj for obj in objs if obj["kind"] == "ConfigMap"])
+        self._concurrently(
+            self.apply, [obj for obj in objs if obj["kind"] != "ConfigMap"])
+
+    def delete_all(self, api_version, kind, namespace="default"):
+        """Delete all objects of the given kind, concurrently."""
+        self._concurrently(self.delete, [{
+            "apiVersion": api_version, "kind": kind,
+            "metadata": {"name": item["metadata"]["name"],
+                         "namespace": namespace},
+        } for item in self.list(api_version, kind, namespace)])
+
+
+__all__ = ["ApiClient", "ApiError", "KubeConfig", "load_kubeconfig"]
@@ -1,22 +1,159 @@
 """Kubernetes integration for Pib."""
 
+from collections import OrderedDict
+from functools import wraps
+from pickle import dumps, loads, HIGHEST_PROTOCOL
+from threading import Lock
+
 from pyrsistent import PClass, field, pset_field, pset, pmap_field, thaw
 
+# Maximum number of rendered objects kept in memory:
+RENDER_CACHE_SIZE = 4096
+
 
 class RenderingOptions(PClass):
     """Define how objects should be rendered."""
     tag_overrides = pmap_field(str,
                                str)  # map service name to Docker image tag
+    # Inject resources with one envFrom entry each, rather than one env entry
+    # per key. Requires Kubernetes 1.6 or later:
+    env_from = field(type=bool, initial=False)
     # TODO: eventually ClusterIP vs NodePort can go here
 
 
-def _render_configmap(name, data):
+def _copy_rendering(rendered):
+    """
+    Copy a rendered object, which is made of dicts, lists and immutable
+    values. A pickle round trip is done in C, so is much faster than
+    ``copy.deepcopy()`` or copying recursively in Python.
+    """
+    return loads(dumps(rendered, HIGHEST_PROTOCOL))
+
+
+def _options_key(obj, options):
+    """
+    :return: the parts of ``options`` that rendering ``obj`` depends on.
+        Only a Deployment depends on a tag override, and only its own, so
+        other objects' renderings survive a change to any tag.
+    """
+    if isinstance(obj, Deployment):
+        return (options.env_from, options.tag_overrides.get(obj.name))
+    return options.env_from
+
+
+class RenderCache(object):
+    """
+    Least-recently-used cache of rendered objects.
+
+    Kubernetes objects are immutable, so the rendering is keyed by the object,
+    the options it depends on and the rendering function. Cached renderings
+    are shared, and may be embedded in other cached renderings, so must not
+    be modified; the public ``render()`` methods hand out copies.
+
+    :attr hits: number of lookups that found a cached rendering.
+    :attr misses: number of lookups that had to render.
+    """
+
+    def __init__(self, size=RENDER_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def render(self, obj, options, render, options_key=None):
+        """
+        :param render: callable taking ``obj`` and ``options`` and returning
+            the rendered object, called on a cache miss.
+        :param options_key: the parts of ``options`` the rendering depends
+            on, if not all of them.
+
+        :return: the rendered object.
+        """
+        key = (obj, options if options_key is None else options_key, render)
+        with self._lock:
+            try:
+                result = self._cache[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._cache.move_to_end(key)
+                return result
+        # Rendering may recursively render other objects, so do it without
+        # holding the lock:
+        result = render(obj, options)
+        with self._lock:
+            self._cache[key] = result
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        return result
+
+    def reserve(self, objects):
+        """
+        Make sure the renderings of ``objects`` Kubernetes objects fit, so
+        rendering them all repeatedly doesn't evict each one before it's
+        reused.
+        """
+        # Objects have at most two cached renderings, e.g. a ConfigMap and
+        # its env entries:
+        self.size = max(self.size, 2 * objects)
+
+    def clear(self):
+        """Forget all cached renderings."""
+        with self._lock:
+            self._cache.clear()
+
+
+# Shared by all rendering in this process, so repeated deploys (e.g. by
+# `pib watch`) only render objects that changed:
+RENDER_CACHE = RenderCache()
+
+
+def _cached(render):
+    """
+    Decorate a ``render(self, options)``-style method to use RENDER_CACHE.
+
+    The decorated method returns the shared cached rendering, which must not
+    be modified; wrap it with ``_copied`` to make a public method.
+    """
+
+    @wraps(render)
+    def cached_render(self, options):
+        return RENDER_CACHE.render(self, options, render,
+                                   _options_key(self, options))
+
+    return cached_render
+
+
+def _copied(render):
+    """
+    :return: a ``render(self, options)``-style method returning a copy of
+        the shared rendering ``render`` returns, which the caller is free
+        to modify.
+    """
+
+    def copied_render(self, options):
+        return _copy_rendering(render(self, options))
+
+    return copied_render
+
+
+def _render_configmap(name, data, options):
     """
     Return JSON for a ConfigMap.
 
     :param name str: The name of the configmap.
     :param data dict: The data included in the ConfigMap.
+    :param options RenderingOptions: How to render.
     """
+    if options.env_from:
+        # envFrom uses the keys as-is, so they must be in the case of the
+        # environment variables:
+        data = {key.upper(): value for (key, value) in data.items()}
     return {
         "apiVersion": "v1",
         "kind": "ConfigMap",
@@ -27,6 +164,38 @@ def _render_configmap(name, data):
     }
 
 
+def _render_env(resource_name, configmap_name, data, options):
+    """
+    Return the container env (or, with ``options.env_from``, envFrom) entries
+    a Deployment uses to get the environment variables from a ConfigMap.
+
+    :param resource_name str: The original name of the required resource.
+    :param configmap_name str: The name of the ConfigMap.
+    :param data: The keys stored in the ConfigMap.
+    :param options RenderingOptions: How to render.
+    """
+    # Notice that the environment variables are based on the original name of
+    # the resource, not the namespaced Kubernetes variant; from the service's
+    # point of view the original name is what counts.
+    prefix = "{}_RESOURCE_".format(resource_name.upper().replace("-", "_"))
+    if options.env_from:
+        return [{
+            "prefix": prefix,
+            "configMapRef": {
+                "name": configmap_name,
+            }
+        }]
+    return [{
+        "name": prefix + key.upper(),
+        "valueFrom": {
+            "configMapKeyRef": {
+                "name": configmap_name,
+                "key": key
+            }
+        }
+    } for key in sorted(data)]
+
+
 class ExternalRequiresConfigMap(PClass):
     """
     Kubernetes ConfigMap pointing an external resource (e.g. AWS RDS) for a
@@ -42,8 +211,20 @@ class ExternalRequiresConfigMap(PClass):
         """:return PMap: the full set of values in the configmap."""
         return self.data
 
-    def render(self, options):
-        return _render_configmap(self.name, thaw(self.data))
+    @_cached
+    def _render(self, options):
+        return _render_configmap(self.name, thaw(self.data), options)
+
+    @_cached
+    def _env_entries(self, options):
+        """
+        :return list: env (or envFrom) entries for Deployments using this
+            ConfigMap.
+        """
+        return _render_env(self.resource_name, self.name, self.data, options)
+
+    render = _copied(_render)
+    render_env = _copied(_env_entries)
 
 
 class InternalRequiresConfigMap(PClass):
@@ -66,12 +247,28 @@ class InternalRequiresConfigMap(PClass):
             "port": str(self.backend_service.deployment.port),
         })
 
-    def render(self, options):
+    @_cached
+    def _render(self, options):
         return _render_configmap(
             self.backend_service.deployment.name,
-            thaw(self.get_full_data())
+            thaw(self.get_full_data()),
+            options
         )
 
+    @_cached
+    def _env_entries(self, options):
+        """
+        :return list: env (or envFrom) entries for Deployments using this
+            ConfigMap.
+        """
+        # ConfigMap k8s object has same name as the Deployment it points at:
+        return _render_env(self.resource_name,
+                           self.backend_service.deployment.name,
+                           self.get_full_data(), options)
+
+    render = _copied(_render)
+    render_env = _copied(_env_entries)
+
 
 class Deployment(PClass):
     """Kubernetes Deployment represenation."""
@@ -81,7 +278,8 @@ class Deployment(PClass):
     address_configmaps = pset_field((InternalRequiresConfigMap,
                                      ExternalRequiresConfigMap))
 
-    def render(self, options):
+    @_cached
+    def _render(self, options):
         docker_image = self.docker_image
         tag = options.tag_overrides.get(self.name)
         if tag is not None:
@@ -118,30 +316,21 @@ class Deployment(PClass):
             },
             'apiVersion': 'extensions/v1beta1'
         }
+        # Each ConfigMap's entries are rendered once and shared by the cached
+        # renderings of all the Deployments using it; they're only copied
+        # when a Deployment's rendering is handed out. ConfigMaps are sorted,
+        # since set iteration order depends on the hashes of everything they
+        # reference:
         env = []
-        for configmap in self.address_configmaps:
-            for key in sorted(configmap.get_full_data()):
-                # Notice that the environment variables are based on the
-                # original name of the resource, not the namespaced Kubernetes
-                # variant; from the service's point of view the original name
-                # is what counts.
-                name = configmap.resource_name
-                env.append({
-                    "name":
-                    "{}_RESOURCE_{}".format(name.upper().replace("-", "_"),
-                                            key.upper()),
-                    "valueFrom": {
-                        "configMapKeyRef": {
-                            # ConfigMap k8s object has same name as the
-                            # Deployment it points at:
-                            "name": configmap.backend_service.deployment.name,
-                            "key": key
-                        }
-                    }
-                })
-        result["spec"]["template"]["spec"]["containers"][0]["env"] = env
+        for configmap in sorted(self.address_configmaps,
+                                key=lambda c: c.resource_name):
+            env.extend(configmap._env_entries(options))
+        container = result["spec"]["template"]["spec"]["containers"][0]
+        container["envFrom" if options.env_from else "env"] = env
         return result
 
+    render = _copied(_render)
+
 
 class InternalService(PClass):
     """Kubernetes Service represenation.
@@ -150,12 +339,19 @@ class InternalService(PClass):
     """
     deployment = field(mandatory=True, type=Deployment)
 
-    def render(self, options):
-        rendered_deployment = self.deployment.render(options)
+    @_cached
+    def _render(self, options):
+        # Same name and labels as the Deployment:
+        name = self.deployment.name
         return {
             "apiVersion": "v1",
             "kind": "Service",
-            "metadata": rendered_deployment["metadata"],
+            "metadata": {
+                "labels": {
+                    "name": name
+                },
+                "name": name
+            },
             "spec": {
                 # TODO: only for local minikube, elsewhere want ClusterIP:
                 "type": "NodePort",
@@ -164,17 +360,22 @@ class InternalService(PClass):
                     "targetPort": self.deployment.port,
                     "protocol": "TCP"
                 }],
-                "selector": rendered_deployment["metadata"]["labels"],
+                "selector": {
+                    "name": name
+                },
             }
         }
 
+    render = _copied(_render)
+
 
 class Ingress(PClass):
     """Kubernetes Ingress representation."""
     exposed_path = field(mandatory=True, type=str)
     backend_service = field(mandatory=True, type=InternalService)
 
-    def render(self, options):
+    @_cached
+    def _render(self, options):
         name = self.backend_service.deployment.name
         return {
             "apiVersion": "extensions/v1beta1",
@@ -198,6 +399,108 @@ class Ingress(PClass):
             }
         }
 
+    render = _copied(_render)
+
+
+def _require_to_k8s(envfile, requirement, prefix):
+    """
+    :return: tuple of Deployment, InternalService and InternalRequiresConfigMap
+        for a required resource.
+    """
+    resource = envfile.local.templates[requirement.template]
+    deployment = Deployment(
+        name=prefix + requirement.name,
+        docker_image=resource.image,
+        port=resource.config["port"])
+    k8s_service = InternalService(deployment=deployment)
+    addrconfigmap = InternalRequiresConfigMap(
+        backend_service=k8s_service, resource_name=requirement.name,
+        data=resource.config.remove("port"))
+    return deployment, k8s_service, addrconfigmap
+
+
+def _sorted_values(pmap):
+    """:return: the values of a map, ordered by key."""
+    return [pmap[key] for key in sorted(pmap)]
+
+
+def _shared_requires_to_k8s(envfile):
+    """
+    :return: list of (Deployment, InternalService, InternalRequiresConfigMap)
+        for the shared resources, ordered by name.
+    """
+    # Shared resources are shared, so no prefix:
+    return [_require_to_k8s(envfile, shared_require, prefix="")
+            for shared_require in _sorted_values(envfile.application.requires)]
+
+
+def _private_requires_to_k8s(envfile, service):
+    """
+    :return: list of (Deployment, InternalService, InternalRequiresConfigMap)
+        for a service's private resources, ordered by name.
+    """
+    # Private resources should be namespaced based on the service they're
+    # part of, so they get prefix with service name:
+    resource_prefix = "{}---".format(service.name)
+    return [_require_to_k8s(envfile, private_require, prefix=resource_prefix)
+            for private_require in _sorted_values(service.requires)]
+
+
+def _service_objects(service, address_configmaps):
+    """:return: tuple of Deployment, InternalService and Ingress."""
+    deployment = Deployment(
+        name=service.name,
+        docker_image=service.image.image_name,
+        port=service.port,
+        address_configmaps=address_configmaps)
+    k8s_service = InternalService(deployment=deployment)
+    ingress = Ingress(
+        exposed_path=service.expose.path, backend_service=k8s_service)
+    return deployment, k8s_service, ingress
+
+
+def _service_to_k8s(envfile, service, shared_addressconfigmaps):
+    """:return: set of K8s objects for a service and its private resources."""
+    result = set()
+    private = _private_requires_to_k8s(envfile, service)
+    for new_objs in private:
+        result |= set(new_objs)
+    result |= set(_service_objects(
+        service, shared_addressconfigmaps | pset(objs[-1] for objs in private)))
+    return result
+
+
+def iter_envfile_to_k8s(envfile):
+    """Convert a loaded Envfile.yaml into Kubernetes objects, lazily.
+
+    Objects are yielded in a stable order, with dependencies first: all
+    ConfigMaps, then resource Deployments and Services, then each service's
+    Deployment, Service and Ingress. Within each group objects are ordered by
+    name, shared resources before private ones.
+
+    :param envfile System: Envfile to convert.
+    :return: iterator of K8s objects.
+    """
+    services = _sorted_values(envfile.application.services)
+    shared = _shared_requires_to_k8s(envfile)
+    private = [_private_requires_to_k8s(envfile, service)
+               for service in services]
+    resources = shared + [objs for objs_list in private for objs in objs_list]
+    # Each resource and service converts to at most three objects, which are
+    # all likely to be rendered:
+    RENDER_CACHE.reserve(3 * (len(resources) + len(services)))
+    for deployment, k8s_service, addrconfigmap in resources:
+        yield addrconfigmap
+    for deployment, k8s_service, addrconfigmap in resources:
+        yield deployment
+        yield k8s_service
+    shared_addressconfigmaps = pset(objs[-1] for objs in shared)
+    for service, private_objs in zip(services, private):
+        for obj in _service_objects(
+                service, shared_addressconfigmaps |
+                pset(objs[-1] for objs in private_objs)):
+            yield obj
+
 
 def envfile_to_k8s(envfile):
     """Convert a loaded Envfile.yaml into Kubernetes objects.
@@ -205,48 +508,95 @@ def envfile_to_k8s(envfile):
     :param envfile System: Envfile to convert.
     :return: `PSet` of K8s objects.
     """
-    result = set()
-    shared_addressconfigmaps = set()
-
-    def require_to_k8s(requirement, prefix):
-        resource = envfile.local.templates[requirement.template]
-        deployment = Deployment(
-            name=prefix + requirement.name,
-            docker_image=resource.image,
-            port=resource.config["port"])
-        k8s_service = InternalService(deployment=deployment)
-        addrconfigmap = InternalRequiresConfigMap(
-            backend_service=k8s_service, resource_name=requirement.name,
-            data=resource.config.remove("port"))
-        return deployment, k8s_service, addrconfigmap
+    return pset(iter_envfile_to_k8s(envfile))
 
-    # Shared resources are shared, so no prefix:
-    for shared_require in envfile.application.requires.values():
-        new_objs = require_to_k8s(shared_require, prefix="")
-        result |= set(new_objs)
-        shared_addressconfigmaps.add(new_objs[-1])
-
-    k8s_services = {}
-    for service in envfile.application.services.values():
-        # Private resources should be namespaced based on the service they're
-        # part of, so they get prefix with service name:
-        resource_prefix = "{}---".format(service.name)
-        private_addressconfigmaps = set()
-        for private_require in service.requires.values():
-            new_objs = require_to_k8s(private_require, prefix=resource_prefix)
-            result |= set(new_objs)
-            private_addressconfigmaps.add(new_objs[-1])
-
-        deployment = Deployment(
-            name=service.name,
-            docker_image=service.image.image_name,
-            port=service.port,
-            address_configmaps=shared_addressconfigmaps |
-            private_addressconfigmaps)
-        k8s_service = InternalService(deployment=deployment)
-        k8s_services[service.name] = k8s_service
-        ingress = Ingress(
-            exposed_path=service.expose.path, backend_service=k8s_service)
-        result |= {deployment, k8s_service, ingress}
-
-    return pset(result)
+
+K8S_TYPES = (Deployment, InternalService, Ingress, InternalRequiresConfigMap,
+             ExternalRequiresConfigMap)
+
+
+class K8sChanges(PClass):
+    """The K8s objects that differ between two versions of an Envfile."""
+    create = pset_field(K8S_TYPES)  # new objects
+    update = pset_field(K8S_TYPES)  # new versions of objects that changed
+    delete = pset_field(K8S_TYPES)  # old objects that no longer exist
+
+
+def _object_id(obj):
+    """:return: (kind, name) of the Kubernetes object ``obj`` renders to."""
+    if isinstance(obj, Deployment):
+        return "Deployment", obj.name
+    if isinstance(obj, InternalService):
+        return "Service", obj.deployment.name
+    if isinstance(obj, Ingress):
+        return "Ingress", obj.backend_service.deployment.name
+    if isinstance(obj, InternalRequiresConfigMap):
+        return "ConfigMap", obj.backend_service.deployment.name
+    return "ConfigMap", obj.name
+
+
+def _same(old, new):
+    """
+    Compare parts of two Envfiles. Unchanged parts are usually shared between
+    versions, so the identity check saves a deep comparison.
+    """
+    return old is new or old == new
+
+
+def _templates_same(old, new, requires):
+    """:return: whether the templates used by ``requires`` are unchanged."""
+    return all(
+        _same(old.local.templates.get(requirement.template),
+              new.local.templates.get(requirement.template))
+        for requirement in requires.values())
+
+
+def envfile_to_k8s_changes(old, new, options=RenderingOptions()):
+    """Find the Kubernetes objects affected by a change to an Envfile.
+
+    Only the services and shared resources that changed, or whose templates
+    changed, are converted; the resulting objects count as updated if they
+    render differently.
+
+    :param old System: Envfile currently deployed.
+    :param new System: Envfile to deploy.
+    :param options RenderingOptions: How objects will be rendered.
+    :return K8sChanges: objects to create, update and delete.
+    """
+    old_app, new_app = old.application, new.application
+    shared_same = (_same(old_app.requires, new_app.requires) and
+                   _templates_same(old, new, new_app.requires))
+    old_shared = _shared_requires_to_k8s(old)
+    if shared_same:
+        # Nothing to compare, but services still need the ConfigMaps:
+        old_objects, new_objects, new_shared = set(), set(), old_shared
+    else:
+        new_shared = _shared_requires_to_k8s(new)
+        old_objects = {obj for objs in old_shared for obj in objs}
+        new_objects = {obj for objs in new_shared for obj in objs}
+    old_shared = pset(objs[-1] for objs in old_shared)
+    new_shared = pset(objs[-1] for objs in new_shared)
+
+    for name in set(old_app.services) | set(new_app.services):
+        old_service = old_app.services.get(name)
+        new_service = new_app.services.get(name)
+        if (shared_same and old_service is not None and
+                new_service is not None and
+                _same(old_service, new_service) and
+                _templates_same(old, new, new_service.requires)):
+            continue
+        if old_service is not None:
+            old_objects |= _service_to_k8s(old, old_service, old_shared)
+        if new_service is not None:
+            new_objects |= _service_to_k8s(new, new_service, new_shared)
+
+    old_by_id = {_object_id(obj): obj for obj in old_objects}
+    new_by_id = {_object_id(obj): obj for obj in new_objects}
+    return K8sChanges(
+        create=[obj for (object_id, obj) in new_by_id.items()
+                if object_id not in old_by_id],
+        update=[obj for (object_id, obj) in new_by_id.items()
+                if object_id in old_by_id and
+                old_by_id[object_id]._render(options) != obj._render(options)],
+        delete=[obj for (object_id, obj) in old_by_id.items()
+                if object_id not in new_by_id])
@@ -1,19 +1,71 @@
 """Local interactions with Minikube and friends."""
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+import json
 import os
 from os.path import expanduser
 from pathlib import Path
-from subprocess import check_call, check_output, CalledProcessError
-from tempfile import NamedTemporaryFile
-from time import sleep, time
-from .kubernetes import envfile_to_k8s, RenderingOptions
-
-from yaml import safe_dump
+import signal
+from subprocess import (check_call, check_output, CalledProcessError, Popen,
+                        PIPE)
+from threading import Lock
+from time import sleep, monotonic, time
 
 
 PIB_DIR = Path(expanduser("~")) / ".pib"
-MINIKUBE = PIB_DIR / "minikube"
-KUBECTL = PIB_DIR / "kubectl"
+# Downloaded tools, one directory per version:
+TOOLS_DIR = PIB_DIR / "tools"
+MINIKUBE_VERSION = "v0.15.0"
+KUBECTL_VERSION = "v1.5.1"
+MINIKUBE = TOOLS_DIR / ("minikube-" + MINIKUBE_VERSION) / "minikube"
+KUBECTL = TOOLS_DIR / ("kubectl-" + KUBECTL_VERSION) / "kubectl"
+# Tools to download, as (path, URL, checksum URL, checksum algorithm, map
+# platform name to pinned sha256 hex digest). URLs are formatted with the
+# platform name. A pinned digest is checked instead of the checksum published
+# next to the binary, so a tampered release bucket is detected; platforms
+# without one fall back to the published checksum. Update both along with the
+# versions:
+TOOLS = [
+    (MINIKUBE,
+     "https://storage.googleapis.com/minikube/releases/" + MINIKUBE_VERSION +
+     "/minikube-{}-amd64",
+     "https://storage.googleapis.com/minikube/releases/" + MINIKUBE_VERSION +
+     "/minikube-{}-amd64.sha256",
+     "sha256",
+     {}),
+    (KUBECTL,
+     "https://storage.googleapis.com/kubernetes-release/release/" +
+     KUBECTL_VERSION + "/bin/{}/amd64/kubectl",
+     "https://storage.googleapis.com/kubernetes-release/release/" +
+     KUBECTL_VERSION + "/bin/{}/amd64/kubectl.sha1",
+     "sha1",
+     {}),
+]
+# Per-service Docker build logs go here:
+BUILD_LOGS = PIB_DIR / "logs"
+# Maps Docker build context hashes to the tags of images built from them:
+IMAGE_INDEX = PIB_DIR / "images.json"
+# Default maximum number of objects passed to a single `kubectl apply`:
+APPLY_CHUNK_SIZE = 500
+# Caches minikube's status and Docker environment across invocations:
+MINIKUBE_CACHE = PIB_DIR / "minikube.json"
+# How long the minikube cache is trusted, in seconds:
+MINIKUBE_CACHE_TTL = 120
+# Where minikube stores information about its VMs:
+MINIKUBE_MACHINES = Path(expanduser("~")) / ".minikube" / "machines"
+# How long to wait for minikube to be ready after starting it, in seconds:
+MINIKUBE_READY_TIMEOUT = 300
+# Label selector for the pods of minikube's ingress addon:
+INGRESS_SELECTOR = "app=nginx-ingress-lb"
+# How long to wait for Deployments to roll out, in seconds:
+ROLLOUT_TIMEOUT = 600
+# Pod container states that mean a rollout won't succeed:
+ROLLOUT_FAILURE_REASONS = {"ImagePullBackOff", "CrashLoopBackOff",
+                           "InvalidImageName"}
+# Kinds of objects deleted by `pib wipe`, in order:
+WIPE_KINDS = [("extensions/v1beta1", "Ingress"), ("v1", "Service"),
+              ("extensions/v1beta1", "Deployment"), ("v1", "Pod")]
 
 
 def run_result(command, **kwargs):
@@ -21,46 +73,267 @@ def run_result(command, **kwargs):
     return str(check_output(command, **kwargs).strip(), "utf-8")
 
 
+def wait_for(check, timeout, initial_delay=0.25, max_delay=5.0):
+    """Poll until a check passes, backing off exponentially between polls.
+
+    :param check: callable returning whether the condition holds.
+    :param timeout: seconds after which to give up.
+
+    :return float: seconds spent waiting.
+    :raises TimeoutError: if the check didn't pass in time.
+    """
+    start = monotonic()
+    deadline = start + timeout
+    delay = initial_delay
+    while not check():
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            raise TimeoutError()
+        sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+    return monotonic() - start
+
+
+class Cancelled(Exception):
+    """The operation was cancelled."""
+
+
+class Cancellation(object):
+    """
+    Allows cancelling an operation from another thread by killing its
+    subprocesses.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._processes = set()
+        self.cancelled = False
+
+    def _kill(self, process):
+        # Subprocesses are started in their own process group, so this kills
+        # any of their children too:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            # Already exited.
+            pass
+
+    def cancel(self):
+        """Cancel the operation, killing any running subprocesses."""
+        with self._lock:
+            self.cancelled = True
+            for process in self._processes:
+                self._kill(process)
+
+    def register(self, process):
+        """Register a running subprocess, killing it if already cancelled."""
+        with self._lock:
+            self._processes.add(process)
+            if self.cancelled:
+                self._kill(process)
+
+    def unregister(self, process):
+        """Unregister a subprocess that has exited."""
+        with self._lock:
+            self._processes.discard(process)
+
+
+def parse_docker_env(shell_script):
+    """Parse the output of `minikube docker-env --shell bash`.
+
+    :return dict: the environment variables it exports.
+    """
+    result = {}
+    for line in shell_script.splitlines():
+        line = line.strip()
+        if line.startswith("export "):
+            key, value = line[len("export "):].strip().split("=", 1)
+            result[key] = value.strip('"')
+    return result
+
+
+def _minikube_profile():
+    """:return str: the name of the minikube profile in use."""
+    return os.environ.get("MINIKUBE_PROFILE", "minikube")
+
+
+def _minikube_machine_ip(profile):
+    """
+    Find the VM's IP from minikube's machine configuration, which is much
+    cheaper than running `minikube ip`.
+
+    :return: the IP, or ``None`` if it can't be determined.
+    """
+    try:
+        with (MINIKUBE_MACHINES / profile / "config.json").open() as f:
+            return json.load(f)["Driver"]["IPAddress"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+class RolloutFailed(Exception):
+    """A Deployment failed to roll out."""
+
+
+class KubernetesError(Exception):
+    """Talking to Kubernetes failed."""
+
+
+def _rollout_complete(deployment):
+    """
+    :param deployment: decoded Deployment, or ``None`` if it doesn't exist.
+    :return bool: whether all its replicas are updated and available.
+    """
+    if deployment is None:
+        return False
+    status = deployment.get("status", {})
+    replicas = deployment["spec"].get("replicas", 1)
+    return (
+        status.get("observedGeneration", 0) >=
+        deployment["metadata"].get("generation", 0) and
+        status.get("updatedReplicas", 0) == replicas and
+        status.get("availableReplicas", 0) == replicas and
+        status.get("replicas", 0) == replicas)
+
+
+def _rollout_failure(deployment, pods):
+    """
+    :param deployment: decoded Deployment, or ``None`` if it doesn't exist.
+    :param pods: decoded Pods.
+    :return: reason the Deployment's current pods are failing, or ``None``.
+    """
+    if deployment is None:
+        return None
+    template = deployment["spec"]["template"]
+    labels = template["metadata"]["labels"]
+    images = sorted(c["image"] for c in template["spec"]["containers"])
+    for pod in pods:
+        # Only look at pods of the current version of the Deployment:
+        if not all(pod["metadata"].get("labels", {}).get(key) == value
+                   for key, value in labels.items()):
+            continue
+        if sorted(c["image"] for c in pod["spec"]["containers"]) != images:
+            continue
+        for status in pod.get("status", {}).get("containerStatuses", []):
+            waiting = status.get("state", {}).get("waiting", {})
+            if waiting.get("reason") in ROLLOUT_FAILURE_REASONS:
+                return "{}: {}".format(waiting["reason"],
+                                       waiting.get("message", ""))
+    return None
+
+
 class RunLocal(object):
     """Context for running local operations."""
 
-    def __init__(self, logfile, echo):
+    def __init__(self, logfile, echo, build_jobs=None,
+                 apply_chunk_size=APPLY_CHUNK_SIZE, backend="kubectl"):
         """
         :param logfile: file-like object to write logs to.
         :param echo: callable to write user output to. Presumed to add
             linebreaks.
+        :param build_jobs: how many Docker images to build concurrently,
+            defaults to the number of CPUs.
+        :param apply_chunk_size: maximum number of Kubernetes objects to pass
+            to a single `kubectl apply`.
+        :param backend: how to talk to Kubernetes: "kubectl" runs kubectl,
+            "api" talks to the API server directly.
         """
         self.logfile = logfile
         self.echo = echo
+        self.build_jobs = build_jobs or os.cpu_count() or 1
+        self.apply_chunk_size = apply_chunk_size
+        self.backend = backend
+        self._kubernetes_api = None
+        self._minikube_ip = None
+        self._image_index = None
+        self._image_index_lock = Lock()
+
+    def _check_call(self, *args, logfile=None, cancellation=None,
+                    input=None, **kwargs):
+        """Run a subprocess, make sure it exited with 0.
 
-    def _check_call(self, *args, **kwargs):
-        """Run a subprocess, make sure it exited with 0."""
-        self.logfile.write("Running: {}\n".format(args))
-        self.logfile.flush()
-        check_call(*args, stdout=self.logfile, stderr=self.logfile, **kwargs)
+        :param logfile: file-like object to write output to, by default the
+            main logfile.
+        :param cancellation: optional ``Cancellation`` that can kill the
+            subprocess.
+        :param input: optional bytes to write to the subprocess' stdin.
+
+        :raises Cancelled: if the subprocess was killed by the cancellation.
+        """
+        if logfile is None:
+            logfile = self.logfile
+        logfile.write("Running: {}\n".format(args))
+        logfile.flush()
+        if cancellation is None and input is None:
+            check_call(*args, stdout=logfile, stderr=logfile, **kwargs)
+            return
+        process = Popen(*args, stdin=None if input is None else PIPE,
+                        stdout=logfile, stderr=logfile,
+                        start_new_session=cancellation is not None, **kwargs)
+        if cancellation is not None:
+            cancellation.register(process)
+        try:
+            process.communicate(input)
+        finally:
+            if cancellation is not None:
+                cancellation.unregister(process)
+        if cancellation is not None and cancellation.cancelled:
+            raise Cancelled()
+        if process.returncode:
+            raise CalledProcessError(process.returncode, args[0])
 
     def ensure_requirements(self):
         """Make sure kubectl and minikube are available."""
+        from .downloads import ensure_downloads
         uname = run_result("uname").lower()
-        for path, url in zip([MINIKUBE, KUBECTL], [
-                "https://storage.googleapis.com/minikube/releases/"
-                "v0.15.0/minikube-{}-amd64",
-                "https://storage.googleapis.com/kubernetes-release/"
-                "release/v1.5.1/bin/{}/amd64/kubectl"
-        ]):
-            if path.exists() and not os.access(str(path), os.X_OK):
-                # Apparently failed halfway through previous download
-                os.remove(str(path))
-            if not path.exists():
-                self.echo("Downloading {}...".format(path.name))
-                check_call([
-                    "curl", "--create-dirs", "--silent", "--output", str(path),
-                    url.format(uname)
-                ])
-                path.chmod(0o755)
+        ensure_downloads([
+            (path, url.format(uname), checksum_url.format(uname), algorithm,
+             pinned.get(uname))
+            for (path, url, checksum_url, algorithm, pinned) in TOOLS],
+            self.echo)
+
+    def _minikube_cache(self):
+        """
+        :return: dict with the minikube "ip" and "docker_env" recorded while
+            minikube was known to be running, or ``None`` if there's no
+            cached information or it's stale.
+        """
+        try:
+            with MINIKUBE_CACHE.open() as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        profile = _minikube_profile()
+        if (time() - cached.get("time", 0) > MINIKUBE_CACHE_TTL or
+                cached.get("profile") != profile or
+                cached.get("machine_ip") != _minikube_machine_ip(profile)):
+            return None
+        return cached
+
+    def _save_minikube_cache(self, docker_env):
+        """Record that minikube is running, and its Docker environment."""
+        profile = _minikube_profile()
+        try:
+            os.makedirs(str(PIB_DIR), exist_ok=True)
+            temporary = MINIKUBE_CACHE.with_suffix(
+                ".tmp{}".format(os.getpid()))
+            with temporary.open("w") as f:
+                json.dump({
+                    "time": time(),
+                    "profile": profile,
+                    "machine_ip": _minikube_machine_ip(profile),
+                    "ip": self.minikube_ip,
+                    "docker_env": docker_env,
+                }, f)
+            os.replace(str(temporary), str(MINIKUBE_CACHE))
+        except OSError:
+            # Caching is an optimization, failing to write is fine.
+            pass
 
     def start_minikube(self):
-        """Start minikube."""
+        """Start minikube, unless it was recently seen running."""
+        if self._minikube_cache() is not None:
+            return
         running = True
         try:
             result = run_result([str(MINIKUBE), "status"])
@@ -71,69 +344,242 @@ class RunLocal(object):
             self.echo("Starting minikube...")
             self._check_call([str(MINIKUBE), "start"])
             self._check_call([str(MINIKUBE), "addons", "enable", "ingress"])
-            sleep(10)  # make sure it's really up
+            self._wait_for_minikube()
+
+    def _kubectl_json(self, args):
+        """
+        :return: decoded JSON output of kubectl, or ``None`` if it failed.
+        """
+        try:
+            return json.loads(run_result(
+                [str(KUBECTL), "--context=minikube"] + args +
+                ["--output=json"], stderr=self.logfile))
+        except (CalledProcessError, ValueError):
+            return None
+
+    def _api_server_ready(self):
+        """:return bool: whether the API server has a Ready node."""
+        api = self.kubernetes_api
+        if api is not None:
+            return api.healthy()
+        nodes = self._kubectl_json(["get", "nodes"])
+        if nodes is None:
+            return False
+        return any(
+            condition["type"] == "Ready" and condition["status"] == "True"
+            for node in nodes["items"]
+            for condition in node["status"].get("conditions", []))
+
+    def _ingress_ready(self):
+        """:return bool: whether an ingress controller pod is ready."""
+        pods = self._kubectl_json(["get", "pods", "--namespace=kube-system",
+                                   "--selector=" + INGRESS_SELECTOR])
+        if pods is None:
+            return False
+        return any(
+            pod["status"].get("containerStatuses") and
+            all(status["ready"] for status in pod["status"]["containerStatuses"])
+            for pod in pods["items"])
+
+    def _wait_for_minikube(self):
+        """Wait for the API server and the ingress controller to be ready."""
+        self.echo("Waiting for minikube to be ready...")
+        waited = 0
+        for name, check in [("API server", self._api_server_ready),
+                            ("Ingress controller", self._ingress_ready)]:
+            try:
+                waited += wait_for(check, MINIKUBE_READY_TIMEOUT - waited)
+            except TimeoutError:
+                raise RuntimeError(
+                    "{} wasn't ready after {} seconds.".format(
+                        name, MINIKUBE_READY_TIMEOUT))
+        self.echo("Minikube ready after {:.1f} seconds.".format(waited))
 
     def _kubectl(self, command, config, kubectl_args=[]):
-        """Run kubectl.
+        """Run kubectl, passing it the configs on stdin.
 
         :param command: The kubectl command.
-        :param params: Parameters with which to render the configs.
-        :param configs: YAML-encoded configuration.
+        :param config: YAML-encoded configuration; may contain multiple
+            documents.
         """
-        with NamedTemporaryFile("w", suffix=".yaml", delete=False) as f:
-            f.write(config)
-            f.flush()
-            self._check_call([str(KUBECTL), "--context=minikube", command,
-                              "-f", f.name] + kubectl_args)
+        self._check_call([str(KUBECTL), "--context=minikube", command,
+                          "-f", "-"] + kubectl_args,
+                         input=config.encode("utf-8"))
 
     def _kubectl_apply(self, config):
         """Run kubectl apply on the given configs."""
         self._kubectl("apply", config)
 
+    def _kubectl_apply_all(self, configs):
+        """Apply configs using as few kubectl processes as possible.
+
+        :param configs: iterable of decoded (POPO) Kubernetes objects. They're
+            sent ``apply_chunk_size`` at a time as multi-document YAML, so
+            the first chunk is applied before later ones are generated.
+        """
+        from ._yaml import safe_dump_all
+
+        configs = iter(configs)
+        while True:
+            chunk = list(islice(configs, self.apply_chunk_size))
+            if not chunk:
+                return
+            self._kubectl_apply(safe_dump_all(chunk))
+
     def _kubectl_delete(self, config):
         """Run kubectl delete on the given configs."""
         self._kubectl(
             "delete", config, kubectl_args=["--ignore-not-found=true"])
 
+    @property
+    def kubernetes_api(self):
+        """
+        :return: ``kubeapi.ApiClient`` for minikube, or ``None`` if the
+            kubectl backend is in use.
+        """
+        if self.backend != "api":
+            return None
+        if self._kubernetes_api is None:
+            from .kubeapi import ApiClient, load_kubeconfig
+            try:
+                config = load_kubeconfig(
+                    data_directory=PIB_DIR / "kubeconfig-data")
+            except (OSError, KeyError) as e:
+                self.echo("Can't use the Kubernetes API ({}), falling back "
+                          "to kubectl.".format(e))
+                self.backend = "kubectl"
+                return None
+            self._kubernetes_api = ApiClient(config)
+        return self._kubernetes_api
+
+    def _apply_all(self, configs):
+        """Create or update Kubernetes objects.
+
+        :param configs: iterable of decoded (POPO) Kubernetes objects, applied
+            in order as they're generated.
+        """
+        api = self.kubernetes_api
+        if api is None:
+            self._kubectl_apply_all(configs)
+        else:
+            self.logfile.write("Applying objects via the API\n")
+            api.apply_all(configs)
+
     def wipe(self):
         """Delete everything from k8s."""
-        for category in ["ingress", "service", "deployment", "pod"]:
-            self._check_call([str(KUBECTL), "--context=minikube",
-                              "delete", category, "--all"])
+        api = self.kubernetes_api
+        for api_version, kind in WIPE_KINDS:
+            if api is None:
+                self._check_call([str(KUBECTL), "--context=minikube",
+                                  "delete", kind.lower(), "--all"])
+            else:
+                api.delete_all(api_version, kind)
 
-    def _rebuild_docker_image(self, docker_image, directory):
+    @property
+    def image_index(self):
+        """The ``ImageIndex`` of previously built images."""
+        with self._image_index_lock:
+            if self._image_index is None:
+                from .images import ImageIndex
+                self._image_index = ImageIndex(IMAGE_INDEX)
+            return self._image_index
+
+    def _docker_image_exists(self, image_name, logfile=None):
+        """:return bool: whether the image exists in Docker."""
+        try:
+            self._check_call(["docker", "inspect", "--type=image", image_name],
+                             logfile=logfile)
+            return True
+        except CalledProcessError:
+            return False
+
+    def _rebuild_docker_image(self, docker_image, directory, logfile=None,
+                              cancellation=None):
         """Rebuild the Docker image for a particular service.
 
+        Images are identified by a hash of the build context, so if an image
+        was already built from identical code it is reused rather than
+        rebuilt, and the returned tag doesn't change.
+
         :param docker_image DockerImage: Docker image name to use.
         :param directory Path: Directory where the `Dockerfile` can be found.
+        :param logfile: file-like object to write build output to, by default
+            the main logfile.
+        :param cancellation: optional ``Cancellation`` for the build.
 
         :return str: the Docker tag to use.
+        :raises Cancelled: if the build was cancelled.
         """
+        from .images import context_hash
+
+        repository = docker_image.repository
+        content_hash = context_hash(directory)
+        tag = self.image_index.get(repository, content_hash)
+        if tag is not None and self._docker_image_exists(
+                "{}:{}".format(repository, tag), logfile):
+            self.echo("Code in {} is unchanged, reusing Docker image with "
+                      "tag '{}'.".format(directory, tag))
+            return tag
         tag = run_result(
             ["git", "describe", "--tags", "--dirty", "--always", "--long"],
-            cwd=str(directory)) + "-" + str(time())
+            cwd=str(directory)) + "-" + content_hash[:12]
         self._check_call([
             "docker", "build", str(directory), "-t",
-            "{}:{}".format(docker_image.repository, tag)
-        ])
+            "{}:{}".format(repository, tag)
+        ], logfile=logfile, cancellation=cancellation)
+        self.image_index.set(repository, content_hash, tag)
         return tag
 
-    def rebuild_docker_images(self, envfile, services_directory):
-        """Rebuild the Docker images for all local services.
+    def rebuild_service_image(self, name, docker_image, directory,
+                              cancellation=None):
+        """Rebuild a service's Docker image, logging to its own logfile.
+
+        :param name str: The service's name.
+        :param docker_image DockerImage: Docker image name to use.
+        :param directory Path: Directory where the `Dockerfile` can be found.
+        :param cancellation: optional ``Cancellation`` for the build.
+
+        :return str: the Docker tag to use.
+        :raises Cancelled: if the build was cancelled.
+        """
+        os.makedirs(str(BUILD_LOGS), exist_ok=True)
+        log_path = BUILD_LOGS / "{}.log".format(name)
+        with log_path.open("w", buffering=1) as logfile:
+            try:
+                return self._rebuild_docker_image(docker_image, directory,
+                                                  logfile, cancellation)
+            except Cancelled:
+                raise
+            except Exception:
+                self.echo("Rebuilding Docker image for {} failed, see {}"
+                          .format(name, log_path))
+                raise
+
+    def rebuild_docker_images(self, envfile, services_directory,
+                              services=None):
+        """Rebuild the Docker images for local services.
+
+        Up to ``build_jobs`` images are built concurrently, each logging to
+        its own file in ``BUILD_LOGS``. If a build fails, the other builds
+        are cancelled, killing any that are running, and the error is raised.
+
+        :param services: names of services to rebuild, by default all.
 
         :return dict: map service name to tag to use.
         """
         tag_overrides = {}
+        to_build = []
         for service in envfile.application.services.values():
             name = service.name
+            if services is not None and name not in services:
+                continue
             # If we have local checkout use local code:
             subdir = services_directory / name
             if subdir.exists():
                 self.echo("Service {} found in {}, rebuilding Docker"
                           " image with latest code...".format(
                               name, services_directory.absolute()))
-                tag_overrides[name] = self._rebuild_docker_image(service.image,
-                                                                 subdir)
+                to_build.append((name, service.image, subdir))
             else:
                 # Otherwise, use tag in Envfile.yaml:
                 # By default use the tag in the Envfile.yaml:
@@ -142,34 +588,206 @@ class RunLocal(object):
                               name, services_directory.absolute(),
                               service.image.tag))
                 tag_overrides[name] = service.image.tag
+        if not to_build:
+            return tag_overrides
+
+        # Shared by all builds, so the first failure kills the others:
+        cancellation = Cancellation()
+
+        def build(name, docker_image, directory):
+            if cancellation.cancelled:
+                # Another build failed, don't bother starting:
+                raise Cancelled()
+            try:
+                return self.rebuild_service_image(name, docker_image,
+                                                  directory, cancellation)
+            except Cancelled:
+                raise
+            except Exception:
+                cancellation.cancel()
+                raise
+
+        error = None
+        with ThreadPoolExecutor(max_workers=self.build_jobs) as executor:
+            futures = {
+                executor.submit(build, *args): args[0]
+                for args in to_build
+            }
+            for future in as_completed(futures):
+                try:
+                    tag_overrides[futures[future]] = future.result()
+                except Cancelled:
+                    # Killed because of a failure, which is reported instead:
+                    pass
+                except Exception as e:
+                    if error is None:
+                        error = e
+        if error is not None:
+            raise error
         return tag_overrides
 
-    def deploy(self, envfile, tag_overrides):
-        """Deploy current configuration to the minikube server."""
+    def deploy(self, envfile, tag_overrides, services=None):
+        """Deploy current configuration to the minikube server.
+
+        :param services: if given, only the Deployments for these service
+            names are applied; useful when only their images changed.
+
+        :return list: names of the Deployments applied.
+        """
+        # Imported here to keep CLI startup fast:
+        from .kubernetes import (iter_envfile_to_k8s, RenderingOptions,
+                                 Deployment)
+
         # TODO: missing ability to remove previous iteration of k8s objects!
         options = RenderingOptions(tag_overrides=tag_overrides)
-        for k8s_config in envfile_to_k8s(envfile):
-            self._kubectl_apply(safe_dump(k8s_config.render(options)))
+        deployments = []
+
+        def rendered():
+            # Objects come in dependency order and are rendered as they're
+            # applied:
+            for k8s_config in iter_envfile_to_k8s(envfile):
+                is_deployment = isinstance(k8s_config, Deployment)
+                if services is not None and not (
+                        is_deployment and k8s_config.name in services):
+                    continue
+                if is_deployment:
+                    deployments.append(k8s_config.name)
+                yield k8s_config.render(options)
+
+        self._apply_all(rendered())
+        return sorted(deployments)
+
+    def _list_objects(self, api_version, kind):
+        """
+        :return list: decoded objects of the given kind.
+        :raises KubernetesError: if listing failed.
+        """
+        api = self.kubernetes_api
+        if api is not None:
+            from requests import RequestException
+            from .kubeapi import ApiError
+            try:
+                return api.list(api_version, kind)
+            except (ApiError, RequestException) as e:
+                raise KubernetesError("Failed to list {}s: {}".format(
+                    kind, e))
+        result = self._kubectl_json(["get", kind.lower()])
+        if result is None:
+            raise KubernetesError("Failed to list {}s, see {}".format(
+                kind, getattr(self.logfile, "name", "the logfile")))
+        return result["items"]
+
+    def wait_for_rollouts(self, names, timeout=ROLLOUT_TIMEOUT,
+                          interval=1.0):
+        """Wait for Deployments to finish rolling out.
+
+        All Deployments are checked together on each poll, and each one is
+        reported as soon as it is ready.
+
+        :param names: names of the Deployments.
+
+        :raises RolloutFailed: as soon as any Deployment's pods are failing
+            in a way that won't fix itself, or on timeout.
+        """
+        start = monotonic()
+        pending = set(names)
+        while pending:
+            deployments = {
+                deployment["metadata"]["name"]: deployment
+                for deployment in self._list_objects(
+                    "extensions/v1beta1", "Deployment")
+            }
+            pods = self._list_objects("v1", "Pod")
+            for name in sorted(pending):
+                failure = _rollout_failure(deployments.get(name), pods)
+                if failure is not None:
+                    raise RolloutFailed("{} failed: {}".format(name, failure))
+                if _rollout_complete(deployments.get(name)):
+                    pending.remove(name)
+                    self.echo("{} ready after {:.1f} seconds.".format(
+                        name, monotonic() - start))
+            if pending:
+                if monotonic() - start > timeout:
+                    raise RolloutFailed(
+                        "Timed out waiting for {} to be ready.".format(
+                            ", ".join(sorted(pending))))
+                sleep(interval)
+
+    def _remember_minikube_ip(self, ip):
+        """
+        Remember the minikube VM's IP, along with what invalidates it.
+        """
+        profile = _minikube_profile()
+        self._minikube_ip = (ip, profile, _minikube_machine_ip(profile),
+                             time())
+
+    @property
+    def minikube_ip(self):
+        """The IP of the minikube VM.
+
+        Like the minikube cache, it's only remembered for MINIKUBE_CACHE_TTL
+        seconds and until the profile or VM changes, since `pib daemon` can
+        outlive a minikube restart.
+        """
+        if self._minikube_ip is not None:
+            ip, profile, machine_ip, when = self._minikube_ip
+            if (time() - when <= MINIKUBE_CACHE_TTL and
+                    profile == _minikube_profile() and
+                    machine_ip == _minikube_machine_ip(profile)):
+                return ip
+        cached = self._minikube_cache()
+        if cached is not None and cached.get("ip"):
+            ip = cached["ip"]
+        else:
+            ip = run_result([str(MINIKUBE), "ip"])
+        self._remember_minikube_ip(ip)
+        return ip
 
     def get_application_urls(self, envfile):
         """
+        URLs are computed from the NodePorts of the deployed Services, as
+        `minikube service --url` would, but with a single query.
+
         :return: Tuple of service URLs as {name: url} and the main URL.
         """
-        return {
-            service_name:
-            run_result([str(MINIKUBE), "service", "--url", service_name])
-            for service_name in envfile.application.services
-        }, "http://{}/".format(run_result([str(MINIKUBE), "ip"]))
+        ip = self.minikube_ip
+        node_ports = {}
+        for k8s_service in self._list_objects("v1", "Service"):
+            ports = k8s_service["spec"].get("ports") or [{}]
+            if "nodePort" in ports[0]:
+                node_ports[k8s_service["metadata"]["name"]] = "\n".join(
+                    "http://{}:{}".format(ip, port["nodePort"])
+                    for port in ports)
+        urls = {}
+        for service_name in envfile.application.services:
+            urls[service_name] = node_ports.get(service_name)
+            if urls[service_name] is None:
+                # Not deployed yet? Let minikube deal with it:
+                urls[service_name] = run_result(
+                    [str(MINIKUBE), "service", "--url", service_name])
+        return urls, "http://{}/".format(ip)
 
     def set_minikube_docker_env(self):
         """Use minikube's Docker."""
-        shell_script = run_result(
-            [str(MINIKUBE), "docker-env", "--shell", "bash"])
-        for line in shell_script.splitlines():
-            line = line.strip()
-            if line.startswith("#"):
-                continue
-            if line.startswith("export "):
-                key, value = line[len("export "):].strip().split("=", 1)
-                value = value.strip('"')
-                os.environ[key] = value
+        cached = self._minikube_cache()
+        if cached is not None:
+            docker_env = cached["docker_env"]
+            self._remember_minikube_ip(cached["ip"])
+        else:
+            docker_env = parse_docker_env(run_result(
+                [str(MINIKUBE), "docker-env", "--shell", "bash"]))
+            self._save_minikube_cache(docker_env)
+        os.environ.update(docker_env)
+
+    def refresh_minikube(self):
+        """
+        Start minikube and update its Docker environment again, unless the
+        minikube cache shows they're still current.
+
+        For processes that outlive a minikube restart, e.g. `pib daemon`,
+        which would otherwise keep talking to a stale ``DOCKER_HOST``.
+        """
+        if self._minikube_cache() is not None:
+            return
+        self.start_minikube()
+        self.set_minikube_docker_env()
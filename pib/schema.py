@@ -6,11 +6,15 @@ We use JSON Schema since it has decent tooling.
 from pathlib import Path
 
 from jsonschema import Draft4Validator
-from yaml import safe_load
+from ._yaml import safe_load
 
 with (Path(__file__).parent / "schema.yaml").open() as f:
     ENVFILE_SCHEMA = safe_load(f.read())
 
+# Building a validator is not free, so the one for the Envfile schema is
+# created once and reused:
+_ENVFILE_VALIDATOR = Draft4Validator(ENVFILE_SCHEMA)
+
 
 class ValidationError(Exception):
     """
@@ -34,25 +38,29 @@ def validate(schema, instance):
 
     :raises ValidationError: if validation failed.
     """
-    validator = Draft4Validator(schema)
-    if not validator.is_valid(instance):
-        errors = []
-        for e in validator.iter_errors(instance):
-            message = e.message
-            # Better error messages, workaround for
-            # https://github.com/Julian/jsonschema/issues/316:
-            if (e.validator == "additionalProperties" and
-                    not e.validator_value and "patternProperties" in e.schema):
-                for key in e.instance.keys():
-                    if repr(key) in e.message:
-                        message = (
-                            "{} does not match any of these "
-                            "regexs: {}.".format(
-                                repr(key),
-                                ", ".join(e.schema["patternProperties"].keys())))
-                        break
-            errors.append(
-                "/{}: {}".format("/".join(map(str, e.path)), message))
+    if schema is ENVFILE_SCHEMA:
+        validator = _ENVFILE_VALIDATOR
+    else:
+        validator = Draft4Validator(schema)
+    # Errors are collected in a single pass over the instance:
+    errors = []
+    for e in validator.iter_errors(instance):
+        message = e.message
+        # Better error messages, workaround for
+        # https://github.com/Julian/jsonschema/issues/316:
+        if (e.validator == "additionalProperties" and
+                not e.validator_value and "patternProperties" in e.schema):
+            for key in e.instance.keys():
+                if repr(key) in e.message:
+                    message = (
+                        "{} does not match any of these "
+                        "regexs: {}.".format(
+                            repr(key),
+                            ", ".join(e.schema["patternProperties"].keys())))
+                    break
+        errors.append(
+            "/{}: {}".format("/".join(map(str, e.path)), message))
+    if errors:
         raise ValidationError(errors)
 
 
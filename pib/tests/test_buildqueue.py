@@ -0,0 +1,130 @@
+"""Tests for pib.buildqueue."""
+
+from threading import Event, Lock
+from time import sleep, monotonic
+
+from ..buildqueue import BuildQueue
+from ..local import Cancelled
+
+
+class FakeBuilds(object):
+    """
+    Builds that block until released. Tags are the service name plus how many
+    times it has been built.
+    """
+
+    def __init__(self):
+        self.started = []
+        self.release = Event()
+        self._lock = Lock()
+
+    def build(self, name, cancellation):
+        with self._lock:
+            self.started.append(name)
+            tag = "{}-{}".format(name, self.started.count(name))
+        while not self.release.wait(0.01):
+            if cancellation.cancelled:
+                raise Cancelled()
+        if name == "broken":
+            raise RuntimeError("oops")
+        return tag
+
+
+def wait_for_results(queue, count, timeout=5):
+    """:return: ``count`` results, ordered by service name."""
+    results = []
+    deadline = monotonic() + timeout
+    while len(results) < count and monotonic() < deadline:
+        results.extend(queue.results())
+        sleep(0.01)
+    return sorted([(r.name, r.tag, r.error and str(r.error)) for r in results])
+
+
+def wait_until(predicate, timeout=5):
+    deadline = monotonic() + timeout
+    while not predicate():
+        assert monotonic() < deadline
+        sleep(0.01)
+
+
+def test_builds():
+    """Submitted builds run and their results are returned."""
+    builds = FakeBuilds()
+    builds.release.set()
+    queue = BuildQueue(builds.build, 2)
+    try:
+        queue.submit({"a", "b", "broken"})
+        assert wait_for_results(queue, 3) == [
+            ("a", "a-1", None), ("b", "b-1", None),
+            ("broken", None, "oops")]
+    finally:
+        queue.close()
+
+
+def test_most_recent_first():
+    """The most recently submitted service is built first."""
+    builds = FakeBuilds()
+    queue = BuildQueue(builds.build, 1)
+    try:
+        queue.submit({"a"})
+        wait_until(lambda: builds.started == ["a"])
+        queue.submit({"b"})
+        queue.submit({"c"})
+        queue.submit({"b"})
+        builds.release.set()
+        wait_for_results(queue, 3)
+        assert builds.started == ["a", "b", "c"]
+    finally:
+        queue.close()
+
+
+def test_pending_collapsed():
+    """Repeatedly submitting a pending service only builds it once."""
+    builds = FakeBuilds()
+    queue = BuildQueue(builds.build, 1)
+    try:
+        queue.submit({"a"})
+        wait_until(lambda: builds.started == ["a"])
+        for i in range(3):
+            queue.submit({"b"})
+        builds.release.set()
+        assert wait_for_results(queue, 2) == [
+            ("a", "a-1", None), ("b", "b-1", None)]
+        assert builds.started == ["a", "b"]
+    finally:
+        queue.close()
+
+
+def test_resubmit_cancels_running():
+    """
+    Submitting a service that is being built cancels that build and builds
+    it again; only the latest result is returned.
+    """
+    builds = FakeBuilds()
+    queue = BuildQueue(builds.build, 2)
+    try:
+        queue.submit({"a"})
+        wait_until(lambda: builds.started == ["a"])
+        queue.submit({"a"})
+        wait_until(lambda: builds.started == ["a", "a"])
+        builds.release.set()
+        assert wait_for_results(queue, 1) == [("a", "a-2", None)]
+        sleep(0.1)
+        assert queue.results() == []
+    finally:
+        queue.close()
+
+
+def test_on_result():
+    """``on_result`` is called once each result is available."""
+    builds = FakeBuilds()
+    builds.release.set()
+    available = []
+    queue = BuildQueue(builds.build, 1,
+                       on_result=lambda: available.extend(queue.results()))
+    try:
+        queue.submit({"a"})
+        wait_until(lambda: available)
+        assert [(r.name, r.tag) for r in available] == [("a", "a-1")]
+    finally:
+        queue.close()
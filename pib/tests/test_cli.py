@@ -0,0 +1,218 @@
+"""Tests for pib.cli."""
+
+import subprocess
+import sys
+from time import sleep
+
+import pytest
+
+# Modules that are slow to import and not needed for e.g. `pib --help`:
+HEAVY_MODULES = ["yaml", "jsonschema", "pyrsistent", "boto3", "botocore",
+                 "requests"]
+
+# Maximum time importing pib.cli may take, in microseconds:
+IMPORT_BUDGET = 300000
+
+
+def test_no_heavy_imports():
+    """Importing pib.cli doesn't import heavy dependencies."""
+    output = subprocess.check_output([
+        sys.executable, "-c",
+        "import sys, pib.cli; print(' '.join(m for m in {!r} "
+        "if m in sys.modules))".format(HEAVY_MODULES)
+    ])
+    assert output.decode("utf-8").split() == []
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason="-X importtime requires Python 3.7")
+def test_import_time_budget():
+    """Importing pib.cli stays within the startup time budget."""
+    output = subprocess.check_output(
+        [sys.executable, "-X", "importtime", "-c", "import pib.cli"],
+        stderr=subprocess.STDOUT).decode("utf-8")
+    # Lines look like "import time:   self [us] | cumulative | pib.cli":
+    for line in output.splitlines():
+        parts = [part.strip() for part in line.split("|")]
+        if parts[-1] == "pib.cli":
+            assert int(parts[1]) < IMPORT_BUDGET
+            return
+    raise AssertionError("pib.cli not found in:\n" + output)
+
+
+class StopWatching(Exception):
+    """Raised to end ``watch()``."""
+
+
+class FakeWatcher(object):
+    """Reports a change to service "a" once, recording how it's polled."""
+
+    def __init__(self):
+        self.timeouts = []
+
+    def changes(self, timeout=None):
+        self.timeouts.append(timeout)
+        if len(self.timeouts) == 1:
+            return {"a"}
+        sleep(timeout)
+        return set()
+
+    def close(self):
+        pass
+
+
+class FakeRunLocal(object):
+    """Stand-in for ``RunLocal`` whose builds take a while."""
+    build_jobs = 1
+
+    def __init__(self):
+        self.output = []
+        self.deployed = []
+
+    def echo(self, text):
+        self.output.append(text)
+
+    def rebuild_service_image(self, name, docker_image, directory,
+                              cancellation=None):
+        sleep(1.5)
+        return "newtag"
+
+    def deploy(self, envfile, tag_overrides, services=None):
+        self.deployed.append((dict(tag_overrides), services))
+        raise StopWatching()
+
+
+def test_watch(tmpdir, monkeypatch):
+    """
+    ``watch()`` rebuilds and redeploys changed services, without polling the
+    watcher more often than once a second while builds run.
+    """
+    from pathlib import Path
+    from .. import cli, watcher
+    from .test_local import make_system
+
+    (Path(str(tmpdir)) / "a").mkdir()
+    fake_watcher = FakeWatcher()
+    monkeypatch.setattr(watcher, "create_watcher",
+                        lambda services, echo=None: fake_watcher)
+    run_local = FakeRunLocal()
+    with pytest.raises(StopWatching):
+        cli.watch(run_local, make_system("a", "b"), Path(str(tmpdir)),
+                  {"b": "1.0"}, debounce=0.1)
+    assert run_local.deployed == [({"a": "newtag", "b": "1.0"}, {"a"})]
+    assert run_local.output[0] == "Changes in a, rebuilding..."
+    assert set(fake_watcher.timeouts) == {1.0}
+    assert len(fake_watcher.timeouts) <= 4
+
+
+class FailingWatcher(object):
+    """Fails with the given exception when asked for changes."""
+
+    def __init__(self, error):
+        self.error = error
+        self.closed = False
+
+    def changes(self, timeout=None):
+        raise self.error
+
+    def close(self):
+        self.closed = True
+
+
+def test_watch_falls_back_to_polling(tmpdir, monkeypatch):
+    """
+    If the watcher fails, ``watch()`` says so and falls back to polling,
+    rebuilding everything in case changes were missed.
+    """
+    from errno import EIO
+    from pathlib import Path
+    from .. import cli, watcher
+    from .test_local import make_system
+
+    (Path(str(tmpdir)) / "a").mkdir()
+    failing = FailingWatcher(OSError(EIO, "Input/output error"))
+    monkeypatch.setattr(watcher, "create_watcher",
+                        lambda services, echo=None: failing)
+
+    class FakePollingWatcher(watcher.PollingWatcher, FakeWatcher):
+        def __init__(self, services):
+            FakeWatcher.__init__(self)
+
+        changes = FakeWatcher.changes
+        close = FakeWatcher.close
+
+    monkeypatch.setattr(watcher, "PollingWatcher", FakePollingWatcher)
+    run_local = FakeRunLocal()
+    with pytest.raises(StopWatching):
+        cli.watch(run_local, make_system("a", "b"), Path(str(tmpdir)),
+                  {"b": "1.0"}, debounce=0.1)
+    assert failing.closed
+    assert run_local.output[0] == (
+        "Watching for changes failed ([Errno 5] Input/output error). "
+        "Falling back to polling for changes.")
+    assert run_local.deployed == [({"a": "newtag", "b": "1.0"}, {"a"})]
+
+
+def test_watch_polling_fails(tmpdir, monkeypatch):
+    """
+    If polling for changes fails, ``watch()`` stops rather than waiting for
+    changes forever.
+    """
+    from errno import EACCES
+    from pathlib import Path
+    from .. import cli, watcher
+    from .test_local import make_system
+
+    (Path(str(tmpdir)) / "a").mkdir()
+    polling = watcher.PollingWatcher({})
+    polling.changes = FailingWatcher(
+        PermissionError(EACCES, "Permission denied")).changes
+    monkeypatch.setattr(watcher, "create_watcher",
+                        lambda services, echo=None: polling)
+    run_local = FakeRunLocal()
+    assert cli.watch(run_local, make_system("a"), Path(str(tmpdir)),
+                     {}, debounce=0.1) == 1
+    assert run_local.output == [
+        "Watching for changes failed ([Errno 13] Permission denied), "
+        "stopping."]
+
+
+def test_watch_watcher_bug(tmpdir, monkeypatch):
+    """Unexpected errors in the watcher are raised by ``watch()``."""
+    from pathlib import Path
+    from .. import cli, watcher
+    from .test_local import make_system
+
+    (Path(str(tmpdir)) / "a").mkdir()
+    monkeypatch.setattr(watcher, "create_watcher",
+                        lambda services, echo=None: FailingWatcher(
+                            ZeroDivisionError()))
+    with pytest.raises(ZeroDivisionError):
+        cli.watch(FakeRunLocal(), make_system("a"), Path(str(tmpdir)), {},
+                  debounce=0.1)
+
+
+def test_deploy_wait(monkeypatch):
+    """
+    ``deploy()`` rebuilds and applies via ``redeploy()``, then waits for the
+    Deployments it applied.
+    """
+    from .. import cli
+
+    calls = []
+
+    class RunLocal(object):
+        def rebuild_docker_images(self, envfile, services_directory):
+            calls.append("rebuild")
+            return {"a": "tag"}
+
+        def deploy(self, envfile, tag_overrides):
+            calls.append(("deploy", tag_overrides))
+            return ["a"]
+
+        def wait_for_rollouts(self, names):
+            calls.append(("wait", names))
+
+    monkeypatch.setattr(cli, "print_service_url", lambda *args: None)
+    assert cli.deploy(RunLocal(), None, None, wait=True) == 0
+    assert calls == ["rebuild", ("deploy", {"a": "tag"}), ("wait", ["a"])]
@@ -0,0 +1,173 @@
+"""Tests for pib.daemon."""
+
+from pathlib import Path
+from threading import Thread
+
+import pytest
+
+from .. import daemon
+from .test_envfile import INSTANCE
+
+
+class FakeRunLocal(object):
+    """Stand-in for ``RunLocal``."""
+
+    def __init__(self):
+        self.echo = None
+        self.logfile = None
+        self.build_jobs = 4
+        self.backend = "kubectl"
+        self.refreshed = 0
+
+    def refresh_minikube(self):
+        self.refreshed += 1
+
+
+@pytest.fixture
+def socket_path(tmpdir):
+    return Path(str(tmpdir)) / "daemon.sock"
+
+
+def start_daemon(socket_path, commands, monkeypatch):
+    """Start a daemon in a thread, stopping it at the end of the test."""
+    # Keep the Envfile cache out of the real home directory:
+    monkeypatch.setattr(daemon, "PIB_DIR", socket_path.parent)
+    pib_daemon = daemon.Daemon(FakeRunLocal(), commands)
+    server = daemon.create_server(pib_daemon, socket_path)
+    thread = Thread(target=server.serve_forever)
+    thread.start()
+    return pib_daemon, server, thread
+
+
+def stop_daemon(server, thread):
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+def write_envfile(tmpdir, contents=INSTANCE):
+    path = Path(str(tmpdir)) / "Envfile.yaml"
+    with path.open("w") as f:
+        f.write(contents)
+    return str(path)
+
+
+def test_no_daemon(socket_path):
+    """If no daemon is running ``request()`` returns ``None``."""
+    assert daemon.request({"command": "deploy"}, print, socket_path) is None
+
+
+def test_request(tmpdir, socket_path, monkeypatch):
+    """
+    ``request()`` runs the command in the daemon, passing through output and
+    the exit code.
+    """
+    calls = []
+
+    def command(run_local, envfile, directory):
+        calls.append((envfile.application.services.keys(), directory))
+        run_local.echo("hello")
+
+    pib_daemon, server, thread = start_daemon(socket_path,
+                                              {"deploy": command}, monkeypatch)
+    try:
+        output = []
+        code = daemon.request({
+            "command": "deploy",
+            "envfile": write_envfile(tmpdir),
+            "directory": "/services",
+        }, output.append, socket_path)
+    finally:
+        stop_daemon(server, thread)
+    assert (code, output) == (0, ["hello"])
+    assert [(list(services), directory) for (services, directory) in calls
+            ] == [(["cloud-service-pipeline-example"], Path("/services"))]
+    # minikube's Docker environment is refreshed before every command:
+    assert pib_daemon.run_local.refreshed == 1
+
+
+def test_request_invalid_envfile(tmpdir, socket_path, monkeypatch):
+    """Envfile validation errors are reported to the client."""
+    pib_daemon, server, thread = start_daemon(
+        socket_path, {"deploy": lambda *args: None}, monkeypatch)
+    try:
+        output = []
+        code = daemon.request({
+            "command": "deploy",
+            "envfile": write_envfile(tmpdir, "not: valid"),
+            "directory": "/services",
+        }, output.append, socket_path)
+    finally:
+        stop_daemon(server, thread)
+    assert code == 1
+    assert output[0] == "Error loading Envfile.yaml:"
+
+
+def test_request_settings_differ(tmpdir, socket_path, monkeypatch):
+    """
+    The client is warned about settings that differ from the daemon's,
+    since the daemon's are used.
+    """
+    pib_daemon, server, thread = start_daemon(
+        socket_path, {"deploy": lambda *args: None}, monkeypatch)
+    try:
+        output = []
+        code = daemon.request({
+            "command": "deploy",
+            "envfile": write_envfile(tmpdir),
+            "directory": "/services",
+            "settings": {"logfile": "/tmp/pib.log", "build_jobs": 4,
+                         "backend": "api"},
+        }, output.append, socket_path)
+    finally:
+        stop_daemon(server, thread)
+    assert code == 0
+    assert output == [
+        "Warning: ignoring --logfile=/tmp/pib.log, the pib daemon uses "
+        "--logfile=-. Restart `pib daemon` to change it.",
+        "Warning: ignoring --kubernetes-backend=api, the pib daemon uses "
+        "--kubernetes-backend=kubectl. Restart `pib daemon` to change it.",
+    ]
+
+
+def test_request_unknown_command(socket_path, monkeypatch):
+    """Unknown commands fail."""
+    pib_daemon, server, thread = start_daemon(socket_path, {}, monkeypatch)
+    try:
+        output = []
+        code = daemon.request({"command": "nope"}, output.append, socket_path)
+    finally:
+        stop_daemon(server, thread)
+    assert (code, output) == (1, ["Unknown command: nope"])
+
+
+def test_envfile_kept_in_memory(tmpdir, monkeypatch):
+    """
+    The daemon only reloads an Envfile when its contents change.
+    """
+    from .. import envfile
+    pib_daemon = daemon.Daemon(FakeRunLocal(), {})
+    monkeypatch.setattr(daemon, "PIB_DIR", Path(str(tmpdir)))
+    path = write_envfile(tmpdir)
+    first = pib_daemon.load_envfile(path)
+
+    def fail(contents, cache_directory):
+        raise AssertionError("Should have been kept in memory")
+
+    monkeypatch.setattr(envfile, "load_cached_envfile", fail)
+    assert pib_daemon.load_envfile(path) is first
+
+    monkeypatch.undo()
+    monkeypatch.setattr(daemon, "PIB_DIR", Path(str(tmpdir)))
+    write_envfile(tmpdir, INSTANCE.replace('tag: "1.0"', 'tag: "2.0"'))
+    assert pib_daemon.load_envfile(path) != first
+
+
+def test_second_daemon_refused(socket_path, monkeypatch):
+    """Only one daemon can listen on a socket at a time."""
+    pib_daemon, server, thread = start_daemon(socket_path, {}, monkeypatch)
+    try:
+        with pytest.raises(RuntimeError):
+            daemon.create_server(pib_daemon, socket_path)
+    finally:
+        stop_daemon(server, thread)
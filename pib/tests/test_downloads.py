@@ -0,0 +1,241 @@
+"""Tests for pib.downloads, using a local HTTP server."""
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import hashlib
+import os
+from pathlib import Path
+from socketserver import ThreadingMixIn
+from threading import Barrier, Thread, Lock
+
+import pytest
+
+from .. import local
+from ..downloads import ensure_downloads, ChecksumMismatch
+from ..local import RunLocal
+
+MINIKUBE_DATA = b"minikube binary" * 1000
+KUBECTL_DATA = b"kubectl binary" * 1000
+
+
+class FakeReleaseServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves release files, supporting range requests.
+
+    :attr files: map URL path to bytes.
+    :attr requests: list of (path, Range header) received.
+    :attr support_ranges: whether Range headers are honoured.
+    :attr barrier: if set, file downloads wait on it before responding.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), FakeReleaseHandler)
+        self.files = {}
+        self.requests = []
+        self.support_ranges = True
+        self.barrier = None
+        self.lock = Lock()
+
+    def url(self, path):
+        return "http://127.0.0.1:{}{}".format(self.server_address[1], path)
+
+    def publish(self, path, data, algorithm="sha256"):
+        """Publish a file along with its checksum file."""
+        self.files[path] = data
+        self.files[path + "." + algorithm] = "{}  {}\n".format(
+            hashlib.new(algorithm, data).hexdigest(),
+            path.rsplit("/", 1)[-1]).encode("utf-8")
+
+
+class FakeReleaseHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        range_header = self.headers.get("Range")
+        with server.lock:
+            server.requests.append((self.path, range_header))
+        data = server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        if server.barrier is not None and not self.path.endswith("sha256"):
+            server.barrier.wait()
+        status = 200
+        if range_header and server.support_ranges:
+            start = int(range_header[len("bytes="):].rstrip("-"))
+            if start >= len(data):
+                self.send_error(416)
+                return
+            data = data[start:]
+            status = 206
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def server():
+    server = FakeReleaseServer()
+    server.publish("/minikube", MINIKUBE_DATA)
+    server.publish("/kubectl", KUBECTL_DATA)
+    thread = Thread(target=server.serve_forever, args=(0.01,))
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def tools(server, tmpdir):
+    """
+    :return: downloads list for minikube and kubectl, verified against their
+        published checksums.
+    """
+    directory = Path(str(tmpdir))
+    return [(directory / "minikube-v1" / "minikube", server.url("/minikube"),
+             server.url("/minikube.sha256"), "sha256", None),
+            (directory / "kubectl-v1" / "kubectl", server.url("/kubectl"),
+             server.url("/kubectl.sha256"), "sha256", None)]
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def read(path):
+    with path.open("rb") as f:
+        return f.read()
+
+
+def test_downloads(server, tmpdir):
+    """
+    Missing tools are downloaded concurrently and made executable, and
+    aren't downloaded again.
+    """
+    # Neither download can finish unless both are in flight:
+    server.barrier = Barrier(2, timeout=5)
+    downloads = tools(server, tmpdir)
+    messages = []
+    ensure_downloads(downloads, messages.append)
+    assert sorted(messages) == ["Downloading kubectl...",
+                                "Downloading minikube..."]
+    minikube, kubectl = downloads[0][0], downloads[1][0]
+    assert read(minikube) == MINIKUBE_DATA
+    assert read(kubectl) == KUBECTL_DATA
+    assert os.access(str(minikube), os.X_OK)
+    assert os.access(str(kubectl), os.X_OK)
+
+    del server.requests[:]
+    ensure_downloads(downloads, messages.append)
+    assert server.requests == []
+
+
+def test_resume(server, tmpdir):
+    """An interrupted download only fetches the remaining bytes."""
+    downloads = tools(server, tmpdir)[:1]
+    path = downloads[0][0]
+    os.makedirs(str(path.parent))
+    with path.with_name("minikube.part").open("wb") as f:
+        f.write(MINIKUBE_DATA[:1000])
+    ensure_downloads(downloads, lambda s: None)
+    assert read(path) == MINIKUBE_DATA
+    assert ("/minikube", "bytes=1000-") in server.requests
+    assert not path.with_name("minikube.part").exists()
+
+
+def test_resume_unsupported(server, tmpdir):
+    """If the server ignores the range, the whole file is downloaded."""
+    server.support_ranges = False
+    downloads = tools(server, tmpdir)[:1]
+    path = downloads[0][0]
+    os.makedirs(str(path.parent))
+    with path.with_name("minikube.part").open("wb") as f:
+        f.write(MINIKUBE_DATA[:1000])
+    ensure_downloads(downloads, lambda s: None)
+    assert read(path) == MINIKUBE_DATA
+
+
+def test_resume_complete_partial(server, tmpdir):
+    """A partial download as long as the file is discarded and refetched."""
+    downloads = tools(server, tmpdir)[:1]
+    path = downloads[0][0]
+    os.makedirs(str(path.parent))
+    with path.with_name("minikube.part").open("wb") as f:
+        f.write(b"x" * len(MINIKUBE_DATA))
+    ensure_downloads(downloads, lambda s: None)
+    assert read(path) == MINIKUBE_DATA
+
+
+def test_checksum_mismatch(server, tmpdir):
+    """
+    A download that doesn't match its checksum is discarded, and the stored
+    published checksum is still used next time.
+    """
+    downloads = tools(server, tmpdir)[:1]
+    path = downloads[0][0]
+    server.files["/minikube"] = b"corrupted"
+    with pytest.raises(ChecksumMismatch):
+        ensure_downloads(downloads, lambda s: None)
+    assert not path.exists()
+    assert not path.with_name("minikube.part").exists()
+
+    # Even if the published checksum changes to match, the stored one wins:
+    server.publish("/minikube", b"corrupted")
+    with pytest.raises(ChecksumMismatch):
+        ensure_downloads(downloads, lambda s: None)
+
+
+def test_published_checksum_file(server, tmpdir):
+    """A previously stored checksum is used without fetching it again."""
+    downloads = tools(server, tmpdir)[:1]
+    path = downloads[0][0]
+    os.makedirs(str(path.parent))
+    with path.with_name("minikube.sha256").open("w") as f:
+        f.write(sha256(MINIKUBE_DATA))
+    ensure_downloads(downloads, lambda s: None)
+    assert [p for (p, _) in server.requests] == ["/minikube"]
+
+
+def test_pinned_checksum(server, tmpdir):
+    """
+    A pinned sha256 digest is used instead of the published checksum.
+    """
+    path, url, checksum_url, algorithm, _ = tools(server, tmpdir)[0]
+    ensure_downloads([(path, url, checksum_url, algorithm,
+                       sha256(MINIKUBE_DATA))], lambda s: None)
+    assert read(path) == MINIKUBE_DATA
+    assert [p for (p, _) in server.requests] == ["/minikube"]
+
+    # A release that matches its published checksum but not the pinned one
+    # is rejected:
+    os.remove(str(path))
+    server.publish("/minikube", b"tampered")
+    with pytest.raises(ChecksumMismatch):
+        ensure_downloads([(path, url, checksum_url, algorithm,
+                           sha256(MINIKUBE_DATA))], lambda s: None)
+    assert not path.exists()
+
+
+def test_ensure_requirements(server, tmpdir, monkeypatch):
+    """
+    ``RunLocal.ensure_requirements()`` downloads the tools for the current
+    platform, verified against the digest pinned for it if there is one.
+    """
+    server.publish("/linux/minikube", MINIKUBE_DATA)
+    server.publish("/linux/kubectl", KUBECTL_DATA, "sha1")
+    directory = Path(str(tmpdir))
+    monkeypatch.setattr(local, "TOOLS", [
+        (directory / "minikube", server.url("/{}/minikube"),
+         server.url("/{}/minikube.sha256"), "sha256",
+         {"linux": sha256(MINIKUBE_DATA), "darwin": sha256(b"other")}),
+        (directory / "kubectl", server.url("/{}/kubectl"),
+         server.url("/{}/kubectl.sha1"), "sha1", {}),
+    ])
+    monkeypatch.setattr(local, "run_result", lambda command: "Linux")
+    RunLocal(None, lambda s: None).ensure_requirements()
+    assert read(directory / "minikube") == MINIKUBE_DATA
+    assert read(directory / "kubectl") == KUBECTL_DATA
+    assert "/linux/minikube.sha256" not in [p for (p, _) in server.requests]
@@ -1,10 +1,15 @@
 """Tests for pib.envfile."""
 
+import os
+from pathlib import Path
+from time import time
+
 import pytest
 from yaml import safe_load
 
 from ..schema import ValidationError
-from ..envfile import (load_envfile, System, LocalDeployment, DockerImage,
+from .. import envfile
+from ..envfile import (load_envfile, load_cached_envfile, System, LocalDeployment, DockerImage,
                        Application, DockerResource, RequiredResource, Expose,
                        Service)
 
@@ -196,3 +201,126 @@ def test_load_valid_instance():
                     "port": 5432, "another": "value"},
             )
         }))
+
+
+def test_load_cached_envfile(tmpdir, monkeypatch):
+    """
+    ``load_cached_envfile`` parses the Envfile contents, and on later calls
+    with the same contents returns the cached result without parsing.
+    """
+    cache = Path(str(tmpdir))
+    contents = INSTANCE.encode("utf-8")
+    expected = load_envfile(safe_load(INSTANCE))
+    assert load_cached_envfile(contents, cache) == expected
+
+    def fail(instance):
+        raise AssertionError("Should have been cached")
+
+    monkeypatch.setattr(envfile, "load_envfile", fail)
+    assert load_cached_envfile(contents, cache) == expected
+
+
+def test_load_cached_envfile_changed_contents(tmpdir):
+    """
+    ``load_cached_envfile`` parses the contents again if they changed.
+    """
+    cache = Path(str(tmpdir))
+    load_cached_envfile(INSTANCE.encode("utf-8"), cache)
+    changed = INSTANCE.replace('tag: "1.0"', 'tag: "2.0"')
+    system = load_cached_envfile(changed.encode("utf-8"), cache)
+    assert system == load_envfile(safe_load(changed))
+
+
+def test_load_cached_envfile_lru(tmpdir, monkeypatch):
+    """
+    When the cache is full the least recently used entry is dropped, where
+    cache hits count as uses.
+    """
+    monkeypatch.setattr(envfile, "CACHE_SIZE", 2)
+    cache = Path(str(tmpdir))
+    contents = [
+        INSTANCE.replace('tag: "1.0"', 'tag: "{}"'.format(i)).encode("utf-8")
+        for i in range(3)]
+    load_cached_envfile(contents[0], cache)
+    load_cached_envfile(contents[1], cache)
+    # Make both entries old, the first one older:
+    for age, entry in [(200, contents[0]), (100, contents[1])]:
+        path = cache / "envfile-{}.pickle".format(envfile._cache_key(entry))
+        os.utime(str(path), (time() - age, time() - age))
+    load_cached_envfile(contents[0], cache)
+    load_cached_envfile(contents[2], cache)
+    assert {p.name for p in cache.glob("envfile-*.pickle")} == {
+        "envfile-{}.pickle".format(envfile._cache_key(contents[i]))
+        for i in [0, 2]}
+
+
+def test_load_cached_envfile_invalid(tmpdir):
+    """
+    Invalid contents raise a ``ValidationError`` every time.
+    """
+    cache = Path(str(tmpdir))
+    for i in range(2):
+        with pytest.raises(ValidationError):
+            load_cached_envfile(b"not: valid", cache)
+
+
+def test_load_optional_fields():
+    """
+    Services without a port and Envfiles without remote get the defaults.
+    """
+    instance = safe_load(INSTANCE)
+    del instance["remote"]
+    del instance["application"]["services"][
+        "cloud-service-pipeline-example"]["port"]
+    system = load_envfile(instance)
+    assert system.remote == {}
+    assert system.application.services[
+        "cloud-service-pipeline-example"].port is None
+
+
+def test_all_semantic_errors_reported():
+    """All semantic errors are reported together."""
+    bad_instance = """\
+Envfile-version: 1
+
+local:
+  templates: {}
+
+application:
+  requires:
+    shared:
+      template: template1
+    other:
+      template: template1
+  services:
+    shared:
+      image:
+        repository: datawire/hello
+        tag: "1.0"
+      expose:
+        path: /hello
+      requires: {}
+    myservice:
+      image:
+        repository: datawire/hello
+        tag: "1.0"
+      expose:
+        path: /hello
+      requires:
+        other:
+          template: template2
+"""
+    with pytest.raises(ValidationError) as result:
+        load_envfile(safe_load(bad_instance))
+    assert sorted(result.value.errors) == sorted([
+        "/application/requires/shared: the name 'shared' conflicts "
+        "with service /application/services/shared",
+        "/application/requires/shared/template: "
+        "the template 'template1' does not exist in /local/templates",
+        "/application/requires/other/template: "
+        "the template 'template1' does not exist in /local/templates",
+        "/application/services/myservice/requires/other: the name 'other'"
+        " conflicts with /application/requires/other",
+        "/application/services/myservice/requires/other/template: "
+        "the template 'template2' does not exist in /local/templates",
+    ])
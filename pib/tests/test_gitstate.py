@@ -0,0 +1,88 @@
+"""Tests for pib._gitstate."""
+
+import os
+
+from .._gitstate import git_state, is_current
+
+
+def write(path, text):
+    """Write text to a file."""
+    with open(str(path), "w") as f:
+        f.write(text)
+
+
+def make_checkout(root):
+    """Create a minimal .git directory."""
+    git = root / ".git"
+    os.makedirs(str(git / "refs" / "heads"))
+    os.makedirs(str(git / "refs" / "tags"))
+    write(git / "HEAD", "ref: refs/heads/master\n")
+    write(git / "refs" / "heads" / "master", "a" * 40 + "\n")
+    return git
+
+
+def test_not_checkout(tmpdir):
+    """Outside a git checkout the state is empty."""
+    assert git_state(str(tmpdir)) == ""
+
+
+def test_unchanged(tmpdir):
+    """The state is the same while nothing changes."""
+    make_checkout(tmpdir)
+    assert git_state(str(tmpdir)) == git_state(str(tmpdir))
+
+
+def test_new_commit(tmpdir):
+    """A new commit on the current branch changes the state."""
+    git = make_checkout(tmpdir)
+    before = git_state(str(tmpdir))
+    write(git / "refs" / "heads" / "master", "b" * 40 + "\n")
+    assert git_state(str(tmpdir)) != before
+
+
+def test_detached_head(tmpdir):
+    """Checking out a different commit changes the state."""
+    git = make_checkout(tmpdir)
+    before = git_state(str(tmpdir))
+    write(git / "HEAD", "b" * 40 + "\n")
+    assert git_state(str(tmpdir)) != before
+
+
+def test_new_tag(tmpdir):
+    """New tags, loose or packed, change the state."""
+    git = make_checkout(tmpdir)
+    before = git_state(str(tmpdir))
+    write(git / "refs" / "tags" / "1.0", "a" * 40 + "\n")
+    loose = git_state(str(tmpdir))
+    assert loose != before
+    write(git / "packed-refs", "{} refs/tags/0.9\n".format("c" * 40))
+    assert git_state(str(tmpdir)) not in (before, loose)
+
+
+def test_undeterminable(tmpdir):
+    """If .git isn't a readable directory the state is unknown."""
+    write(tmpdir / ".git", "gitdir: /elsewhere\n")
+    assert git_state(str(tmpdir)) is None
+
+
+def test_is_current(tmpdir):
+    """A version baked with the current state is current."""
+    make_checkout(tmpdir)
+    state = git_state(str(tmpdir))
+    assert is_current(state, str(tmpdir))
+    assert not is_current("other", str(tmpdir))
+
+
+def test_is_current_not_checkout(tmpdir):
+    """Outside a git checkout a baked version never goes stale."""
+    assert is_current(None, str(tmpdir))
+
+
+def test_is_current_undeterminable(tmpdir):
+    """
+    If the state can't be determined, e.g. in a worktree, a baked version is
+    assumed to be stale even if the state couldn't be determined when it was
+    baked either.
+    """
+    write(tmpdir / ".git", "gitdir: /elsewhere\n")
+    assert not is_current(None, str(tmpdir))
@@ -0,0 +1,105 @@
+"""Tests for pib.images."""
+
+from pathlib import Path
+
+import pytest
+
+from ..images import context_hash, is_ignored, read_dockerignore, ImageIndex
+
+
+def write(path, text):
+    """Write text to a Path."""
+    with path.open("w") as f:
+        f.write(text)
+
+
+@pytest.fixture
+def context(tmpdir):
+    """A Docker build context."""
+    directory = Path(str(tmpdir)) / "context"
+    (directory / "src").mkdir(parents=True)
+    write(directory / "Dockerfile", "FROM scratch\n")
+    write(directory / "src" / "main.py", "print(1)\n")
+    return directory
+
+
+def test_hash_is_stable(context):
+    """Hashing the same context twice gives the same result."""
+    assert context_hash(context) == context_hash(context)
+
+
+def test_hash_changes_with_contents(context):
+    """Changing a file's contents changes the hash."""
+    before = context_hash(context)
+    write(context / "src" / "main.py", "print(2)\n")
+    assert context_hash(context) != before
+
+
+def test_hash_changes_with_new_file(context):
+    """Adding a file changes the hash."""
+    before = context_hash(context)
+    write(context / "src" / "other.py", "")
+    assert context_hash(context) != before
+
+
+def test_hash_changes_with_mode(context):
+    """Making a file executable changes the hash."""
+    before = context_hash(context)
+    (context / "src" / "main.py").chmod(0o755)
+    assert context_hash(context) != before
+
+
+def test_hash_ignores_dockerignored(context):
+    """Files excluded by .dockerignore don't affect the hash."""
+    write(context / ".dockerignore", "*.log\nbuild\n")
+    before = context_hash(context)
+    write(context / "debug.log", "hello")
+    (context / "build").mkdir()
+    write(context / "build" / "output", "hello")
+    assert context_hash(context) == before
+    # Nested .log files aren't matched by "*.log":
+    write(context / "src" / "debug.log", "hello")
+    assert context_hash(context) != before
+
+
+def test_hash_dockerignore_exclusions(context):
+    """Files re-included with ! in .dockerignore do affect the hash."""
+    write(context / ".dockerignore", "build\n!build/keep\n")
+    (context / "build").mkdir()
+    before = context_hash(context)
+    write(context / "build" / "other", "hello")
+    assert context_hash(context) == before
+    write(context / "build" / "keep", "hello")
+    assert context_hash(context) != before
+
+
+@pytest.mark.parametrize("patterns,path,ignored", [
+    ("*.md", "README.md", True),
+    ("*.md", "docs/README.md", False),
+    ("**/*.md", "docs/README.md", True),
+    ("**/*.md", "README.md", True),
+    ("/docs", "docs/README.md", True),
+    ("docs/*", "docs/a/b", True),
+    ("docs/?", "docs/a", True),
+    ("docs/?", "docs/ab", False),
+    ("[a-c].txt", "b.txt", True),
+    ("[^a-c].txt", "b.txt", False),
+    ("*\n!keep.md", "keep.md", False),
+    ("!keep.md\n*", "keep.md", True),
+])
+def test_is_ignored(tmpdir, patterns, path, ignored):
+    """Patterns are matched like Docker does."""
+    directory = Path(str(tmpdir))
+    write(directory / ".dockerignore", patterns)
+    assert is_ignored(path, read_dockerignore(directory)) == ignored
+
+
+def test_index(tmpdir):
+    """The ``ImageIndex`` persists tags by repository and hash."""
+    path = Path(str(tmpdir)) / "images.json"
+    index = ImageIndex(path)
+    assert index.get("example/a", "abc") is None
+    index.set("example/a", "abc", "v1")
+    assert index.get("example/a", "abc") == "v1"
+    assert index.get("example/b", "abc") is None
+    assert ImageIndex(path).get("example/a", "abc") == "v1"
@@ -0,0 +1,394 @@
+"""Tests for pib.kubeapi, using a fake API server."""
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from io import StringIO
+import json
+from pathlib import Path
+from socketserver import ThreadingMixIn
+from threading import Thread, Lock
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+
+from ..kubeapi import ApiClient, ApiError, KubeConfig, load_kubeconfig
+from ..local import RunLocal, KubernetesError
+from .test_images import write
+from .test_local import make_system
+
+DEPLOYMENT = {
+    "apiVersion": "extensions/v1beta1",
+    "kind": "Deployment",
+    "metadata": {"name": "myservice"},
+    "spec": {"replicas": 1},
+}
+DEPLOYMENTS = "/apis/extensions/v1beta1/namespaces/default/deployments"
+
+
+class FakeApiServer(ThreadingMixIn, HTTPServer):
+    """
+    Minimal in-memory Kubernetes API server.
+
+    :attr objects: map object URL path to the object.
+    :attr requests: list of (method, path) received.
+    :attr server_side_apply: whether PATCH with apply-patch is supported.
+
+    Like a real API server, created and replaced objects get a new
+    resourceVersion, Services are allocated a clusterIP and node ports, and
+    replacing an object requires its current resourceVersion and the
+    Service's clusterIP to be unchanged.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), FakeApiHandler)
+        self.objects = {}
+        self.requests = []
+        self.delete_options = []  # decoded bodies of DELETE requests
+        self.connections = set()
+        self.server_side_apply = True
+        self.failure = None  # (status, message) to fail every request with
+        self.lock = Lock()
+        self.last_version = 0
+
+    def store(self, path, obj, live=None):
+        """
+        Store an object as it's created or replaced, filling in the fields
+        the server allocates.
+        """
+        self.last_version += 1
+        obj["metadata"]["resourceVersion"] = str(self.last_version)
+        if obj["kind"] == "Service" and live is None:
+            spec = obj.setdefault("spec", {})
+            spec["clusterIP"] = "10.0.0.{}".format(self.last_version)
+            for port in spec.get("ports", []):
+                port.setdefault("nodePort", 30000 + self.last_version)
+        self.objects[path] = obj
+
+    def replace_error(self, live, obj):
+        """:return: why replacing ``live`` with ``obj`` is invalid, if it is."""
+        version = obj["metadata"].get("resourceVersion")
+        if not version:
+            return 422, ("metadata.resourceVersion: Invalid value: 0x0: "
+                         "must be specified for an update")
+        if version != live["metadata"]["resourceVersion"]:
+            return 409, "the object has been modified"
+        if obj["kind"] == "Service" and obj.get("spec", {}).get(
+                "clusterIP") != live["spec"]["clusterIP"]:
+            return 422, "spec.clusterIP: Invalid value: field is immutable"
+        return None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status, body):
+        data = body.encode("utf-8") if isinstance(body, str) else json.dumps(
+            body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else None
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, url.path))
+            server.connections.add(self.client_address)
+            if url.path == "/healthz":
+                return self._respond(200, "ok")
+            if server.failure is not None:
+                return self._respond(server.failure[0],
+                                     {"message": server.failure[1]})
+            if self.command == "PATCH":
+                if (not server.server_side_apply or
+                        self.headers["Content-Type"] !=
+                        "application/apply-patch+yaml"):
+                    return self._respond(415, {"message": "unsupported"})
+                assert parse_qs(url.query) == {
+                    "fieldManager": ["pib"], "force": ["true"]}
+                server.objects[url.path] = json.loads(body.decode("utf-8"))
+                return self._respond(200, {})
+            if self.command == "POST":
+                obj = json.loads(body.decode("utf-8"))
+                path = url.path + "/" + obj["metadata"]["name"]
+                if path in server.objects:
+                    return self._respond(409, {"message": "exists"})
+                server.store(path, obj)
+                return self._respond(201, obj)
+            if self.command == "PUT":
+                live = server.objects.get(url.path)
+                if live is None:
+                    return self._respond(404, {"message": "not found"})
+                obj = json.loads(body.decode("utf-8"))
+                error = server.replace_error(live, obj)
+                if error is not None:
+                    return self._respond(error[0], {"message": error[1]})
+                server.store(url.path, obj, live)
+                return self._respond(200, obj)
+            if self.command == "DELETE":
+                server.delete_options.append(
+                    json.loads(body.decode("utf-8")) if body else None)
+                if server.objects.pop(url.path, None) is None:
+                    return self._respond(404, {"message": "not found"})
+                return self._respond(200, {})
+            if self.command == "GET":
+                if url.path in server.objects:
+                    return self._respond(200, server.objects[url.path])
+                items = [obj for (path, obj) in server.objects.items()
+                         if path.rsplit("/", 1)[0] == url.path]
+                return self._respond(200, {"items": items})
+        self._respond(405, {"message": "unsupported method"})
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+
+@pytest.fixture
+def server():
+    server = FakeApiServer()
+    thread = Thread(target=server.serve_forever, args=(0.01,))
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+@pytest.fixture
+def client(server):
+    return ApiClient(KubeConfig(server.url), jobs=4)
+
+
+def test_healthy(client):
+    """``healthy()`` checks the API server's health endpoint."""
+    assert client.healthy()
+
+
+def test_unhealthy():
+    """``healthy()`` is false if the API server can't be reached."""
+    assert not ApiClient(KubeConfig("http://127.0.0.1:1")).healthy()
+
+
+def test_apply(server, client):
+    """``apply()`` uses server-side apply."""
+    client.apply(DEPLOYMENT)
+    assert server.objects == {DEPLOYMENTS + "/myservice": DEPLOYMENT}
+    assert server.requests == [("PATCH", DEPLOYMENTS + "/myservice")]
+
+
+def test_apply_old_server(server, client):
+    """
+    If server-side apply isn't supported, objects are created or replaced.
+    """
+    server.server_side_apply = False
+    client.apply(DEPLOYMENT)
+    updated = dict(DEPLOYMENT, spec={"replicas": 2})
+    client.apply(updated)
+    assert server.objects[DEPLOYMENTS + "/myservice"]["spec"] == {
+        "replicas": 2}
+    assert [method for (method, _) in server.requests] == [
+        "PATCH", "POST", "PATCH", "POST", "GET", "PUT"]
+    # The object passed in isn't modified:
+    assert updated["metadata"] == {"name": "myservice"}
+
+
+def test_apply_old_server_service(server, client):
+    """
+    Replacing a Service on an old server keeps the clusterIP and node ports
+    it was allocated.
+    """
+    server.server_side_apply = False
+    service = {
+        "apiVersion": "v1", "kind": "Service",
+        "metadata": {"name": "myservice"},
+        "spec": {"type": "NodePort", "ports": [{"port": 80}]},
+    }
+    client.apply(service)
+    path = "/api/v1/namespaces/default/services/myservice"
+    created = server.objects[path]["spec"]
+    client.apply(dict(service, spec={
+        "type": "NodePort", "ports": [{"port": 80, "protocol": "TCP"}]}))
+    replaced = server.objects[path]["spec"]
+    assert replaced["clusterIP"] == created["clusterIP"]
+    assert replaced["ports"] == [{
+        "port": 80, "protocol": "TCP",
+        "nodePort": created["ports"][0]["nodePort"]}]
+
+
+def test_replace_validated(server, client):
+    """
+    The fake API server rejects replacing an object without its current
+    resourceVersion, like a real one.
+    """
+    server.server_side_apply = False
+    client.apply(DEPLOYMENT)
+    with pytest.raises(ApiError) as e:
+        client._request("PUT", DEPLOYMENTS + "/myservice",
+                        data=json.dumps(DEPLOYMENT))
+    assert e.value.status == 422
+
+
+def test_apply_all(server, client):
+    """``apply_all()`` applies every object, reusing connections."""
+    objs = [{
+        "apiVersion": "v1", "kind": "ConfigMap",
+        "metadata": {"name": "cm{}".format(i)}, "data": {},
+    } for i in range(50)]
+    client.apply_all(objs)
+    assert len(server.objects) == 50
+    # Connections are kept alive rather than one per request:
+    assert len(server.connections) <= client.jobs
+
+
+def test_apply_all_configmaps_first(server, client):
+    """``apply_all()`` applies all ConfigMaps before any other objects."""
+    objs = [dict(DEPLOYMENT, metadata={"name": "d{}".format(i)})
+            for i in range(10)] + [{
+                "apiVersion": "v1", "kind": "ConfigMap",
+                "metadata": {"name": "cm{}".format(i)}, "data": {},
+            } for i in range(10)]
+    client.apply_all(iter(objs))
+    kinds = ["configmaps" in path for (_, path) in server.requests]
+    assert kinds == [True] * 10 + [False] * 10
+
+
+def test_delete(server, client):
+    """``delete()`` deletes objects, ignoring ones that don't exist."""
+    client.apply(DEPLOYMENT)
+    client.delete(DEPLOYMENT)
+    client.delete(DEPLOYMENT)
+    assert server.objects == {}
+
+
+def test_delete_all(server, client):
+    """``delete_all()`` deletes all objects of a kind."""
+    client.apply(DEPLOYMENT)
+    client.apply(dict(DEPLOYMENT, metadata={"name": "other"}))
+    client.apply({"apiVersion": "v1", "kind": "Service",
+                  "metadata": {"name": "myservice"}})
+    client.delete_all("extensions/v1beta1", "Deployment")
+    assert list(server.objects) == [
+        "/api/v1/namespaces/default/services/myservice"]
+
+
+def test_delete_cascades(server, client):
+    """
+    ``delete()`` asks for dependents, e.g. a Deployment's ReplicaSets, to be
+    deleted too rather than orphaned.
+    """
+    client.apply(DEPLOYMENT)
+    client.delete_all("extensions/v1beta1", "Deployment")
+    assert server.delete_options == [{
+        "kind": "DeleteOptions", "apiVersion": "v1",
+        "orphanDependents": False}]
+
+
+def test_error(server, client):
+    """Errors from the API server raise ``ApiError``."""
+    server.server_side_apply = False
+    client.apply(DEPLOYMENT)
+    with pytest.raises(ApiError) as e:
+        client._request("PUT", DEPLOYMENTS + "/unknown", data="{}")
+    assert (e.value.status, e.value.message) == (404, "not found")
+
+
+def test_run_local_backend(server, client):
+    """``RunLocal`` with the "api" backend deploys via the API."""
+    run_local = RunLocal(StringIO(), lambda s: None, backend="api")
+    run_local._kubernetes_api = client
+    run_local.deploy(make_system("a"), {})
+    assert sorted(server.objects) == [
+        "/api/v1/namespaces/default/services/a",
+        "/apis/extensions/v1beta1/namespaces/default/deployments/a",
+        "/apis/extensions/v1beta1/namespaces/default/ingresses/a",
+    ]
+    run_local.wipe()
+    assert server.objects == {}
+
+
+def test_run_local_backend_redeploy_old_server(server, client):
+    """
+    Deploying again with the "api" backend works on API servers without
+    server-side apply, e.g. the Kubernetes 1.5 minikube runs.
+    """
+    server.server_side_apply = False
+    run_local = RunLocal(StringIO(), lambda s: None, backend="api")
+    run_local._kubernetes_api = client
+    run_local.deploy(make_system("a"), {})
+    run_local.deploy(make_system("a"), {"a": "v2"})
+    deployment = server.objects[
+        "/apis/extensions/v1beta1/namespaces/default/deployments/a"]
+    assert deployment["spec"]["template"]["spec"]["containers"][0][
+        "image"].endswith(":v2")
+
+
+def test_run_local_list_error(server, client):
+    """
+    ``RunLocal`` reports API errors when listing objects as
+    ``KubernetesError``, which commands handle rather than treating as bugs.
+    """
+    run_local = RunLocal(StringIO(), lambda s: None, backend="api")
+    run_local._kubernetes_api = client
+    server.failure = (503, "etcd unavailable")
+    with pytest.raises(KubernetesError) as e:
+        run_local._list_objects("v1", "Pod")
+    assert str(e.value) == (
+        "Failed to list Pods: Kubernetes API error 503: etcd unavailable")
+
+
+KUBECONFIG = """\
+apiVersion: v1
+clusters:
+- cluster:
+    certificate-authority: /home/user/.minikube/ca.crt
+    server: https://192.168.99.100:8443
+  name: minikube
+- cluster:
+    server: https://example.com
+  name: other
+contexts:
+- context:
+    cluster: minikube
+    user: minikube
+  name: minikube
+current-context: minikube
+kind: Config
+users:
+- name: minikube
+  user:
+    client-certificate: certs/apiserver.crt
+    client-key-data: aGVsbG8=
+"""
+
+
+def test_load_kubeconfig(tmpdir):
+    """
+    ``load_kubeconfig()`` finds the server and credentials for the context,
+    resolving relative paths and writing out embedded data.
+    """
+    directory = Path(str(tmpdir))
+    write(directory / "config", KUBECONFIG)
+    config = load_kubeconfig(directory / "config",
+                             data_directory=directory / "data")
+    assert config.server == "https://192.168.99.100:8443"
+    assert config.verify == "/home/user/.minikube/ca.crt"
+    assert config.cert[0] == str(directory / "certs" / "apiserver.crt")
+    assert Path(config.cert[1]).open().read() == "hello"
+    assert config.token is None
+
+
+def test_load_kubeconfig_missing_context(tmpdir):
+    """Loading an unknown context raises ``KeyError``."""
+    directory = Path(str(tmpdir))
+    write(directory / "config", KUBECONFIG)
+    with pytest.raises(KeyError):
+        load_kubeconfig(directory / "config", context="nope")
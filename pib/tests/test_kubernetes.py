@@ -354,3 +354,393 @@ def test_render_ingress():
             }]
         }
     }
+
+
+def test_render_cached(monkeypatch):
+    """
+    Rendering an equal object with equal options reuses the earlier result.
+    """
+    cache = k8s.RenderCache()
+    monkeypatch.setattr(k8s, "RENDER_CACHE", cache)
+    options = k8s.RenderingOptions(tag_overrides={"myservice": "v1"})
+    deployment = SIMPLE_K8S_DEPLOYMENT.set("port", 4321)
+    first = deployment.render(options)
+    assert deployment.set("port", 4321).render(
+        k8s.RenderingOptions(tag_overrides={"myservice": "v1"})) == first
+    assert (cache.misses, cache.hits) == (1, 1)
+    other = deployment.render(k8s.RenderingOptions())
+    assert other["spec"]["template"]["spec"]["containers"][0][
+        "image"] == "examplecom/myservice:1.2"
+
+
+def test_render_cached_copies():
+    """
+    Modifying a rendered object doesn't affect later renderings.
+    """
+    options = k8s.RenderingOptions()
+    first = SIMPLE_K8S_DEPLOYMENT.render(options)
+    expected = SIMPLE_K8S_DEPLOYMENT.render(options)
+    first["spec"]["template"]["spec"]["containers"][0]["image"] = "other"
+    first["metadata"]["labels"]["extra"] = "label"
+    assert SIMPLE_K8S_DEPLOYMENT.render(options) == expected
+    assert expected["spec"]["template"]["spec"]["containers"][0][
+        "image"] == "examplecom/myservice:1.2"
+
+
+def test_render_cache_tag_key(monkeypatch):
+    """
+    A Deployment's rendering only depends on its own tag override, and other
+    objects' renderings don't depend on tag overrides at all.
+    """
+    cache = k8s.RenderCache()
+    monkeypatch.setattr(k8s, "RENDER_CACHE", cache)
+    service = k8s.InternalService(deployment=SIMPLE_K8S_DEPLOYMENT)
+    ingress = k8s.Ingress(exposed_path="/", backend_service=service)
+    options = k8s.RenderingOptions(tag_overrides={"myservice": "v1"})
+    for obj in [SIMPLE_K8S_DEPLOYMENT, service, ingress]:
+        obj.render(options)
+    misses = cache.misses
+
+    # Another service's tag changed; nothing needs rendering again:
+    options = options.set(
+        "tag_overrides", options.tag_overrides.set("other", "v2"))
+    for obj in [SIMPLE_K8S_DEPLOYMENT, service, ingress]:
+        obj.render(options)
+    assert cache.misses == misses
+
+    # This service's tag changed; only its Deployment is rendered again:
+    options = options.set(
+        "tag_overrides", options.tag_overrides.set("myservice", "v3"))
+    rendered = [obj.render(options)
+                for obj in [SIMPLE_K8S_DEPLOYMENT, service, ingress]]
+    assert cache.misses == misses + 1
+    assert rendered[0]["spec"]["template"]["spec"]["containers"][0][
+        "image"] == "examplecom/myservice:v3"
+
+
+def test_render_service_without_deployment(monkeypatch):
+    """
+    Rendering an InternalService doesn't render its Deployment, but uses the
+    same metadata.
+    """
+    cache = k8s.RenderCache()
+    monkeypatch.setattr(k8s, "RENDER_CACHE", cache)
+    options = k8s.RenderingOptions()
+    service = k8s.InternalService(deployment=SIMPLE_K8S_DEPLOYMENT).render(
+        options)
+    assert cache.misses == 1
+    deployment = SIMPLE_K8S_DEPLOYMENT.render(options)
+    assert service["metadata"] == deployment["metadata"]
+    assert service["spec"]["selector"] == deployment["metadata"]["labels"]
+
+
+def test_render_cache_reserve(monkeypatch):
+    """
+    Converting an Envfile makes room in the cache for rendering all the
+    objects, so rendering them again doesn't render anything.
+    """
+    system = SIMPLE_SYSTEM.transform(
+        ["application", "services", "myservice", "requires", "myresource"],
+        RequiredResource(name="myresource", template="database"),
+        ["local", "templates", "database"],
+        DockerResource(name="myresource", image="postgres:9.3",
+                       config=dict(port=3535)))
+    cache = k8s.RenderCache(size=2)
+    monkeypatch.setattr(k8s, "RENDER_CACHE", cache)
+    objects = list(k8s.iter_envfile_to_k8s(system))
+    assert len(objects) == 6
+    options = k8s.RenderingOptions()
+    for obj in objects:
+        obj.render(options)
+    misses = cache.misses
+    for obj in objects:
+        obj.render(options)
+    assert cache.misses == misses
+
+
+def test_render_cache_lru():
+    """The least recently used rendering is evicted when the cache is full."""
+    cache = k8s.RenderCache(size=2)
+    rendered = []
+
+    def render(obj, options):
+        rendered.append(obj)
+        return {"name": obj}
+
+    cache.render("a", None, render)
+    cache.render("b", None, render)
+    cache.render("a", None, render)
+    cache.render("c", None, render)
+    assert len(cache) == 2
+    cache.render("a", None, render)
+    cache.render("b", None, render)
+    assert rendered == ["a", "b", "c", "b"]
+
+
+def test_render_shared_configmap_env(monkeypatch):
+    """
+    The env entries for a ConfigMap are rendered once for all the Deployments
+    using it, and each Deployment gets its own copy.
+    """
+    cache = k8s.RenderCache()
+    monkeypatch.setattr(k8s, "RENDER_CACHE", cache)
+    addrconfigmap = k8s.InternalRequiresConfigMap(
+        resource_name="thedb",
+        data={"another": "value"},
+        backend_service=k8s.InternalService(
+            deployment=SIMPLE_K8S_DEPLOYMENT.set("name", "thedb")))
+    options = k8s.RenderingOptions()
+    envs = [
+        SIMPLE_K8S_DEPLOYMENT.set("name", name).set(
+            "address_configmaps", {addrconfigmap}).render(options)["spec"][
+                "template"]["spec"]["containers"][0]["env"]
+        for name in ["service1", "service2"]
+    ]
+    assert [e["name"] for e in envs[0]] == [
+        "THEDB_RESOURCE_ANOTHER", "THEDB_RESOURCE_HOST",
+        "THEDB_RESOURCE_PORT"]
+    assert envs[0] == envs[1]
+    # Two Deployments and the ConfigMap's env entries:
+    assert cache.misses == 3
+
+    envs[0][0]["name"] = "MODIFIED"
+    assert envs[1][0]["name"] == "THEDB_RESOURCE_ANOTHER"
+    assert addrconfigmap.render_env(options)[0]["name"] == (
+        "THEDB_RESOURCE_ANOTHER")
+
+
+def test_render_configmap_env_spliced():
+    """
+    A Deployment's cached rendering splices in the ConfigMap's cached env
+    entries as-is, so they're only copied when the rendering is handed out.
+    """
+    addrconfigmap = k8s.ExternalRequiresConfigMap(
+        name="myservice---thedb", resource_name="thedb",
+        data={"url": "postgres://example.com"})
+    deployment = SIMPLE_K8S_DEPLOYMENT.set("address_configmaps",
+                                           {addrconfigmap})
+    options = k8s.RenderingOptions()
+    shared = deployment._render(options)["spec"]["template"]["spec"][
+        "containers"][0]["env"]
+    assert shared[0] is addrconfigmap._env_entries(options)[0]
+    copied = deployment.render(options)["spec"]["template"]["spec"][
+        "containers"][0]["env"]
+    assert copied == shared
+    assert copied[0] is not shared[0]
+
+
+def test_render_external_configmap_env():
+    """
+    Deployments using an ExternalRequiresConfigMap get env entries pointing
+    at that ConfigMap.
+    """
+    configmap = k8s.ExternalRequiresConfigMap(
+        name="myservice---thedb", resource_name="thedb",
+        data={"url": "postgres://example.com"})
+    rendered = SIMPLE_K8S_DEPLOYMENT.set(
+        "address_configmaps", {configmap}).render(k8s.RenderingOptions())
+    assert rendered["spec"]["template"]["spec"]["containers"][0]["env"] == [{
+        "name": "THEDB_RESOURCE_URL",
+        "valueFrom": {
+            "configMapKeyRef": {
+                "name": "myservice---thedb",
+                "key": "url",
+            }
+        }
+    }]
+
+
+def test_render_env_from():
+    """
+    With ``env_from`` set, each ConfigMap is injected with a single envFrom
+    entry whose prefix keeps the ``<NAME>_RESOURCE_<KEY>`` convention, and
+    ConfigMap keys are upper-cased to match.
+    """
+    options = k8s.RenderingOptions(env_from=True)
+    addrconfigmap = k8s.InternalRequiresConfigMap(
+        resource_name="the-db",
+        data={"another": "value"},
+        backend_service=k8s.InternalService(
+            deployment=SIMPLE_K8S_DEPLOYMENT.set(
+                "name", "myservice---thedb").set("port", 5678)))
+    deployment = SIMPLE_K8S_DEPLOYMENT.set("address_configmaps",
+                                           {addrconfigmap})
+    container = deployment.render(options)["spec"]["template"]["spec"][
+        "containers"][0]
+    assert "env" not in container
+    assert container["envFrom"] == [{
+        "prefix": "THE_DB_RESOURCE_",
+        "configMapRef": {
+            "name": "myservice---thedb",
+        }
+    }]
+    assert addrconfigmap.render(options)["data"] == {
+        "ANOTHER": "value", "HOST": "myservice---thedb", "PORT": "5678"}
+
+
+CHANGES_SYSTEM = System(
+    application=Application(
+        services={
+            name: Service(
+                name=name,
+                image=DockerImage(
+                    repository="examplecom/" + name, tag="1.2"),
+                port=1234,
+                expose=Expose(path="/" + name),
+                requires={
+                    "cache": RequiredResource(name="cache", template="redis")
+                })
+            for name in ["service1", "service2"]
+        },
+        requires={
+            "db": RequiredResource(name="db", template="database")
+        }),
+    local=LocalDeployment(templates={
+        "database": DockerResource(
+            name="database", image="postgres:9.3",
+            config=dict(port=3535, user="pib")),
+        "redis": DockerResource(
+            name="redis", image="redis:3", config=dict(port=6379)),
+    }))
+
+
+def object_ids(objects):
+    """:return: set of (kind, name) rendered from the given objects."""
+    options = k8s.RenderingOptions()
+    return {(o.render(options)["kind"], o.render(options)["metadata"]["name"])
+            for o in objects}
+
+
+def changes(old, new, options=k8s.RenderingOptions()):
+    """:return: tuple of (kind, name) sets to create, update and delete."""
+    result = k8s.envfile_to_k8s_changes(old, new, options)
+    return (object_ids(result.create), object_ids(result.update),
+            object_ids(result.delete))
+
+
+def test_changes_none():
+    """An unchanged Envfile results in no changes."""
+    assert changes(CHANGES_SYSTEM, CHANGES_SYSTEM) == (set(), set(), set())
+
+
+def test_changes_unchanged_services_skipped(monkeypatch):
+    """Only services that changed are converted to K8s objects."""
+    converted = []
+    original = k8s._service_to_k8s
+
+    def service_to_k8s(envfile, service, shared_addressconfigmaps):
+        converted.append(service.name)
+        return original(envfile, service, shared_addressconfigmaps)
+
+    monkeypatch.setattr(k8s, "_service_to_k8s", service_to_k8s)
+    new = CHANGES_SYSTEM.transform(
+        ["application", "services", "service1", "image", "tag"], "1.3")
+    assert changes(CHANGES_SYSTEM, new) == (
+        set(), {("Deployment", "service1")}, set())
+    assert converted == ["service1", "service1"]
+
+
+def test_changes_tag_overrides():
+    """Objects are compared as rendered with the given options."""
+    options = k8s.RenderingOptions(tag_overrides={"service1": "1.3"})
+    new = CHANGES_SYSTEM.transform(
+        ["application", "services", "service1", "image", "tag"], "1.3")
+    assert changes(CHANGES_SYSTEM, new, options) == (set(), set(), set())
+
+
+def test_changes_add_and_remove_service():
+    """Added services are created, removed services are deleted."""
+    new = CHANGES_SYSTEM.transform(
+        ["application", "services"],
+        lambda services: services.remove("service2").set(
+            "service3", services["service2"].set("name", "service3")))
+    service2 = {("Deployment", "service2"), ("Service", "service2"),
+                ("Ingress", "service2"), ("Deployment", "service2---cache"),
+                ("Service", "service2---cache"),
+                ("ConfigMap", "service2---cache")}
+    service3 = {(kind, name.replace("service2", "service3"))
+                for (kind, name) in service2}
+    assert changes(CHANGES_SYSTEM, new) == (service3, set(), service2)
+
+
+def test_changes_shared_template():
+    """
+    Changing a shared resource's template updates the objects that render
+    differently.
+    """
+    new = CHANGES_SYSTEM.transform(
+        ["local", "templates", "database", "config", "user"], "other")
+    assert changes(CHANGES_SYSTEM, new) == (
+        set(), {("ConfigMap", "db")}, set())
+
+
+def test_changes_private_template():
+    """
+    Changing a private resource's template updates every service using it.
+    """
+    new = CHANGES_SYSTEM.transform(
+        ["local", "templates", "redis", "image"], "redis:4")
+    assert changes(CHANGES_SYSTEM, new) == (
+        set(), {("Deployment", "service1---cache"),
+                ("Deployment", "service2---cache")}, set())
+
+
+def test_changes_new_shared_requirement():
+    """
+    A new shared resource is created and added to every service's
+    Deployment.
+    """
+    new = CHANGES_SYSTEM.transform(
+        ["application", "requires", "db2"],
+        RequiredResource(name="db2", template="database"))
+    assert changes(CHANGES_SYSTEM, new) == (
+        {("Deployment", "db2"), ("Service", "db2"), ("ConfigMap", "db2")},
+        {("Deployment", "service1"), ("Deployment", "service2")}, set())
+
+
+def test_iter_envfile_to_k8s_order():
+    """
+    ``iter_envfile_to_k8s()`` yields ConfigMaps, then resource Deployments and
+    Services, then service Deployments, Services and Ingresses, each ordered
+    by name.
+    """
+    options = k8s.RenderingOptions()
+    objects = k8s.iter_envfile_to_k8s(CHANGES_SYSTEM)
+    assert [(type(o).__name__, o.render(options)["metadata"]["name"])
+            for o in objects] == [
+                ("InternalRequiresConfigMap", "db"),
+                ("InternalRequiresConfigMap", "service1---cache"),
+                ("InternalRequiresConfigMap", "service2---cache"),
+                ("Deployment", "db"),
+                ("InternalService", "db"),
+                ("Deployment", "service1---cache"),
+                ("InternalService", "service1---cache"),
+                ("Deployment", "service2---cache"),
+                ("InternalService", "service2---cache"),
+                ("Deployment", "service1"),
+                ("InternalService", "service1"),
+                ("Ingress", "service1"),
+                ("Deployment", "service2"),
+                ("InternalService", "service2"),
+                ("Ingress", "service2")]
+    assert pset(k8s.iter_envfile_to_k8s(CHANGES_SYSTEM)) == envfile_to_k8s(
+        CHANGES_SYSTEM)
+
+
+def test_iter_envfile_to_k8s_lazy(monkeypatch):
+    """
+    Service objects are only created as ``iter_envfile_to_k8s()`` reaches
+    them.
+    """
+    created = []
+    original = k8s._service_objects
+
+    def service_objects(service, address_configmaps):
+        created.append(service.name)
+        return original(service, address_configmaps)
+
+    monkeypatch.setattr(k8s, "_service_objects", service_objects)
+    objects = k8s.iter_envfile_to_k8s(CHANGES_SYSTEM)
+    for _ in range(10):
+        next(objects)
+    assert created == ["service1"]
@@ -0,0 +1,568 @@
+"""Tests for pib.local."""
+
+from io import StringIO
+import json
+import os
+from pathlib import Path
+from subprocess import CalledProcessError
+from threading import Barrier, Timer
+from time import monotonic, sleep
+
+import pytest
+from yaml import safe_load_all
+
+from .. import kubernetes, local
+from ..local import RunLocal
+from ..envfile import System, Application, Service, DockerImage, Expose
+from .test_images import write
+
+
+def make_system(*names):
+    """:return System: with services with the given names."""
+    return System(application=Application(services={
+        name: Service(
+            name=name,
+            image=DockerImage(repository="example/" + name, tag="1.0"),
+            port=80,
+            expose=Expose(path="/" + name))
+        for name in names
+    }))
+
+
+@pytest.fixture
+def services_directory(tmpdir, monkeypatch):
+    """Directory with checkouts of services a and b, but not c."""
+    monkeypatch.setattr(local, "BUILD_LOGS", Path(str(tmpdir)) / "logs")
+    directory = Path(str(tmpdir)) / "services"
+    for name in ["a", "b"]:
+        (directory / name).mkdir(parents=True)
+    return directory
+
+
+def test_rebuild_docker_images_concurrently(services_directory, monkeypatch):
+    """
+    Local services are built concurrently, each logging to its own file;
+    other services use the tag from the Envfile.
+    """
+    # Both builds must be running at the same time to get past this:
+    barrier = Barrier(2, timeout=5)
+
+    def rebuild(self, docker_image, directory, logfile,
+                cancellation=None):
+        barrier.wait()
+        logfile.write("building " + directory.name)
+        return "tag-" + directory.name
+
+    monkeypatch.setattr(RunLocal, "_rebuild_docker_image", rebuild)
+    run_local = RunLocal(StringIO(), lambda s: None, build_jobs=2)
+    result = run_local.rebuild_docker_images(
+        make_system("a", "b", "c"), services_directory)
+    assert result == {"a": "tag-a", "b": "tag-b", "c": "1.0"}
+    assert [(local.BUILD_LOGS / (name + ".log")).open().read()
+            for name in ["a", "b"]] == ["building a", "building b"]
+
+
+def test_rebuild_docker_images_fails_fast(services_directory, monkeypatch):
+    """
+    If a build fails the error is raised and builds that haven't started are
+    cancelled.
+    """
+    for name in ["c", "d"]:
+        (services_directory / name).mkdir()
+    built = []
+
+    def rebuild(self, docker_image, directory, logfile,
+                cancellation=None):
+        built.append(directory.name)
+        raise RuntimeError("build failed")
+
+    monkeypatch.setattr(RunLocal, "_rebuild_docker_image", rebuild)
+    output = []
+    run_local = RunLocal(StringIO(), output.append, build_jobs=1)
+    with pytest.raises(RuntimeError):
+        run_local.rebuild_docker_images(
+            make_system("a", "b", "c", "d"), services_directory)
+    assert len(built) == 1
+    assert "Rebuilding Docker image for {} failed".format(built[0]) in (
+        output[-1])
+
+
+def test_rebuild_docker_images_kills_running(services_directory,
+                                             monkeypatch):
+    """
+    If a build fails, builds that are already running are killed rather than
+    waited for.
+    """
+    def rebuild(self, docker_image, directory, logfile,
+                cancellation=None):
+        if directory.name == "a":
+            self._check_call(["sh", "-c", "sleep 30; true"],
+                             logfile=logfile, cancellation=cancellation)
+            return "tag-a"
+        sleep(0.2)
+        raise RuntimeError("build failed")
+
+    monkeypatch.setattr(RunLocal, "_rebuild_docker_image", rebuild)
+    run_local = RunLocal(StringIO(), lambda s: None, build_jobs=2)
+    start = monotonic()
+    with pytest.raises(RuntimeError):
+        run_local.rebuild_docker_images(
+            make_system("a", "b"), services_directory)
+    assert monotonic() - start < 10
+
+
+def test_rebuild_docker_image_reuses_unchanged(tmpdir, monkeypatch):
+    """
+    Images are tagged by content; unchanged code reuses the existing image
+    instead of being rebuilt.
+    """
+    monkeypatch.setattr(local, "IMAGE_INDEX", Path(str(tmpdir)) / "i.json")
+    monkeypatch.setattr(local, "run_result", lambda *a, **kw: "v1-0-gabc")
+    commands = []
+
+    def check_call(self, command, logfile=None, cancellation=None):
+        commands.append(command[:2])
+
+    monkeypatch.setattr(RunLocal, "_check_call", check_call)
+    directory = Path(str(tmpdir)) / "service"
+    directory.mkdir()
+    write(directory / "Dockerfile", "FROM scratch\n")
+    image = DockerImage(repository="example/service", tag="1.0")
+
+    run_local = RunLocal(StringIO(), lambda s: None)
+    tag = run_local._rebuild_docker_image(image, directory)
+    assert tag.startswith("v1-0-gabc-")
+    assert run_local._rebuild_docker_image(image, directory) == tag
+    assert commands == [["docker", "build"], ["docker", "inspect"]]
+
+    write(directory / "Dockerfile", "FROM scratch\nCMD true\n")
+    assert run_local._rebuild_docker_image(image, directory) != tag
+    assert commands[-1] == ["docker", "build"]
+
+
+def test_rebuild_docker_images_subset(services_directory, monkeypatch):
+    """Only the given services are rebuilt."""
+    def rebuild(self, docker_image, directory, logfile,
+                cancellation=None):
+        return "tag-" + directory.name
+
+    monkeypatch.setattr(RunLocal, "_rebuild_docker_image", rebuild)
+    run_local = RunLocal(StringIO(), lambda s: None)
+    result = run_local.rebuild_docker_images(
+        make_system("a", "b", "c"), services_directory, {"b", "c"})
+    assert result == {"b": "tag-b", "c": "1.0"}
+
+
+def test_deploy_subset(monkeypatch):
+    """
+    If services are given, only their Deployments are applied.
+    """
+    applied = []
+    monkeypatch.setattr(RunLocal, "_kubectl_apply",
+                        lambda self, config: applied.append(config))
+    run_local = RunLocal(StringIO(), lambda s: None)
+    run_local.deploy(make_system("a", "b", "c"), {"b": "new"}, {"b"})
+    assert len(applied) == 1
+    assert "kind: Deployment" in applied[0]
+    assert "image: example/b:new" in applied[0]
+
+
+def test_check_call_cancellation(tmpdir):
+    """
+    Cancelling kills the subprocess and its children, and raises
+    ``Cancelled``.
+    """
+    run_local = RunLocal(tmpdir.join("log").open("w"), lambda s: None)
+    cancellation = local.Cancellation()
+    Timer(0.2, cancellation.cancel).start()
+    start = monotonic()
+    with pytest.raises(local.Cancelled):
+        run_local._check_call(["sh", "-c", "sleep 30; true"],
+                              cancellation=cancellation)
+    assert monotonic() - start < 10
+
+
+def test_check_call_cancellation_failure(tmpdir):
+    """Subprocesses that fail without being cancelled raise as usual."""
+    run_local = RunLocal(tmpdir.join("log").open("w"), lambda s: None)
+    with pytest.raises(CalledProcessError):
+        run_local._check_call(["false"], cancellation=local.Cancellation())
+
+
+def test_deploy_batches(monkeypatch):
+    """
+    ``deploy()`` applies objects in chunks of multi-document YAML.
+    """
+    applied = []
+    monkeypatch.setattr(RunLocal, "_kubectl_apply",
+                        lambda self, config: applied.append(config))
+    run_local = RunLocal(StringIO(), lambda s: None, apply_chunk_size=4)
+    run_local.deploy(make_system("a", "b", "c"), {})
+    documents = [list(safe_load_all(config)) for config in applied]
+    # Three objects per service:
+    assert [len(chunk) for chunk in documents] == [4, 4, 1]
+    assert sorted((d["kind"], d["metadata"]["name"])
+                  for chunk in documents for d in chunk) == sorted(
+                      (kind, name) for name in "abc"
+                      for kind in ["Deployment", "Service", "Ingress"])
+
+
+def test_deploy_streams(monkeypatch):
+    """
+    ``deploy()`` applies the first chunk of objects before later ones are
+    rendered, in dependency order.
+    """
+    rendered = []
+    applied = []
+    original_render = kubernetes.Deployment.render
+
+    def render(self, options):
+        rendered.append(self.name)
+        return original_render(self, options)
+
+    monkeypatch.setattr(kubernetes.Deployment, "render", render)
+    monkeypatch.setattr(
+        RunLocal, "_kubectl_apply",
+        lambda self, config: applied.append(
+            (list(rendered), [d["metadata"]["name"]
+                              for d in safe_load_all(config)])))
+    run_local = RunLocal(StringIO(), lambda s: None, apply_chunk_size=3)
+    assert run_local.deploy(make_system("a", "b"), {}) == ["a", "b"]
+    assert applied == [(["a"], ["a", "a", "a"]),
+                       (["a", "b"], ["b", "b", "b"])]
+
+
+def test_kubectl_stdin(tmpdir, monkeypatch):
+    """kubectl is passed the configuration on stdin."""
+    output = Path(str(tmpdir)) / "output"
+    kubectl = Path(str(tmpdir)) / "kubectl"
+    write(kubectl, '#!/bin/sh\necho "$@" > {0}\ncat >> {0}\n'.format(output))
+    kubectl.chmod(0o755)
+    monkeypatch.setattr(local, "KUBECTL", kubectl)
+    run_local = RunLocal(tmpdir.join("log").open("w"), lambda s: None)
+    run_local._kubectl_apply("a: 1\n---\nb: 2\n")
+    assert output.open().read() == (
+        "--context=minikube apply -f -\na: 1\n---\nb: 2\n")
+
+
+class FakeClock(object):
+    """Replaces ``sleep`` and ``monotonic`` in pib.local."""
+
+    def __init__(self, monkeypatch):
+        self.now = 0
+        self.sleeps = []
+        monkeypatch.setattr(local, "monotonic", lambda: self.now)
+        monkeypatch.setattr(local, "sleep", self.sleep)
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_wait_for_backoff(monkeypatch):
+    """
+    ``wait_for()`` polls with exponential backoff, returning the time spent.
+    """
+    clock = FakeClock(monkeypatch)
+    results = iter([False] * 6 + [True])
+    assert local.wait_for(lambda: next(results), 60, 0.5, 4) == 15.5
+    assert clock.sleeps == [0.5, 1, 2, 4, 4, 4]
+
+
+def test_wait_for_timeout(monkeypatch):
+    """``wait_for()`` gives up at the deadline."""
+    clock = FakeClock(monkeypatch)
+    with pytest.raises(TimeoutError):
+        local.wait_for(lambda: False, 10, 1, 4)
+    assert clock.now == 10
+
+
+def test_minikube_readiness(monkeypatch):
+    """
+    The API server is ready once a node is Ready, the ingress controller once
+    its pod's containers are ready.
+    """
+    outputs = {}
+    monkeypatch.setattr(
+        local, "run_result",
+        lambda command, **kwargs: outputs[command[2]])
+    run_local = RunLocal(StringIO(), lambda s: None)
+
+    def node(ready):
+        return {"status": {"conditions": [
+            {"type": "OutOfDisk", "status": "False"},
+            {"type": "Ready", "status": ready}]}}
+
+    def pod(*ready):
+        return {"status": {"containerStatuses": [
+            {"ready": r} for r in ready]}}
+
+    for nodes, expected in [([], False), ([node("False")], False),
+                            ([node("True")], True)]:
+        outputs["get"] = json.dumps({"items": nodes})
+        assert run_local._api_server_ready() == expected
+    for pods, expected in [([], False), ([pod()], False),
+                           ([pod(True, False)], False),
+                           ([pod(True, True)], True)]:
+        outputs["get"] = json.dumps({"items": pods})
+        assert run_local._ingress_ready() == expected
+
+
+def rollout_objects(name, image, updated, reason=None):
+    """:return: decoded Deployment and Pod for a rollout in progress."""
+    labels = {"name": name}
+    deployment = {
+        "metadata": {"name": name, "generation": 2},
+        "spec": {"replicas": 1, "template": {
+            "metadata": {"labels": labels},
+            "spec": {"containers": [{"image": image}]}}},
+        "status": {"observedGeneration": 2, "replicas": 1,
+                   "updatedReplicas": int(updated),
+                   "availableReplicas": int(updated)},
+    }
+    state = {"waiting": {"reason": reason, "message": "oops"}} if (
+        reason) else {"running": {}}
+    pod = {
+        "metadata": {"labels": labels},
+        "spec": {"containers": [{"image": image}]},
+        "status": {"containerStatuses": [{"state": state}]},
+    }
+    return deployment, pod
+
+
+def fake_cluster(monkeypatch, states):
+    """
+    Make ``RunLocal._list_objects`` return successive states, each a list of
+    (Deployment, Pod) tuples.
+    """
+    states = iter(states)
+    current = []
+
+    def list_objects(self, api_version, kind):
+        if kind == "Deployment":
+            current[:] = next(states)
+            return [deployment for (deployment, pod) in current]
+        return [pod for (deployment, pod) in current]
+
+    monkeypatch.setattr(RunLocal, "_list_objects", list_objects)
+
+
+def test_wait_for_rollouts(monkeypatch):
+    """
+    ``wait_for_rollouts()`` reports each Deployment as it becomes ready.
+    """
+    FakeClock(monkeypatch)
+    fake_cluster(monkeypatch, [
+        [rollout_objects("a", "a:1", False),
+         rollout_objects("b", "b:1", False)],
+        [rollout_objects("a", "a:1", False),
+         rollout_objects("b", "b:1", True)],
+        [rollout_objects("a", "a:1", True),
+         rollout_objects("b", "b:1", True)],
+    ])
+    output = []
+    RunLocal(StringIO(), output.append).wait_for_rollouts(["a", "b"])
+    assert output == ["b ready after 1.0 seconds.",
+                      "a ready after 2.0 seconds."]
+
+
+def test_wait_for_rollouts_fails_fast(monkeypatch):
+    """
+    ``wait_for_rollouts()`` fails as soon as a current pod is crash looping.
+    """
+    FakeClock(monkeypatch)
+    old_deployment, old_pod = rollout_objects("a", "a:1", True,
+                                              "CrashLoopBackOff")
+    new_deployment, new_pod = rollout_objects("a", "a:2", False)
+    fake_cluster(monkeypatch, [
+        # Crash looping pods of the previous version don't matter:
+        [(new_deployment, old_pod)],
+        [(new_deployment, new_pod)],
+        [rollout_objects("a", "a:2", False, "ImagePullBackOff")],
+    ])
+    with pytest.raises(local.RolloutFailed) as e:
+        RunLocal(StringIO(), lambda s: None).wait_for_rollouts(["a"])
+    assert str(e.value) == "a failed: ImagePullBackOff: oops"
+
+
+def test_wait_for_rollouts_timeout(monkeypatch):
+    """``wait_for_rollouts()`` gives up eventually."""
+    FakeClock(monkeypatch)
+    fake_cluster(monkeypatch, [[rollout_objects("a", "a:1", False)]] * 20)
+    with pytest.raises(local.RolloutFailed):
+        RunLocal(StringIO(), lambda s: None).wait_for_rollouts(
+            ["a"], timeout=10)
+
+
+def test_get_application_urls(monkeypatch):
+    """
+    Service URLs are computed from the Services' NodePorts and the minikube
+    IP, which is only looked up once.
+    """
+    commands = []
+
+    def run_result(command, **kwargs):
+        commands.append(command[1:])
+        return "192.168.99.100" if command[1] == "ip" else (
+            "http://192.168.99.100:30003")
+
+    monkeypatch.setattr(local, "run_result", run_result)
+    monkeypatch.setattr(
+        RunLocal, "_list_objects", lambda self, api_version, kind: [{
+            "metadata": {"name": name},
+            "spec": {"ports": [{"port": 80, "nodePort": 30000 + i}]},
+        } for (i, name) in enumerate(["a", "b"])])
+    run_local = RunLocal(StringIO(), lambda s: None)
+    for i in range(2):
+        assert run_local.get_application_urls(make_system("a", "b", "c")) == (
+            {"a": "http://192.168.99.100:30000",
+             "b": "http://192.168.99.100:30001",
+             # Not in the list, so minikube is asked:
+             "c": "http://192.168.99.100:30003"},
+            "http://192.168.99.100/")
+    assert commands == [["ip"], ["service", "--url", "c"],
+                        ["service", "--url", "c"]]
+
+
+DOCKER_ENV = """\
+export DOCKER_TLS_VERIFY="1"
+export DOCKER_HOST="tcp://192.168.99.100:2376"
+# Run this command to configure your shell:
+# eval $(minikube docker-env)
+"""
+
+
+def test_parse_docker_env():
+    """``parse_docker_env()`` extracts the exported variables."""
+    assert local.parse_docker_env(DOCKER_ENV) == {
+        "DOCKER_TLS_VERIFY": "1", "DOCKER_HOST": "tcp://192.168.99.100:2376"}
+
+
+@pytest.fixture
+def minikube(tmpdir, monkeypatch):
+    """
+    Fake minikube, returning list of commands run.
+    """
+    directory = Path(str(tmpdir))
+    monkeypatch.setattr(local, "MINIKUBE_CACHE", directory / "minikube.json")
+    monkeypatch.setattr(local, "MINIKUBE_MACHINES", directory / "machines")
+    monkeypatch.setattr(local, "PIB_DIR", directory)
+    monkeypatch.setattr(local.os, "environ", {})
+    set_machine_ip("192.168.99.100")
+    commands = []
+
+    def run_result(command, **kwargs):
+        commands.append(command[1])
+        return {"status": "Running", "ip": "192.168.99.100",
+                "docker-env": DOCKER_ENV}[command[1]]
+
+    monkeypatch.setattr(local, "run_result", run_result)
+    return commands
+
+
+def set_machine_ip(ip):
+    """Write minikube's machine configuration."""
+    directory = local.MINIKUBE_MACHINES / "minikube"
+    os.makedirs(str(directory), exist_ok=True)
+    write(directory / "config.json",
+          json.dumps({"Driver": {"IPAddress": ip}}))
+
+
+def start_minikube():
+    run_local = RunLocal(StringIO(), lambda s: None)
+    run_local.start_minikube()
+    run_local.set_minikube_docker_env()
+    return run_local
+
+
+def test_minikube_cache(minikube):
+    """
+    minikube status and Docker environment are cached across RunLocal
+    instances.
+    """
+    start_minikube()
+    assert minikube == ["status", "docker-env", "ip"]
+    del minikube[:]
+    local.os.environ.clear()
+    run_local = start_minikube()
+    assert minikube == []
+    assert local.os.environ["DOCKER_HOST"] == "tcp://192.168.99.100:2376"
+    assert run_local.minikube_ip == "192.168.99.100"
+
+
+def test_minikube_cache_expires(minikube, monkeypatch):
+    """The cache is ignored once it's too old."""
+    start_minikube()
+    del minikube[:]
+    now = local.time()
+    monkeypatch.setattr(local, "time",
+                        lambda: now + local.MINIKUBE_CACHE_TTL + 1)
+    start_minikube()
+    assert minikube == ["status", "docker-env", "ip"]
+
+
+def test_minikube_cache_ip_changed(minikube):
+    """The cache is ignored if the minikube VM's IP changed."""
+    start_minikube()
+    del minikube[:]
+    set_machine_ip("192.168.99.101")
+    start_minikube()
+    assert minikube == ["status", "docker-env", "ip"]
+
+
+def test_minikube_cache_profile_changed(minikube):
+    """The cache is ignored if a different minikube profile is used."""
+    start_minikube()
+    del minikube[:]
+    local.os.environ["MINIKUBE_PROFILE"] = "other"
+    start_minikube()
+    assert minikube == ["status", "docker-env", "ip"]
+
+
+def test_refresh_minikube(minikube):
+    """
+    ``refresh_minikube()`` does nothing while the minikube cache is current.
+    """
+    run_local = start_minikube()
+    del minikube[:]
+    run_local.refresh_minikube()
+    assert minikube == []
+
+
+def test_refresh_minikube_restarted(minikube):
+    """
+    ``refresh_minikube()`` checks minikube and updates the Docker environment
+    once minikube has restarted with a different IP.
+    """
+    run_local = start_minikube()
+    del minikube[:]
+    local.os.environ.clear()
+    set_machine_ip("192.168.99.101")
+    run_local.refresh_minikube()
+    assert minikube == ["status", "docker-env", "ip"]
+    assert local.os.environ["DOCKER_HOST"] == "tcp://192.168.99.100:2376"
+
+
+def test_minikube_ip_invalidated(minikube):
+    """
+    A ``RunLocal`` that outlives a minikube restart, e.g. in `pib daemon`,
+    notices the VM's IP changed.
+    """
+    run_local = start_minikube()
+    del minikube[:]
+    assert run_local.minikube_ip == "192.168.99.100"
+    assert minikube == []
+    set_machine_ip("192.168.99.101")
+    run_local.minikube_ip
+    assert minikube == ["ip"]
+
+
+def test_minikube_ip_expires(minikube, monkeypatch):
+    """The minikube IP is only remembered for the minikube cache's TTL."""
+    run_local = start_minikube()
+    del minikube[:]
+    now = local.time()
+    monkeypatch.setattr(local, "time",
+                        lambda: now + local.MINIKUBE_CACHE_TTL + 1)
+    run_local.minikube_ip
+    assert minikube == ["ip"]
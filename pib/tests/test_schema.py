@@ -35,3 +35,18 @@ def test_error_on_bad_instance():
         "/: 'count' is a required property",
         "/name: 123 is not of type 'string'"
     ])
+
+
+def test_envfile_validator_is_reused(monkeypatch):
+    """
+    Validating against the Envfile schema doesn't construct a new validator.
+    """
+    from .. import schema
+
+    def fail(schema):
+        raise AssertionError("Validator should not be constructed")
+
+    monkeypatch.setattr(schema, "Draft4Validator", fail)
+    with pytest.raises(ValidationError) as e:
+        validate(schema.ENVFILE_SCHEMA, {"not": "valid"})
+    assert e.value.errors
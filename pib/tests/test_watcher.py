@@ -0,0 +1,204 @@
+"""Tests for pib.watcher."""
+
+import ctypes
+from errno import ENOSPC
+from pathlib import Path
+from time import monotonic
+
+import pytest
+
+from .. import watcher as watcher_module
+from ..watcher import (InotifyWatcher, PollingWatcher, WatchLimitReached,
+                       create_watcher as real_create_watcher)
+from .test_images import write
+
+
+def next_changes(watcher, quiet=0.1):
+    """
+    Wait for changes, then keep collecting them until there are none for
+    ``quiet`` seconds, since one change may be reported over several calls.
+
+    :return set: names of services with relevant changes.
+    """
+    deadline = monotonic() + 5
+    changed = set()
+    while not changed:
+        assert monotonic() < deadline
+        changed = watcher.changes(timeout=1)
+    while True:
+        more = watcher.changes(timeout=quiet)
+        if not more:
+            return changed
+        changed |= more
+
+
+def polling_watcher(services):
+    return PollingWatcher(services, interval=0.01)
+
+
+def inotify_watcher(services):
+    try:
+        return InotifyWatcher(services)
+    except (AttributeError, OSError):
+        pytest.skip("inotify is not available")
+
+
+@pytest.fixture(params=[polling_watcher, inotify_watcher])
+def create_watcher(request):
+    return request.param
+
+
+@pytest.fixture
+def services(tmpdir):
+    """Checkouts for services a and b."""
+    result = {}
+    for name in ["a", "b"]:
+        directory = Path(str(tmpdir)) / name
+        (directory / "src").mkdir(parents=True)
+        write(directory / "Dockerfile", "FROM scratch\n")
+        write(directory / ".dockerignore", "*.log\n")
+        result[name] = directory
+    return result
+
+
+def test_no_changes(create_watcher, services):
+    """If nothing changes no changes are reported."""
+    watcher = create_watcher(services)
+    try:
+        assert watcher.changes(timeout=0.1) == set()
+    finally:
+        watcher.close()
+
+
+def test_changes(create_watcher, services):
+    """Changes to files are reported by service."""
+    watcher = create_watcher(services)
+    try:
+        write(services["b"] / "src" / "main.py", "print(1)\n")
+        assert next_changes(watcher) == {"b"}
+    finally:
+        watcher.close()
+
+
+def test_new_directory(create_watcher, services):
+    """Changes in newly created directories are reported."""
+    watcher = create_watcher(services)
+    try:
+        (services["a"] / "new").mkdir()
+        assert next_changes(watcher) == {"a"}
+        write(services["a"] / "new" / "file", "hello")
+        assert next_changes(watcher) == {"a"}
+    finally:
+        watcher.close()
+
+
+def test_irrelevant_changes(create_watcher, services):
+    """Changes to files Docker ignores, or to .git, aren't reported."""
+    (services["a"] / ".git").mkdir()
+    watcher = create_watcher(services)
+    try:
+        write(services["a"] / "debug.log", "hello")
+        write(services["a"] / ".git" / "index", "hello")
+        assert watcher.changes(timeout=0.2) == set()
+    finally:
+        watcher.close()
+
+
+def test_dockerignore_change(create_watcher, services):
+    """
+    Changes to .dockerignore are picked up, so files that were ignored are
+    watched once they're no longer ignored.
+    """
+    (services["a"] / "ignored").mkdir()
+    write(services["a"] / ".dockerignore", "ignored\n")
+    watcher = create_watcher(services)
+    try:
+        write(services["a"] / "ignored" / "file", "hello")
+        assert watcher.changes(timeout=0.2) == set()
+        write(services["a"] / ".dockerignore", "*.log\n")
+        assert next_changes(watcher) == {"a"}
+        write(services["a"] / "ignored" / "file", "changed")
+        assert next_changes(watcher) == {"a"}
+    finally:
+        watcher.close()
+
+
+def test_dockerignore_parsed_once(services, monkeypatch):
+    """
+    .dockerignore is parsed once per service, not once per file, until it
+    changes.
+    """
+    for i in range(50):
+        write(services["a"] / "src" / "file{}.py".format(i), "")
+    calls = []
+    original = watcher_module.read_dockerignore
+
+    def read_dockerignore(directory):
+        calls.append(directory.name)
+        return original(directory)
+
+    monkeypatch.setattr(watcher_module, "read_dockerignore",
+                        read_dockerignore)
+    watcher = PollingWatcher(services, interval=0.01)
+    assert watcher.changes(timeout=0.05) == set()
+    assert sorted(calls) == ["a", "b"]
+    write(services["a"] / ".dockerignore", "*.text\n")
+    assert watcher.changes(timeout=1) == {"a"}
+    assert sorted(calls) == ["a", "a", "b"]
+
+
+def test_ignored_directories_pruned(services):
+    """
+    Ignored directories aren't walked, unless exclusions might re-include
+    something inside them.
+    """
+    directory = services["a"]
+    (directory / "node_modules" / "lib").mkdir(parents=True)
+    write(directory / ".dockerignore", "node_modules\n")
+    walked = [watcher_module._relative(path, directory)
+              for path in watcher_module._walk_directories(
+                  watcher_module._DockerignoreRules(directory))]
+    assert sorted(walked) == [".", "src"]
+
+    write(directory / ".dockerignore", "node_modules\n!node_modules/lib\n")
+    walked = [watcher_module._relative(path, directory)
+              for path in watcher_module._walk_directories(
+                  watcher_module._DockerignoreRules(directory))]
+    assert sorted(walked) == [".", "node_modules", "node_modules/lib", "src"]
+
+
+def test_watch_limit_reached(services):
+    """
+    Running out of inotify watches is reported rather than silently losing
+    changes.
+    """
+    watcher = inotify_watcher(services)
+
+    class FakeLibc(object):
+        def inotify_add_watch(self, fd, path, mask):
+            ctypes.set_errno(ENOSPC)
+            return -1
+
+    watcher._libc = FakeLibc()
+    try:
+        (services["a"] / "new").mkdir()
+        with pytest.raises(WatchLimitReached):
+            next_changes(watcher)
+    finally:
+        watcher.close()
+
+
+def test_create_watcher_limit_reached(services, monkeypatch):
+    """
+    If inotify runs out of watches, ``create_watcher()`` says so and falls
+    back to polling.
+    """
+    def fail(services):
+        raise WatchLimitReached(ENOSPC, "Ran out of inotify watches")
+
+    monkeypatch.setattr(watcher_module, "InotifyWatcher", fail)
+    output = []
+    watcher = real_create_watcher(services, output.append)
+    assert isinstance(watcher, PollingWatcher)
+    assert output == [
+        "Ran out of inotify watches. Falling back to polling for changes."]
@@ -0,0 +1,24 @@
+"""Tests for pib._yaml."""
+
+import yaml
+
+from .. import _yaml
+
+
+def test_uses_libyaml_when_available():
+    """The C implementation is used if PyYAML was built with libyaml."""
+    if yaml.__with_libyaml__:
+        assert _yaml.SafeLoader is yaml.CSafeLoader
+        assert _yaml.SafeDumper is yaml.CSafeDumper
+    else:
+        assert _yaml.SafeLoader is yaml.SafeLoader
+        assert _yaml.SafeDumper is yaml.SafeDumper
+
+
+def test_roundtrip_matches_pure_python():
+    """Loading and dumping gives the same results as the pure-Python code."""
+    data = {"a": [1, "2", {"b": None, "c": 3.5}], "d": {"e": True}}
+    dumped = _yaml.safe_dump(data)
+    assert yaml.safe_load(dumped) == data
+    assert _yaml.safe_load(yaml.safe_dump(data)) == data
+    assert _yaml.safe_load(dumped) == data
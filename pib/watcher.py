@@ -0,0 +1,306 @@
+"""Watch service checkouts for changes.
+
+On Linux this uses inotify, so nothing happens until files change. Elsewhere
+it falls back to periodically comparing file metadata.
+"""
+
+import ctypes
+import ctypes.util
+from errno import ENOENT, ENOSPC, ENOTDIR
+import os
+import select
+import struct
+from time import monotonic, sleep
+
+from .images import read_dockerignore, is_ignored
+
+# inotify constants, from <sys/inotify.h>:
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+               IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class WatchLimitReached(OSError):
+    """inotify ran out of watches, see fs.inotify.max_user_watches."""
+
+
+def is_relevant(service_directory, relative_path, patterns=None):
+    """
+    :param service_directory Path: A service's checkout.
+    :param relative_path str: '/'-separated path of a changed file.
+    :param patterns: the service's parsed .dockerignore, read from
+        ``service_directory`` if not given.
+    :return bool: whether the change can affect the service's Docker image.
+    """
+    if relative_path == ".git" or relative_path.startswith(".git/"):
+        return False
+    if relative_path in ("Dockerfile", ".dockerignore"):
+        return True
+    if patterns is None:
+        patterns = read_dockerignore(service_directory)
+    return not is_ignored(relative_path, patterns)
+
+
+class _DockerignoreRules(object):
+    """
+    A service's .dockerignore patterns, only parsed again when the file
+    changes.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._key = object()
+        self.patterns = []
+        self.refresh()
+
+    def refresh(self):
+        """
+        Re-read .dockerignore if it changed.
+
+        :return bool: whether it changed.
+        """
+        try:
+            stat = os.stat(str(self.directory / ".dockerignore"))
+            key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        except OSError:
+            key = None
+        if key == self._key:
+            return False
+        self._key = key
+        self.patterns = read_dockerignore(self.directory)
+        return True
+
+    @property
+    def can_prune(self):
+        """
+        Whether ignored directories can be skipped entirely; with exclusions
+        an ignored directory may still contain files that are sent.
+        """
+        return not any(exclusion for (_, exclusion) in self.patterns)
+
+    def is_relevant(self, relative_path):
+        """:return bool: whether a change to the path matters."""
+        return is_relevant(self.directory, relative_path, self.patterns)
+
+    def is_pruned(self, relative_path):
+        """:return bool: whether a directory can be skipped entirely."""
+        if relative_path == ".git" or relative_path.startswith(".git/"):
+            return True
+        return self.can_prune and not self.is_relevant(relative_path)
+
+
+def _relative(path, root):
+    """:return str: '/'-separated path relative to ``root``."""
+    return os.path.relpath(path, str(root)).replace(os.sep, "/")
+
+
+def _walk_directories(rules, start=None):
+    """
+    Yield a directory in a service's checkout and all its subdirectories,
+    skipping .git and, where possible, directories Docker ignores.
+
+    :param rules _DockerignoreRules: The service's rules.
+    :param start: directory to start from, by default the whole checkout.
+    """
+    root = rules.directory
+    start = str(root if start is None else start)
+    if start != str(root) and rules.is_pruned(_relative(start, root)):
+        return
+    for dirpath, dirnames, _ in os.walk(start):
+        dirnames[:] = [
+            d for d in dirnames
+            if not rules.is_pruned(_relative(os.path.join(dirpath, d), root))
+        ]
+        yield dirpath
+
+
+class InotifyWatcher(object):
+    """Watch service checkouts using Linux's inotify."""
+
+    def __init__(self, services):
+        """
+        :param services: map service names to their checkout ``Path``.
+        """
+        self._libc = ctypes.CDLL(
+            ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._services = services
+        self._rules = {name: _DockerignoreRules(directory)
+                       for name, directory in services.items()}
+        self._watches = {}  # map watch descriptor to (service name, path)
+        self._watched = set()  # watched paths
+        try:
+            for name in services:
+                self._add_watches(name)
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    def _add_watches(self, name, start=None):
+        """Watch a directory and its relevant subdirectories."""
+        for path in _walk_directories(self._rules[name], start):
+            if path in self._watched:
+                continue
+            wd = self._libc.inotify_add_watch(
+                self._fd, os.fsencode(path), _WATCH_MASK)
+            if wd >= 0:
+                self._watches[wd] = (name, path)
+                self._watched.add(path)
+                continue
+            errno = ctypes.get_errno()
+            if errno == ENOSPC:
+                raise WatchLimitReached(
+                    errno, "Ran out of inotify watches watching {}; raise "
+                    "the fs.inotify.max_user_watches sysctl".format(path))
+            if errno not in (ENOENT, ENOTDIR):
+                raise OSError(errno, os.strerror(errno), path)
+            # Otherwise the directory was removed already.
+
+    def close(self):
+        os.close(self._fd)
+
+    def changes(self, timeout=None):
+        """Wait for changes.
+
+        :param timeout: seconds to wait, or ``None`` to wait forever.
+        :return set: names of services with relevant changes, empty if the
+            timeout was reached.
+        :raises WatchLimitReached: if new directories can't be watched.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        data = os.read(self._fd, 65536)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            filename = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so assume everything changed:
+                return set(self._services)
+            if mask & IN_IGNORED:
+                removed = self._watches.pop(wd, None)
+                if removed is not None:
+                    self._watched.discard(removed[1])
+                continue
+            if wd not in self._watches:
+                continue
+            name, directory_path = self._watches[wd]
+            path = os.path.join(directory_path, filename)
+            rules = self._rules[name]
+            relative_path = _relative(path, self._services[name])
+            if relative_path == ".dockerignore" and rules.refresh():
+                # Directories that were ignored may matter now:
+                self._add_watches(name)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_watches(name, path)
+            if relative_path == ".":
+                # The checkout itself was deleted:
+                changed.add(name)
+            elif rules.is_relevant(relative_path):
+                changed.add(name)
+        return changed
+
+
+class PollingWatcher(object):
+    """Watch service checkouts by comparing file metadata."""
+
+    def __init__(self, services, interval=1.0):
+        """
+        :param services: map service names to their checkout ``Path``.
+        :param interval: seconds between checks.
+        """
+        self._services = services
+        self._interval = interval
+        self._rules = {name: _DockerignoreRules(directory)
+                       for name, directory in services.items()}
+        self._snapshots = {
+            name: self._snapshot(name) for name in services
+        }
+
+    def _snapshot(self, service):
+        """:return dict: map relevant paths to their metadata."""
+        rules = self._rules[service]
+        rules.refresh()
+        snapshot = {}
+        root = str(rules.directory)
+        for dirpath in _walk_directories(rules):
+            for name in os.listdir(dirpath):
+                path = os.path.join(dirpath, name)
+                relative_path = _relative(path, root)
+                if not rules.is_relevant(relative_path):
+                    continue
+                try:
+                    stat = os.lstat(path)
+                except OSError:
+                    continue
+                snapshot[relative_path] = (stat.st_mtime_ns, stat.st_size,
+                                           stat.st_mode)
+        return snapshot
+
+    def close(self):
+        pass
+
+    def changes(self, timeout=None):
+        """Wait for changes.
+
+        :param timeout: seconds to wait, or ``None`` to wait forever.
+        :return set: names of services with relevant changes, empty if the
+            timeout was reached.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            changed = set()
+            for name in self._services:
+                snapshot = self._snapshot(name)
+                if snapshot != self._snapshots[name]:
+                    self._snapshots[name] = snapshot
+                    changed.add(name)
+            if changed:
+                return changed
+            if deadline is not None:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return changed
+                sleep(min(self._interval, remaining))
+            else:
+                sleep(self._interval)
+
+
+def create_watcher(services, echo=None):
+    """Create the best available watcher for this platform.
+
+    :param services: map service names to their checkout ``Path``.
+    :param echo: optional callable to report problems with inotify to.
+    """
+    try:
+        return InotifyWatcher(services)
+    except WatchLimitReached as e:
+        if echo is not None:
+            echo("{}. Falling back to polling for changes.".format(
+                e.strerror))
+        return PollingWatcher(services)
+    except (AttributeError, OSError):
+        # No inotify, e.g. on macOS:
+        return PollingWatcher(services)
+
+
+__all__ = ["create_watcher", "InotifyWatcher", "PollingWatcher",
+           "WatchLimitReached"]
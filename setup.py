@@ -1,12 +1,44 @@
+import json
+
 from setuptools import setup, find_packages
+from setuptools.command.egg_info import egg_info as _egg_info
 
 import versioneer
+from pib._gitstate import git_state
+
+
+STATIC_VERSION_FILE = "pib/_static_version.py"
+
+
+class egg_info(_egg_info):
+    """
+    Development installs run from the source tree, where pib/_version.py asks
+    git for the version on every import. Bake the version in instead, like
+    versioneer does for pib/_version.py in builds.
+
+    egg_info runs for every install, including `setup.py develop` and
+    `pip install -e` (which doesn't run `develop` with PEP 660 builds). The
+    git state is recorded too, so pib/__init__.py can ignore the file once
+    there are new commits or tags.
+    """
+
+    def run(self):
+        contents = json.dumps(versioneer.get_versions(), sort_keys=True,
+                              indent=1, separators=(",", ": "))
+        with open(STATIC_VERSION_FILE, "w") as f:
+            f.write(versioneer.SHORT_VERSION_PY % contents)
+            f.write("\n\nGIT_STATE = {!r}\n".format(git_state()))
+        _egg_info.run(self)
+
+
+cmdclass = versioneer.get_cmdclass()
+cmdclass["egg_info"] = egg_info
 
 
 setup(
     name='pib',
     description='Pib: dev and prod application stacks on Kubernetes',
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['tests', 'benchmarks']),
     entry_points={
         'console_scripts': [
             'pib=pib.cli:main',
@@ -16,5 +48,5 @@ setup(
         "pib": ["*.yaml"],
     },
     version=versioneer.get_version(),
-    cmdclass=versioneer.get_cmdclass(),
+    cmdclass=cmdclass,
 )